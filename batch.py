@@ -0,0 +1,482 @@
+import argparse
+import json
+import re
+import sys
+import threading
+from collections import Counter, deque
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterator, List, Optional, TextIO, Tuple
+
+import kakuyomu
+import narou_downloader
+from catalog import CATALOG_NAME, Catalog
+from download_engine import DownloadEngine, DownloadError, SiteAdapter, check_episode_range
+from download_metrics import metrics, profiled, serve_prometheus
+from episode_cache import DEFAULT_CACHE_DIR, EpisodeCache
+from epub_images import DEFAULT_IMAGE_QUALITY, ImageOptions
+from epub_volumes import VolumeOptions
+from http_client import DEFAULT_MAX_RETRIES, HttpClient, parse_rate_limit
+from narou_api import NAROU_API_URL
+from output_sinks import FORMATS, SinkOptions
+from page_parser import BACKENDS, create_parse_pool, set_backend
+
+DEFAULT_WORKERS = 16
+DEFAULT_SITE_WORKERS = 8
+DEFAULT_ACTIVE_WORKS = 8
+
+ADAPTERS: Dict[str, SiteAdapter] = {
+    "kakuyomu": kakuyomu.KakuyomuAdapter(),
+    "narou": narou_downloader.NarouAdapter(),
+}
+
+KAKUYOMU_URL = re.compile(r'kakuyomu\.jp/works/(\d+)')
+NAROU_URL = re.compile(r'ncode\.syosetu\.com/(n\d+[a-z]+)', re.IGNORECASE)
+KAKUYOMU_ID = re.compile(r'\d+')
+NAROU_ID = re.compile(r'n\d+[a-z]+', re.IGNORECASE)
+
+
+def parse_work_ref(line: str) -> Optional[Tuple[str, str]]:
+    """Return the site and work ID of a Kakuyomu or Narou URL or ID, or None if it is neither."""
+    line = line.strip()
+    for pattern, site in ((KAKUYOMU_URL, "kakuyomu"), (NAROU_URL, "narou")):
+        match = pattern.search(line)
+        if match:
+            return site, match.group(1).lower()
+    if KAKUYOMU_ID.fullmatch(line):
+        return "kakuyomu", line
+    if NAROU_ID.fullmatch(line):
+        return "narou", line.lower()
+    return None
+
+
+def parse_site_limit(value: str) -> Dict[str, int]:
+    """Parse a ``site=workers`` command line option."""
+    site, _, workers = value.partition("=")
+    if site not in ADAPTERS or not workers:
+        raise ValueError(f"expected kakuyomu=N or narou=N, got {value!r}")
+    return {site: int(workers)}
+
+
+class BatchWork:
+    """A work of a batch and the outcome of its download."""
+
+    def __init__(
+        self,
+        site: str,
+        work_id: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+    ):
+        self.site = site
+        self.work_id = work_id
+        # Episodes to download, as for DownloadEngine.run (all of them when None)
+        self.start = start
+        self.end = end
+        self.latest = latest
+        self.title: Optional[str] = None
+        self.state = "waiting"  # waiting, running, done or failed
+        self.paused = False
+        # Whether the thread downloading the work is still going (a cancelled work's winds down)
+        self.running = False
+        self.error: Optional[str] = None
+        self.paths: List[Path] = []
+        # Episodes packaged and expected so far, as reported by the engine (0 while unknown)
+        self.done = 0
+        self.total = 0
+        self.engine: Optional[DownloadEngine] = None
+
+    def reset(self) -> None:
+        """Forget the outcome of a finished work so it can be downloaded again."""
+        self.state = "waiting"
+        self.paused = False
+        self.error = None
+        self.paths = []
+        self.done = 0
+        self.total = 0
+        self.engine = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.site} {self.work_id}"
+
+
+def parse_episode_range(text: str) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+    """Parse ``N-M``, ``N-``, ``-M`` or ``latest:N`` into the first, last and latest episode numbers."""
+    if text.startswith("latest:"):
+        numbers = [None, None, text[len("latest:"):]]
+    else:
+        first, dash, last = text.partition("-")
+        if not dash:
+            raise ValueError(f"expected N-M, N-, -M or latest:N, got {text!r}")
+        numbers = [first, last, None]
+    parsed = []
+    for number in numbers:
+        if number is None or number == "":
+            parsed.append(None)
+        elif not number.isdigit():
+            raise ValueError(f"{number!r} is not an episode number")
+        else:
+            parsed.append(int(number))
+    start, end, latest = parsed
+    if start is None and end is None and latest is None:
+        raise ValueError(f"expected N-M, N-, -M or latest:N, got {text!r}")
+    check_episode_range(start, end, latest)
+    return start, end, latest
+
+
+def read_work_list(lines: TextIO, log: Callable[[str], None] = print) -> List[BatchWork]:
+    """Read one work per line, skipping blank lines, ``#`` comments and duplicates.
+
+    A work may be followed by the episodes to download, as ``N-M``, ``N-``,
+    ``-M`` or ``latest:N``; otherwise all of them are.
+    """
+    works: List[BatchWork] = []
+    for line_num, line in enumerate(lines, start=1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        ref = parse_work_ref(fields[0])
+        if ref is None or len(fields) > 2:
+            log(f"[ERROR] Line {line_num}: not a Kakuyomu or Narou work: {' '.join(fields)}")
+            continue
+        try:
+            episodes = parse_episode_range(fields[1]) if len(fields) == 2 else (None, None, None)
+        except ValueError as exc:
+            log(f"[ERROR] Line {line_num}: {exc}")
+            continue
+        if all((work.site, work.work_id) != ref for work in works):
+            works.append(BatchWork(*ref, *episodes))
+    return works
+
+
+class BatchScheduler:
+    """Starts the works of a batch and shares a budget of page requests among them.
+
+    At most ``max_active`` works are in progress at once (paused works don't
+    count). Each runs its own download pipeline, whose fetch threads take a
+    slot from ``slot`` for every page: no more than ``workers`` requests run
+    at once, and no more than the site's limit against one site. Slots go to
+    the works in the order they asked for them, so the active works advance
+    at the same pace. With ``keep_open`` more works can be added until
+    ``stop`` is called, instead of the batch ending once all have started.
+    """
+
+    def __init__(
+        self,
+        works: List[BatchWork],
+        site_limits: Dict[str, int],
+        max_active: int = DEFAULT_ACTIVE_WORKS,
+        keep_open: bool = False,
+        workers: int = DEFAULT_WORKERS,
+    ):
+        self.waiting = deque(works)
+        self.active: List[BatchWork] = []
+        self.site_limits = site_limits
+        self.max_active = max(1, max_active)
+        self.keep_open = keep_open
+        self.workers = max(1, workers)
+        self.stopped = False
+        # Requests in flight per site
+        self.running = Counter()
+        # Works waiting for a slot, once per waiting fetch thread, in the order they asked
+        self.requests: Deque[BatchWork] = deque()
+        self.condition = threading.Condition()
+
+    def site_limit(self, site: str) -> int:
+        return self.site_limits.get(site, DEFAULT_SITE_WORKERS)
+
+    def next_work(self) -> Optional[BatchWork]:
+        """Block until another work may start and return it; None once every work has started, or on stop."""
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                if self.waiting and sum(not work.paused for work in self.active) < self.max_active:
+                    work = self.waiting.popleft()
+                    work.state = "running"
+                    work.running = True
+                    self.active.append(work)
+                    return work
+                if not self.waiting and not self.keep_open:
+                    return None
+                self.condition.wait()
+
+    @contextmanager
+    def slot(self, work: BatchWork) -> Iterator[None]:
+        """Hold one of the batch's request slots while a page of ``work`` is fetched.
+
+        Raises DownloadError once the work is cancelled or the batch stopped.
+        """
+        with self.condition:
+            self.requests.append(work)
+            try:
+                while not self.stopped and work.state != "failed" and not self.is_next(work):
+                    self.condition.wait()
+            finally:
+                self.requests.remove(work)
+                self.condition.notify_all()
+            if self.stopped or work.state == "failed":
+                raise DownloadError(work.error or "the batch was stopped")
+            self.running[work.site] += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running[work.site] -= 1
+                self.condition.notify_all()
+
+    def is_next(self, work: BatchWork) -> bool:
+        """Whether the first request that may run now is one of ``work``'s."""
+        if sum(self.running.values()) >= self.workers:
+            return False
+        for request in self.requests:
+            if request.paused or self.running[request.site] >= self.site_limit(request.site):
+                continue
+            return request is work
+        return False
+
+    def work_done(self, work: BatchWork, error: Optional[str] = None) -> None:
+        """Record the end of a work's download; a cancelled work stays cancelled."""
+        with self.condition:
+            work.running = False
+            if work.state != "failed":
+                work.state = "failed" if error else "done"
+                work.error = error
+            self.active.remove(work)
+            self.condition.notify_all()
+
+    def add(self, work: BatchWork) -> None:
+        """Queue a work (new, or reset after it finished) behind the waiting ones."""
+        with self.condition:
+            self.waiting.append(work)
+            self.condition.notify_all()
+
+    def set_paused(self, work: BatchWork, paused: bool) -> None:
+        """Stop or resume handing out request slots to a work; requests already running finish."""
+        with self.condition:
+            work.paused = paused
+            self.condition.notify_all()
+
+    def cancel(self, work: BatchWork) -> None:
+        """Fail a work: drop it if it hasn't started, else stop its download (its journal is kept)."""
+        with self.condition:
+            if work.state in ("done", "failed"):
+                return
+            work.state = "failed"
+            work.error = "cancelled"
+            if work in self.waiting:
+                self.waiting.remove(work)
+            self.condition.notify_all()
+        run = work.engine.current_run if work.engine else None
+        if run:
+            run.cancel()
+
+    def stop(self) -> None:
+        """Stop starting works and handing out slots; running fetches end, the others fail."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class BatchDownloader:
+    """Download many Kakuyomu and Narou works, each through the download engine's pipeline.
+
+    Every work gets its own DownloadEngine run, so updates, journals, images,
+    volumes, output sinks and the catalog work as for a single download; the
+    scheduler decides when works start and hands out the request slots.
+    """
+
+    def __init__(
+        self,
+        client: HttpClient,
+        output_dir: Path = Path("epub"),
+        cache: Optional[EpisodeCache] = None,
+        update: bool = False,
+        parse_executor: Optional[Executor] = None,
+        log: Optional[Callable[[str], None]] = None,
+        resume: bool = False,
+        adapters: Optional[Dict[str, SiteAdapter]] = None,
+        images: Optional[ImageOptions] = None,
+        sink: Optional[SinkOptions] = None,
+        catalog: Optional[Catalog] = None,
+        volumes: Optional[VolumeOptions] = None,
+    ):
+        self.client = client
+        self.output_dir = Path(output_dir)
+        self.cache = cache
+        # Only a single EPUB is matched against an earlier download
+        self.update = update and not sink and not volumes
+        self.resume = resume
+        self.parse_executor = parse_executor
+        self.log = log or print
+        self.adapters = adapters or ADAPTERS
+        self.images = images if not sink else None
+        self.sink = sink
+        self.catalog = catalog
+        self.volumes = volumes if not sink else None
+
+    def run(
+        self,
+        works: List[BatchWork],
+        workers: int = DEFAULT_WORKERS,
+        site_limits: Optional[Dict[str, int]] = None,
+        max_active: int = DEFAULT_ACTIVE_WORKS,
+    ) -> List[BatchWork]:
+        """Download every work and return them with their outcome."""
+        # Sites with an API describe all their works in a few requests up front
+        for site, adapter in self.adapters.items():
+            adapter.prefetch(self.client, [work.work_id for work in works if work.site == site], self.log)
+        scheduler = BatchScheduler(works, site_limits or {}, max_active, workers=workers)
+        self.start(scheduler).join()
+        return works
+
+    def start(self, scheduler: BatchScheduler) -> threading.Thread:
+        """Start the thread starting each work as ``scheduler`` lets it; it ends once they all finished."""
+        thread = threading.Thread(target=self.dispatch, args=(scheduler,), daemon=True)
+        thread.start()
+        return thread
+
+    def dispatch(self, scheduler: BatchScheduler) -> None:
+        threads = []
+        while True:
+            work = scheduler.next_work()
+            if work is None:
+                break
+            thread = threading.Thread(target=self.download, args=(work, scheduler), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def download(self, work: BatchWork, scheduler: BatchScheduler) -> None:
+        """Download one work on its own pipeline, fetching its pages in the scheduler's slots."""
+        def log(message: str) -> None:
+            tag, separator, text = message.partition("] ")
+            self.log(f"{tag}] {work.name}: {text}" if separator and tag.startswith("[") else f"{work.name}: {message}")
+
+        def progress(done: int, total: int) -> None:
+            work.done, work.total = done, total
+            run = work.engine.current_run if work.engine else None
+            if run and run.title:
+                work.title = run.title
+
+        work.engine = DownloadEngine(
+            self.adapters[work.site], self.client, self.output_dir, scheduler.site_limit(work.site), self.cache, self.update,
+            parse_executor=self.parse_executor, resume=self.resume, log=log, progress=progress,
+            images=self.images, volumes=self.volumes, sink=self.sink, catalog=self.catalog,
+            fetch_slot=lambda: scheduler.slot(work),
+        )
+        error = None
+        try:
+            work.title, work.paths = work.engine.run(work.work_id, False, work.start, work.end, work.latest)
+        except Exception as exc:
+            error = str(exc) if isinstance(exc, DownloadError) else f"{type(exc).__name__}: {exc}"
+            if work.state != "failed":
+                self.log(f"[ERROR] {work.name}: {error}")
+        scheduler.work_done(work, error)
+        metrics.count("works_done" if work.state == "done" else "works_failed")
+
+
+def print_report(works: List[BatchWork], log: Callable[[str], None] = print) -> None:
+    """Print the outcome of every work of a batch."""
+    log("[INFO] Batch report:")
+    for work in works:
+        if work.state == "done":
+            log(f"  [OK] {work.name}: {', '.join(str(path) for path in work.paths)}")
+        else:
+            log(f"  [FAILED] {work.name}: {work.error or 'not finished'}")
+    failed = sum(work.state != "done" for work in works)
+    log(f"[INFO] {len(works) - failed} succeeded, {failed} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download many Kakuyomu and Narou works listed in a file')
+    parser.add_argument('list', nargs='?', default='-', help='File with one work ID or URL per line (- for stdin)')
+    parser.add_argument('--output-dir', type=Path, default=Path('epub'), help='Directory the EPUB files are written to')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Requests running at once across all sites')
+    parser.add_argument('--site-workers', type=parse_site_limit, action='append', default=[], metavar='SITE=N', help=f'Requests running at once against one site (default {DEFAULT_SITE_WORKERS})')
+    parser.add_argument('--active-works', type=int, default=DEFAULT_ACTIVE_WORKS, help='Works downloaded at the same time')
+    parser.add_argument('--processes', type=int, default=0, help='Parse episode pages in this many worker processes (0 parses in-process)')
+    parser.add_argument('--parser', choices=['auto', *BACKENDS], default='auto', help='HTML parser backend (auto picks lxml when installed)')
+    parser.add_argument('--resume', action='store_true', help='Continue interrupted downloads from their journals')
+    parser.add_argument('--update', action='store_true', help='Only fetch new or changed episodes of existing EPUBs')
+    parser.add_argument('--volume-episodes', type=int, help='Split each work into volumes of at most this many episodes')
+    parser.add_argument('--volume-size', type=float, help='Split each work into volumes of at most this many megabytes')
+    parser.add_argument('--volume-by-arc', action='store_true', help="Start a new volume at every arc (chapter) of a work's table of contents")
+    parser.add_argument('--bundle-size', type=int, help='Bundle consecutive episodes of an arc into files of up to this many kilobytes')
+    parser.add_argument('--arc-toc', action='store_true', help='Nest the table of contents by arc')
+    parser.add_argument('--format', choices=FORMATS, default='epub', help='Write EPUBs, or one JSONL, text or HTML file per work')
+    parser.add_argument('--zstd', action='store_true', help='Compress JSONL output with zstd (requires zstandard)')
+    parser.add_argument('--strip-ruby', action='store_true', help='Drop ruby readings from text and JSONL output instead of writing them as |base《reading》')
+    parser.add_argument('--images', action='store_true', help='Download the illustrations of the chapters and embed them in the EPUBs')
+    parser.add_argument('--image-max-size', type=int, help='Scale embedded images down to this many pixels on the longest edge (requires Pillow)')
+    parser.add_argument('--image-quality', type=int, help=f'Recompress embedded images as JPEG of this quality (requires Pillow, default {DEFAULT_IMAGE_QUALITY} when scaling)')
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR, help='Directory of the episode cache')
+    parser.add_argument('--no-cache', action='store_true', help='Download and parse every episode again')
+    parser.add_argument('--no-catalog', action='store_true', help=f'Don\'t record the downloads in {CATALOG_NAME} in the output directory')
+    parser.add_argument('--narou-api', action='store_true', help='Look up Narou titles, authors, episode counts and updates in the Syosetu novel API')
+    parser.add_argument('--narou-api-url', default=NAROU_API_URL, help='Base URL of the novel API (for a mirror or local stand-in)')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='Retries of a request after network errors, 429 or 5xx responses')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='HOST=RATE', help='Requests per second allowed for a host (0 disables the limit)')
+    parser.add_argument('--metrics', type=Path, help='Write the time spent in each download stage to this JSON file')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port at /metrics while running')
+    parser.add_argument('--profile', type=Path, help='Profile the batch with cProfile and write the stats to this file')
+    args = parser.parse_args()
+    set_backend(args.parser)
+
+    with open('userAgents.json', 'r') as f:
+        user_agents = json.load(f)
+
+    if args.list == '-':
+        works = read_work_list(sys.stdin)
+    else:
+        with open(args.list, 'r', encoding='utf-8') as f:
+            works = read_work_list(f)
+    print(f"[INFO] {len(works)} works to download")
+
+    site_limits = {site: workers for limit in args.site_workers for site, workers in limit.items()}
+    rate_limits = {host: rate for limit in args.rate_limit for host, rate in limit.items()}
+    if args.metrics_port is not None:
+        serve_prometheus(args.metrics_port)
+        print(f"[INFO] Serving metrics on http://localhost:{args.metrics_port}/metrics")
+    parse_executor = create_parse_pool(args.processes) if args.processes > 0 else None
+    cache = None if args.no_cache else EpisodeCache(args.cache_dir)
+    catalog = None if args.no_catalog else Catalog(args.output_dir / CATALOG_NAME)
+    metrics.reset()
+    with profiled(args.profile):
+        try:
+            with HttpClient(user_agents, pool_size=args.workers, rate_limits=rate_limits, max_retries=args.max_retries) as client:
+                adapters = dict(ADAPTERS, narou=narou_downloader.NarouAdapter(args.narou_api_url)) if args.narou_api else None
+                images = ImageOptions(args.image_max_size, args.image_quality) if args.images else None
+                sink = SinkOptions(args.format, args.zstd, args.strip_ruby) if args.format != 'epub' else None
+                volumes = VolumeOptions(
+                    args.volume_episodes,
+                    int(args.volume_size * 1024 * 1024) if args.volume_size else None,
+                    args.volume_by_arc,
+                    args.bundle_size * 1024 if args.bundle_size else None,
+                    args.arc_toc,
+                )
+                downloader = BatchDownloader(
+                    client, args.output_dir, cache, args.update, parse_executor, resume=args.resume, adapters=adapters,
+                    images=images, sink=sink, catalog=catalog, volumes=volumes if volumes.enabled else None,
+                )
+                downloader.run(works, args.workers, site_limits, args.active_works)
+        finally:
+            if cache:
+                cache.close()
+            if catalog:
+                catalog.close()
+            if parse_executor:
+                parse_executor.shutdown()
+
+    print_report(works)
+    print(f"[INFO] {metrics.describe()}")
+    if args.metrics:
+        metrics.write_json(args.metrics)
+    sys.exit(0 if all(work.state == "done" for work in works) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import product
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from page_parser import BACKENDS
+
+ENGINES = ("kakuyomu", "kakuyomu-sequential", "kakuyomu-async", "narou", "narou-sequential", "narou-async", "narou-api")
+DEFAULT_ENGINES = ["kakuyomu", "kakuyomu-async", "narou", "narou-async"]
+KAKUYOMU_WORK_ID = "1000000000000000001"
+NAROU_WORK_ID = "n0001bm"
+EPISODES_PER_CHAPTER = 100
+NAROU_INDEX_PAGE_SIZE = 100
+NAROU_API_PATH = "/novelapi/api/"
+
+EPISODE_URL = re.compile(r'/episodes/\d+$|/n\w+/\d+/$')
+FILLER = "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。"
+
+
+def filler_paragraphs(episode_num: int, size: int) -> str:
+    """Return about ``size`` bytes of paragraphs of Japanese text for an episode."""
+    paragraphs = []
+    written = 0
+    line = 1
+    while written < size:
+        paragraph = f'<p id="L{line}">{episode_num}-{line} {FILLER}<ruby>漢字<rt>かんじ</rt></ruby></p>'
+        paragraphs.append(paragraph)
+        written += len(paragraph.encode("utf-8"))
+        line += 1
+    return "".join(paragraphs)
+
+
+class FakeSite:
+    """Synthetic Kakuyomu and Narou pages with the markup the downloaders select on.
+
+    Every work has ``episodes`` episodes whose body is about ``page_size``
+    bytes. Each response is delayed by ``latency`` seconds, and a fraction
+    ``error_rate`` of them fail with 429 or 503 (with ``Retry-After: 0``).
+    """
+
+    def __init__(self, episodes: int, page_size: int, latency: float, error_rate: float, seed: Optional[int] = None):
+        self.episodes = episodes
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def inject_error(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def page(self, path: str) -> Optional[str]:
+        """Return the page served at ``path``, or None for a 404."""
+        if path.startswith(NAROU_API_PATH):
+            return self.narou_api(parse_qs(urlsplit(path).query))
+        match = re.fullmatch(r'/works/(\d+)/episodes/(\d+)', path)
+        if match and 1 <= int(match.group(2)) <= self.episodes:
+            return self.kakuyomu_episode(match.group(1), int(match.group(2)))
+        match = re.fullmatch(r'/works/(\d+)', path)
+        if match:
+            return self.kakuyomu_work(match.group(1))
+        match = re.fullmatch(r'/(n\d+[a-z]+)/(\d+)/', path)
+        if match and 1 <= int(match.group(2)) <= self.episodes:
+            return self.narou_episode(match.group(1), int(match.group(2)))
+        match = re.fullmatch(r'/(n\d+[a-z]+)/(?:\?p=(\d+))?', path)
+        if match:
+            return self.narou_index(match.group(1), int(match.group(2) or 1))
+        return None
+
+    def narou_api(self, query: Dict[str, List[str]]) -> str:
+        """Answer a Syosetu novel API query for the ncodes asked for."""
+        ncodes = [ncode for ncode in query.get("ncode", [""])[0].split("-") if ncode]
+        entries: List[Dict[str, Any]] = [{"allcount": len(ncodes)}]
+        for ncode in ncodes:
+            entries.append({
+                "title": f"ベンチマーク{ncode}",
+                "ncode": ncode.upper(),
+                "writer": "ベンチマーク作者",
+                "general_all_no": self.episodes,
+                "general_lastup": "2024-01-01 12:00:00",
+                "novelupdated_at": "2024-01-01 12:00:00",
+            })
+        return json.dumps(entries, ensure_ascii=False)
+
+    def kakuyomu_work(self, book_id: str) -> str:
+        state: Dict[str, Any] = {}
+        chapters = []
+        for start in range(1, self.episodes + 1, EPISODES_PER_CHAPTER):
+            number = len(chapters) + 1
+            end = min(self.episodes, start + EPISODES_PER_CHAPTER - 1)
+            chapters.append({"__ref": f"TableOfContentsChapter:{number}"})
+            state[f"TableOfContentsChapter:{number}"] = {
+                "chapter": {"__ref": f"Chapter:{number}"},
+                "episodeUnions": [{"__ref": f"Episode:{i}"} for i in range(start, end + 1)],
+            }
+            state[f"Chapter:{number}"] = {"title": f"第{number}章"}
+        for i in range(1, self.episodes + 1):
+            state[f"Episode:{i}"] = {"id": str(i), "title": f"第{i}話", "publishedAt": "2024-01-01T00:00:00Z"}
+        state[f"Work:{book_id}"] = {"title": f"ベンチマーク{book_id}", "tableOfContents": chapters}
+        next_data = json.dumps({"props": {"pageProps": {"__APOLLO_STATE__": state}}}, ensure_ascii=False)
+        return (
+            '<html><body><div id="app"><div class="DefaultTemplate_fixed__DLjCr DefaultTemplate_isWeb__QRPlB '
+            'DefaultTemplate_fixedGlobalFooter___dZog"><div><div><main>'
+            '<div class="NewBox_box__45ont NewBox_padding-px-4l__Kx_xT NewBox_padding-pt-7l__Czm59"><div>'
+            '<div class="Gap_size-2l__HWqrr Gap_direction-y__Ee6Qv">'
+            f'<div class="Gap_size-3s__fjxCP Gap_direction-y__Ee6Qv"><h1><span><a href="/works/{book_id}">ベンチマーク{book_id}</a></span></h1></div>'
+            f'<div class="Gap_size-m__thYv4 Gap_direction-y__Ee6Qv"><div><a href="/works/{book_id}/episodes/1">1話目から読む</a></div></div>'
+            '</div></div></div></main></div></div></div></div>'
+            f'<script id="__NEXT_DATA__" type="application/json">{next_data}</script></body></html>'
+        )
+
+    def kakuyomu_episode(self, book_id: str, episode_num: int) -> str:
+        next_link = ""
+        if episode_num < self.episodes:
+            next_link = f'<a id="contentMain-readNextEpisode" href="/works/{book_id}/episodes/{episode_num + 1}">次のエピソードへ</a>'
+        return (
+            '<html><body><div id="contentMain">'
+            f'<p class="widget-episodeTitle js-vertical-composition-item">第{episode_num}話</p>'
+            f'<div class="widget-episodeBody js-episode-body">{filler_paragraphs(episode_num, self.page_size)}</div>'
+            f'{next_link}</div></body></html>'
+        )
+
+    def narou_episode(self, novel_id: str, episode_num: int) -> str:
+        links = ""
+        if episode_num > 1:
+            links += f'<a href="/{novel_id}/{episode_num - 1}/" class="c-pager__item c-pager__item--before">前へ</a>'
+        links += f'<a href="/{novel_id}/" class="c-pager__item">目次</a>'
+        if episode_num < self.episodes:
+            links += f'<a href="/{novel_id}/{episode_num + 1}/" class="c-pager__item c-pager__item--next">次へ</a>'
+        return (
+            f'<html><head><title>ベンチマーク{novel_id} - 第{episode_num}話</title></head><body>'
+            f'<div class="l-container"><main><article><div class="c-pager">{links}</div>'
+            f'<h1 class="p-novel__title">第{episode_num}話</h1>'
+            f'<div class="p-novel__body"><div class="js-novel-text p-novel__text">{filler_paragraphs(episode_num, self.page_size)}</div></div>'
+            f'<div class="c-pager">{links}</div></article></main></div></body></html>'
+        )
+
+    def narou_index(self, novel_id: str, page: int) -> str:
+        start = (page - 1) * NAROU_INDEX_PAGE_SIZE + 1
+        end = min(self.episodes, page * NAROU_INDEX_PAGE_SIZE)
+        last_page = max(1, -(-self.episodes // NAROU_INDEX_PAGE_SIZE))
+        items = "".join(
+            f'<div class="p-eplist__sublist"><a href="/{novel_id}/{i}/" class="p-eplist__subtitle">第{i}話</a>'
+            '<div class="p-eplist__update">2024/01/01 12:00</div></div>'
+            for i in range(start, end + 1)
+        )
+        pager = ""
+        if last_page > 1:
+            pager = f'<a href="/{novel_id}/?p={last_page}" class="c-pager__item c-pager__item--last">最後へ</a>'
+        return (
+            f'<html><head><title>ベンチマーク{novel_id}</title></head><body>'
+            f'<h1 class="p-novel__title">ベンチマーク{novel_id}</h1>'
+            f'<div class="p-eplist">{items}</div>{pager}</body></html>'
+        )
+
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real sites; headers and body go out in separate writes
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        site: FakeSite = self.server.site
+        if site.latency:
+            time.sleep(site.latency)
+        if site.inject_error():
+            self.send_response(site.random.choice((429, 503)))
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        page = site.page(self.path)
+        if page is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = page.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSiteServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, site: FakeSite, port: int = 0):
+        super().__init__(("127.0.0.1", port), FakeSiteHandler)
+        self.site = site
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self) -> "FakeSiteServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def percentile(values: Sequence[float], fraction: float) -> Optional[float]:
+    """Return the nearest-rank percentile of ``values``, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Return the peak resident set size of this process in MB, or None where unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_engine(config: Dict[str, Any], base_url: str) -> Dict[str, Any]:
+    """Download the benchmark work once with one engine and configuration, in this process."""
+    import http_client
+    import kakuyomu
+    import narou_downloader
+    from download_metrics import metrics
+    from page_parser import create_parse_pool, set_backend
+
+    kakuyomu.KAKUYOMU_ROOT = base_url
+    narou_downloader.NAROU_ROOT = base_url
+    set_backend(config["parser"])
+
+    latencies: List[float] = []
+    write_times: List[float] = []
+
+    def timed_get(get):
+        def wrapper(self, url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return get(self, url, *args, **kwargs)
+            finally:
+                if EPISODE_URL.search(url):
+                    latencies.append(time.perf_counter() - start)
+        return wrapper
+
+    def timed_get_text(get_text):
+        async def wrapper(self, url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await get_text(self, url, *args, **kwargs)
+            finally:
+                if EPISODE_URL.search(url):
+                    latencies.append(time.perf_counter() - start)
+        return wrapper
+
+    def timed_save(save_book):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return save_book(*args, **kwargs)
+            finally:
+                write_times.append(time.perf_counter() - start)
+        return wrapper
+
+    http_client.HttpClient.get = timed_get(http_client.HttpClient.get)
+    http_client.AsyncHttpClient.get_text = timed_get_text(http_client.AsyncHttpClient.get_text)
+    kakuyomu.save_book = timed_save(kakuyomu.save_book)
+    narou_downloader.save_book = timed_save(narou_downloader.save_book)
+
+    with open(Path(__file__).with_name("userAgents.json"), "r") as f:
+        user_agents = json.load(f)
+
+    site, _, mode = config["engine"].partition("-")
+    workers = config["workers"]
+    output = io.StringIO()
+    parse_executor = create_parse_pool(config["processes"]) if config["processes"] > 0 else None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            if site == "kakuyomu":
+                app = kakuyomu.KakuyomuApp(KAKUYOMU_WORK_ID)
+                if mode == "async":
+                    ok = asyncio.run(app.download_async(user_agents, concurrency=workers, parse_executor=parse_executor))
+                else:
+                    ok = app.download(user_agents, workers=workers, sequential=mode == "sequential", stream=config["stream"], parse_executor=parse_executor)
+            else:
+                downloader = narou_downloader.NarouDownloader(NAROU_WORK_ID, log=print, output_dir=Path("epub"))
+                if mode == "async":
+                    ok = asyncio.run(downloader.download_async(user_agents, concurrency=workers, parse_executor=parse_executor))
+                else:
+                    api_url = f"{base_url}{NAROU_API_PATH}" if mode == "api" else None
+                    ok = downloader.download(user_agents, workers=workers, sequential=mode == "sequential", stream=config["stream"], parse_executor=parse_executor, api_url=api_url)
+    finally:
+        if parse_executor:
+            parse_executor.shutdown()
+    elapsed = time.perf_counter() - start
+
+    errors = [line for line in output.getvalue().splitlines() if line.startswith("[ERROR]")]
+    return {
+        "ok": bool(ok),
+        "error": errors[-1] if errors else None,
+        "seconds": elapsed,
+        "episode_requests": len(latencies),
+        "p50_ms": None if not latencies else percentile(latencies, 0.50) * 1000,
+        "p99_ms": None if not latencies else percentile(latencies, 0.99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+        "epub_write_ms": sum(write_times) * 1000,
+        "metrics": metrics.summary(),
+    }
+
+
+def run_config(config: Dict[str, Any], base_url: str, episodes: int) -> Dict[str, Any]:
+    """Run one configuration in a fresh interpreter so its peak RSS is its own."""
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as work_dir:
+        completed = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--run", json.dumps(config), "--url", base_url],
+            cwd=work_dir,
+            capture_output=True,
+            text=True,
+            encoding="utf-8",
+        )
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        return {"ok": False, "error": lines[-1] if lines else f"exit status {completed.returncode}"}
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["episodes_per_second"] = episodes / result["seconds"]
+    return result
+
+
+def summarize(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine repeated runs of a configuration into the median of every metric."""
+    summary = dict(runs[0])
+    summary["ok"] = all(run.get("ok") for run in runs)
+    summary["error"] = next((run.get("error") for run in runs if run.get("error")), None)
+    for key, value in runs[0].items():
+        if isinstance(value, float):
+            values = [run[key] for run in runs if run.get(key) is not None]
+            summary[key] = percentile(values, 0.5)
+    return summary
+
+
+def format_metric(value: Optional[float], digits: int = 1) -> str:
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    print()
+    print(f"{'engine':<20} {'workers':>7} {'procs':>5} {'parser':<11} {'stream':<6} "
+          f"{'eps/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>7} {'write ms':>9}")
+    for result in results:
+        config = result["config"]
+        line = (
+            f"{config['engine']:<20} {config['workers']:>7} {config['processes']:>5} {config['parser']:<11} "
+            f"{'yes' if config['stream'] else 'no':<6} "
+        )
+        if not result["ok"]:
+            print(f"{line}FAILED: {result.get('error')}")
+            continue
+        print(
+            f"{line}{format_metric(result['episodes_per_second']):>8} {format_metric(result['p50_ms']):>8} "
+            f"{format_metric(result['p99_ms']):>8} {format_metric(result['peak_rss_mb']):>7} "
+            f"{format_metric(result['epub_write_ms']):>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the downloaders against a local stand-in for Kakuyomu and Narou')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=DEFAULT_ENGINES, help='Downloaders to benchmark')
+    parser.add_argument('--workers', nargs='+', type=int, default=[8], help='Worker threads (connections for async engines) to try')
+    parser.add_argument('--processes', nargs='+', type=int, default=[0], help='Parse process counts to try (0 parses in-process)')
+    parser.add_argument('--parser', nargs='+', choices=['auto', *BACKENDS], default=['auto'], help='HTML parser backends to try')
+    parser.add_argument('--stream', choices=['off', 'on', 'both'], default='off', help='Write EPUBs with --stream (ignored by async engines)')
+    parser.add_argument('--episodes', type=int, default=200, help='Episodes of the benchmark work')
+    parser.add_argument('--page-size', type=int, default=8000, help='Bytes of text in every episode body')
+    parser.add_argument('--latency', type=float, default=20, help='Milliseconds the server waits before every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of responses failing with 429 or 503')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of every configuration; the median is reported')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the error injection')
+    parser.add_argument('--json', type=Path, help='Also write the results to this JSON file')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_engine(json.loads(args.run), args.url)))
+        return
+
+    streams = {"off": [False], "on": [True], "both": [False, True]}[args.stream]
+    configs = []
+    for engine, workers, processes, backend, stream in product(args.engines, args.workers, args.processes, args.parser, streams):
+        if stream and engine.endswith("-async"):
+            continue
+        configs.append({"engine": engine, "workers": workers, "processes": processes, "parser": backend, "stream": stream})
+
+    site = FakeSite(args.episodes, args.page_size, args.latency / 1000, args.error_rate, args.seed)
+    print(f"[INFO] {len(configs)} configurations, {args.episodes} episodes of {args.page_size} bytes, "
+          f"{args.latency:g} ms latency, {args.error_rate:.0%} errors")
+    results = []
+    with FakeSiteServer(site) as server:
+        for config in configs:
+            print(f"[INFO] {config['engine']} workers={config['workers']} processes={config['processes']} "
+                  f"parser={config['parser']} stream={config['stream']}")
+            runs = [run_config(config, server.url, args.episodes) for _ in range(max(1, args.repeat))]
+            result = summarize(runs)
+            result["config"] = config
+            results.append(result)
+        print(f"[INFO] Server answered {site.requests} requests, {site.errors} with injected errors")
+
+    print_report(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"[INFO] Results written to {args.json}")
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import requests
+
+from http_client import DEFAULT_MAX_RETRIES, HttpClient
+from narou_api import NAROU_API_URL, fetch_novel_info
+from output_sinks import Episode, html_to_text
+
+# File name of the catalog in an output directory
+CATALOG_NAME = "catalog.sqlite3"
+DEFAULT_CATALOG = Path("epub") / CATALOG_NAME
+DEFAULT_SEARCH_LIMIT = 20
+# Trigram tokens let FTS5 find words in Japanese text, which has no spaces between them
+FTS_TOKENIZERS = ("trigram", "unicode61")
+TRIGRAM = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS works (
+    site TEXT NOT NULL,
+    work_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    stamp TEXT,
+    files TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (site, work_id)
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    id INTEGER PRIMARY KEY,
+    site TEXT NOT NULL,
+    work_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    url TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    UNIQUE (site, work_id, number)
+);
+"""
+
+
+class CatalogEntry:
+    """What the catalog keeps of a downloaded episode: its text for searching and the hash of its HTML."""
+
+    __slots__ = ("number", "title", "url", "hash", "text")
+
+    def __init__(self, number: int, title: str, url: str, hash: str, text: str):
+        self.number = number
+        self.title = title
+        self.url = url
+        self.hash = hash
+        self.text = text
+
+    @classmethod
+    def from_episode(cls, episode: Episode) -> "CatalogEntry":
+        return cls(episode.index, episode.title, episode.url, episode.hash, html_to_text(episode.body, strip_ruby=True))
+
+
+class CatalogWork:
+    """A work of the catalog, with the number of its episodes held."""
+
+    __slots__ = ("site", "work_id", "title", "stamp", "files", "updated_at", "episodes", "last_episode")
+
+    def __init__(self, site: str, work_id: str, title: str, stamp: Optional[str], files: str, updated_at: float, episodes: int, last_episode: int):
+        self.site = site
+        self.work_id = work_id
+        self.title = title
+        self.stamp = stamp
+        self.files: List[str] = json.loads(files)
+        self.updated_at = updated_at
+        self.episodes = episodes
+        self.last_episode = last_episode
+
+    @property
+    def name(self) -> str:
+        return f"{self.site}:{self.work_id}"
+
+
+class SearchHit:
+    __slots__ = ("site", "work_id", "work_title", "number", "title", "snippet")
+
+    def __init__(self, site: str, work_id: str, work_title: str, number: int, title: str, snippet: str):
+        self.site = site
+        self.work_id = work_id
+        self.work_title = work_title
+        self.number = number
+        self.title = title
+        self.snippet = snippet
+
+
+class Catalog:
+    """SQLite record of the works and episodes downloaded into an output directory.
+
+    Every download records the work's title, update time and files, and
+    each episode's number, URL, SHA-256 of its HTML and when it was fetched.
+    Episode text goes into an FTS5 index, so works are listed and searched
+    with indexed queries instead of opening the EPUBs. The connection is
+    shared by all worker threads.
+    """
+
+    def __init__(self, path: Path = DEFAULT_CATALOG):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.tokenizer = self.create_index()
+
+    def create_index(self) -> str:
+        """Create the full-text index with the best tokenizer this SQLite has and return its name."""
+        row = self.db.execute("SELECT sql FROM sqlite_master WHERE name = 'episode_text'").fetchone()
+        if row:
+            return next((tokenizer for tokenizer in FTS_TOKENIZERS if tokenizer in row[0]), FTS_TOKENIZERS[-1])
+        for tokenizer in FTS_TOKENIZERS:
+            try:
+                self.db.execute(f"CREATE VIRTUAL TABLE episode_text USING fts5(title, text, tokenize='{tokenizer}')")
+                return tokenizer
+            except sqlite3.OperationalError:
+                continue
+        raise sqlite3.OperationalError("SQLite was built without FTS5")
+
+    def record(
+        self,
+        site: str,
+        work_id: str,
+        title: str,
+        stamp: Optional[str],
+        files: Sequence[Path],
+        entries: Iterable[CatalogEntry],
+        total: Optional[int] = None,
+    ) -> None:
+        """Record a finished download of a work and the episodes it fetched.
+
+        Episodes reused from an earlier EPUB keep their rows. With ``total``
+        (the number of episodes of the whole work) rows of episodes past it
+        are dropped.
+        """
+        self.record_episodes(site, work_id, entries)
+        self.record_work(site, work_id, title, stamp, files, total)
+
+    def record_episodes(self, site: str, work_id: str, entries: Iterable[CatalogEntry]) -> None:
+        """Record fetched episodes of a work, in one transaction.
+
+        Downloads call this as episodes arrive, so their text isn't held
+        until the work is finished; search only shows them once the work is
+        recorded with ``record_work``.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            for entry in entries:
+                row = self.db.execute(
+                    "SELECT id, hash FROM episodes WHERE site = ? AND work_id = ? AND number = ?", (site, work_id, entry.number),
+                ).fetchone()
+                if row and row[1] == entry.hash:
+                    self.db.execute("UPDATE episodes SET title = ?, url = ?, fetched_at = ? WHERE id = ?", (entry.title, entry.url, now, row[0]))
+                    continue
+                if row:
+                    self.db.execute("DELETE FROM episode_text WHERE rowid = ?", (row[0],))
+                    self.db.execute("DELETE FROM episodes WHERE id = ?", (row[0],))
+                episode_id = self.db.execute(
+                    "INSERT INTO episodes (site, work_id, number, title, url, hash, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (site, work_id, entry.number, entry.title, entry.url, entry.hash, now),
+                ).lastrowid
+                self.db.execute("INSERT INTO episode_text (rowid, title, text) VALUES (?, ?, ?)", (episode_id, entry.title, entry.text))
+
+    def record_work(self, site: str, work_id: str, title: str, stamp: Optional[str], files: Sequence[Path], total: Optional[int] = None) -> None:
+        """Record the title, update time and files of a finished download; see ``record``."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?, ?, ?)",
+                (site, work_id, title, stamp, json.dumps([str(path) for path in files], ensure_ascii=False), time.time()),
+            )
+            if total is not None:
+                self.db.execute(
+                    "DELETE FROM episode_text WHERE rowid IN (SELECT id FROM episodes WHERE site = ? AND work_id = ? AND number > ?)",
+                    (site, work_id, total),
+                )
+                self.db.execute("DELETE FROM episodes WHERE site = ? AND work_id = ? AND number > ?", (site, work_id, total))
+
+    def works(self, refs: Optional[Sequence[Tuple[str, str]]] = None) -> List[CatalogWork]:
+        """Return the works of the catalog (or those of ``refs`` it holds), by title."""
+        query = """
+            SELECT w.site, w.work_id, w.title, w.stamp, w.files, w.updated_at, COUNT(e.id), COALESCE(MAX(e.number), 0)
+            FROM works w LEFT JOIN episodes e ON e.site = w.site AND e.work_id = w.work_id
+            {where} GROUP BY w.site, w.work_id ORDER BY w.title
+        """
+        with self.lock:
+            if refs is None:
+                return [CatalogWork(*row) for row in self.db.execute(query.format(where=""))]
+            works = []
+            for site, work_id in refs:
+                row = self.db.execute(query.format(where="WHERE w.site = ? AND w.work_id = ?"), (site, work_id)).fetchone()
+                if row:
+                    works.append(CatalogWork(*row))
+            return works
+
+    def episode_numbers(self, site: str, work_id: str) -> List[int]:
+        with self.lock:
+            rows = self.db.execute("SELECT number FROM episodes WHERE site = ? AND work_id = ? ORDER BY number", (site, work_id))
+            return [number for number, in rows]
+
+    def search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[SearchHit]:
+        """Return the episodes whose title or text contains ``query``, best matches first.
+
+        Queries shorter than a trigram can't use the index and scan the text.
+        """
+        select = """
+            SELECT e.site, e.work_id, w.title, e.number, e.title, {snippet}
+            FROM episode_text t JOIN episodes e ON e.id = t.rowid JOIN works w ON w.site = e.site AND w.work_id = e.work_id
+        """
+        with self.lock:
+            if self.tokenizer == "trigram" and len(query) < TRIGRAM:
+                pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                rows = self.db.execute(
+                    select.format(snippet="substr(t.text, max(1, instr(t.text, ?) - 20), 60)")
+                    + " WHERE t.text LIKE ? ESCAPE '\\' OR t.title LIKE ? ESCAPE '\\' ORDER BY w.title, e.number LIMIT ?",
+                    (query, pattern, pattern, limit),
+                )
+            else:
+                phrase = '"' + query.replace('"', '""') + '"'
+                rows = self.db.execute(
+                    select.format(snippet="snippet(episode_text, 1, '[', ']', '…', 16)")
+                    + " WHERE episode_text MATCH ? ORDER BY rank LIMIT ?",
+                    (phrase, limit),
+                )
+            return [SearchHit(*row) for row in rows]
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def remote_episode_counts(
+    client: HttpClient,
+    works: List[CatalogWork],
+    narou_api_url: Optional[str] = None,
+    log: Callable[[str], None] = print,
+) -> Dict[Tuple[str, str], Optional[int]]:
+    """Return how many episodes the sites list for the works, None where that can't be told.
+
+    With ``narou_api_url``, Narou counts come from the novel API in a few
+    requests; other works are counted from their listing.
+    """
+    # The downloaders record into the catalog, so their adapters are imported when needed
+    from batch import ADAPTERS
+
+    counts: Dict[Tuple[str, str], Optional[int]] = {}
+    if narou_api_url:
+        ncodes = [work.work_id for work in works if work.site == "narou"]
+        if ncodes:
+            try:
+                for ncode, info in fetch_novel_info(client, ncodes, narou_api_url).items():
+                    if info is not None:
+                        counts[("narou", ncode)] = info.episodes
+            except (requests.exceptions.RequestException, ValueError) as exc:
+                log(f"[WARN] Could not query the novel API: {exc}")
+    for work in works:
+        key = (work.site, work.work_id)
+        if key in counts:
+            continue
+        try:
+            _, listing = ADAPTERS[work.site].list_episodes(client, work.work_id, log)
+            counts[key] = len(list(listing)) or None
+        except requests.exceptions.RequestException as exc:
+            log(f"[WARN] {work.name}: could not list the episodes: {exc}")
+            counts[key] = None
+    return counts
+
+
+def describe_time(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+def describe_numbers(numbers: List[int]) -> str:
+    """Return episode numbers with runs collapsed, such as ``3, 7-12``."""
+    runs: List[List[int]] = []
+    for number in numbers:
+        if runs and runs[-1][1] == number - 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return ", ".join(str(first) if first == last else f"{first}-{last}" for first, last in runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List, search and check the works downloaded into an output directory')
+    parser.add_argument('mode', choices=['list', 'search', 'diff'], help='List the works held, search their text, or compare them with the sites')
+    parser.add_argument('args', nargs='*', help='Words to search for, or work IDs or URLs to list or compare (all by default)')
+    parser.add_argument('--catalog', type=Path, default=DEFAULT_CATALOG, help='Catalog database (kept next to the downloaded files)')
+    parser.add_argument('--limit', type=int, default=DEFAULT_SEARCH_LIMIT, help='Most search results shown')
+    parser.add_argument('--narou-api', action='store_true', help='Count Narou episodes with the Syosetu novel API')
+    parser.add_argument('--narou-api-url', default=NAROU_API_URL, help='Base URL of the novel API (for a mirror or local stand-in)')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='Retries of a request after network errors, 429 or 5xx responses')
+    args = parser.parse_args()
+    from batch import parse_work_ref
+
+    if not args.catalog.exists():
+        print(f"[ERROR] No catalog at {args.catalog}; it is written by the downloads")
+        sys.exit(1)
+
+    with Catalog(args.catalog) as catalog:
+        if args.mode == 'search':
+            if not args.args:
+                parser.error('search needs the words to look for')
+            hits = catalog.search(" ".join(args.args), args.limit)
+            for hit in hits:
+                print(f"{hit.site}:{hit.work_id} {hit.work_title} #{hit.number} {hit.title}")
+                print(f"  {' '.join(hit.snippet.split())}")
+            print(f"[INFO] {len(hits)} episodes found")
+            return
+
+        refs = None
+        if args.args:
+            refs = []
+            for work in args.args:
+                ref = parse_work_ref(work)
+                if ref is None:
+                    print(f"[ERROR] Not a Kakuyomu or Narou work: {work}")
+                    sys.exit(1)
+                refs.append(ref)
+        works = catalog.works(refs)
+
+        if args.mode == 'list':
+            for work in works:
+                print(f"{work.name}: {work.title}")
+                print(f"  {work.episodes} episodes, downloaded {describe_time(work.updated_at)}, {', '.join(work.files)}")
+            print(f"[INFO] {len(works)} works")
+            return
+
+        with open('userAgents.json', 'r') as f:
+            user_agents = json.load(f)
+        with HttpClient(user_agents, max_retries=args.max_retries) as client:
+            counts = remote_episode_counts(client, works, args.narou_api_url if args.narou_api else None)
+        outdated = 0
+        for work in works:
+            remote = counts.get((work.site, work.work_id))
+            held = catalog.episode_numbers(work.site, work.work_id)
+            missing = sorted(set(range(1, (remote or work.last_episode) + 1)) - set(held))
+            if remote is None:
+                print(f"[WARN] {work.name} {work.title}: {len(held)} episodes held, the site's count is unknown")
+            elif missing:
+                outdated += 1
+                print(f"[INFO] {work.name} {work.title}: {len(held)} of {remote} episodes held, missing {describe_numbers(missing)}")
+            else:
+                print(f"[INFO] {work.name} {work.title}: all {remote} episodes held")
+        print(f"[INFO] {outdated} of {len(works)} works are missing episodes")
+        sys.exit(1 if outdated else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,733 @@
+import os
+import queue
+import sqlite3
+import threading
+from collections.abc import Sized
+from contextlib import nullcontext
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, Generator, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from ebooklib import epub
+
+from catalog import Catalog, CatalogEntry
+from download_journal import DownloadJournal, journal_path
+from episode_cache import EpisodeCache, fetch_page, store_page
+from epub_images import ImageOptions, ImageStore, find_image_urls
+from epub_stream import StreamingEpubBook
+from epub_volumes import VolumeOptions, VolumeWriter
+from epub_update import ExistingChapter, find_reusable, is_up_to_date, read_existing_chapters, read_work_stamp, reuse_chapter, write_work_stamp
+from http_client import HttpClient
+from output_sinks import Episode, EpisodeSink, SinkOptions, open_sink
+from page_parser import parse_in
+
+DEFAULT_WORKERS = 8
+# Items a queue between two stages holds for each thread of the stage after it
+QUEUE_DEPTH = 4
+# Seconds a stage waits on an empty queue before checking whether the download ended
+POLL_INTERVAL = 0.1
+# Fetched episodes written to the catalog together, in one transaction
+CATALOG_BATCH = 50
+
+
+class DownloadError(Exception):
+    """A download that can't go on, such as a work page without a title."""
+
+
+def episode_range(count: int, start: Optional[int] = None, end: Optional[int] = None, latest: Optional[int] = None) -> Tuple[int, int]:
+    """Return the first and last of ``count`` episodes to download.
+
+    ``start`` and ``end`` are counted from 1 and both included; ``latest``
+    selects the last episodes instead.
+    """
+    if latest:
+        return max(1, count - latest + 1), count
+    return max(1, start or 1), min(count, end) if end else count
+
+
+def check_episode_range(start: Optional[int] = None, end: Optional[int] = None, latest: Optional[int] = None) -> None:
+    """Raise ValueError unless the given episode numbers are positive and ``start`` doesn't come after ``end``."""
+    for number in (start, end, latest):
+        if number is not None and number < 1:
+            raise ValueError(f"{number} is not an episode number")
+    if start and end and start > end:
+        raise ValueError(f"episode {start} comes after episode {end}")
+
+
+def range_title(title: str, first: int, last: Optional[int]) -> str:
+    """Return the title of a download holding only episodes ``first`` to ``last`` of a work."""
+    return f"{title} ({first}-{last or ''})"
+
+
+class EpisodeListing:
+    """Episodes listed lazily whose number is known up front, such as from a site API."""
+
+    def __init__(self, episodes: Iterable[Dict[str, str]], count: int):
+        self.episodes = episodes
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return iter(self.episodes)
+
+
+class SiteAdapter:
+    """The site specific part of a download: URLs, episode listing and page parsing.
+
+    ``parse_page`` returns what the episode cache and the download journal
+    store for an episode of the site, and ``unpack`` splits such a result into
+    the work title found on the page (or None), the episode title and the
+    chapter HTML. Parse functions run in worker processes, so they have to be
+    module-level functions.
+    """
+
+    # Key of the site in the episode cache, journal names and batch lists
+    site = ""
+    # Whether episode pages carry the work title, so a listing without one is fine
+    title_on_episode_pages = False
+    parse_page: Callable[[str, int], Sequence[Any]]
+    # Like parse_page, with the URL of the next episode appended to the result
+    parse_page_with_next: Callable[[str, int], Sequence[Any]]
+
+    def prefetch(self, client: HttpClient, work_ids: List[str], log: Callable[[str], None]) -> None:
+        """Look up what the site tells about many works at once, ahead of their downloads."""
+
+    def work_stamp(self, client: HttpClient, work_id: str, log: Callable[[str], None]) -> Tuple[Optional[str], Optional[str]]:
+        """Return the title and last update time of a work if they are known without reading its pages."""
+        return None, None
+
+    def latest_episodes(self, client: HttpClient, work_id: str, log: Callable[[str], None]) -> Optional[Tuple[int, List[Dict[str, str]]]]:
+        """Return the number of episodes and the latest ones if a site lists them without reading the whole listing."""
+        return None
+
+    def list_episodes(self, client: HttpClient, work_id: str, log: Callable[[str], None]) -> Tuple[Optional[str], Iterable[Dict[str, str]]]:
+        """Return the work title and its episodes in reading order.
+
+        Episodes are dicts with at least the ``url`` and ``stamp`` of the
+        episode; a lazy iterable lets fetching start before the listing is
+        read to the end, and an ``EpisodeListing`` tells how many episodes
+        there will be. An empty listing falls back to ``fallback_episodes``.
+        """
+        raise NotImplementedError
+
+    def fallback_episodes(self, client: HttpClient, work_id: str, log: Callable[[str], None]) -> List[Dict[str, str]]:
+        """Return the episodes of a work whose listing is empty; none means following the next links."""
+        return []
+
+    def first_episode_url(self, client: HttpClient, work_id: str, log: Callable[[str], None]) -> Optional[str]:
+        """Return the URL the next links are followed from."""
+        raise NotImplementedError
+
+    def episode_url(self, client: HttpClient, work_id: str, episode_num: int, log: Callable[[str], None]) -> Optional[str]:
+        """Return the URL of an episode without following the next links to it, or None if it can't be known."""
+        return None
+
+    def unpack(self, result: Sequence[Any]) -> Tuple[Optional[str], str, Optional[str]]:
+        raise NotImplementedError
+
+    def create_book(self, work_id: str, title: Optional[str], stream: bool, output_dir: Path) -> epub.EpubBook:
+        raise NotImplementedError
+
+    def add_chapter(self, book: epub.EpubBook, episode_num: int, episode_title: str, content: str) -> epub.EpubHtml:
+        raise NotImplementedError
+
+    def save_book(
+        self,
+        book: epub.EpubBook,
+        chapters: List[epub.EpubHtml],
+        title: str,
+        output_dir: Path,
+        records: List[Dict[str, str]],
+    ) -> Path:
+        raise NotImplementedError
+
+
+class DownloadEngine:
+    """Download works of one site through overlapping stages connected by bounded queues.
+
+    A discover thread lists the episodes (or follows the next links), ``workers``
+    threads fetch the pages, ``parse_workers`` threads extract the chapters
+    (in ``parse_executor`` when given) and the calling thread packages them
+    into the EPUB in reading order. A stage waits once the queue to the next
+    one is full, so a slow stage holds back the ones before it instead of the
+    whole work piling up in memory.
+
+    Episodes unchanged since they were stored in ``cache`` aren't parsed
+    again. With ``update``, chapters of an EPUB previously written for the
+    work are reused and only new or changed episodes are fetched; a work
+    whose site reports the same last update time as recorded in the EPUB
+    is skipped without reading its pages. With ``stream``, chapters are
+    written to disk as they are packaged. With ``images``, the images of the
+    chapters are downloaded as the pages are parsed and embedded in the
+    book. With ``volumes``, the work is split into volumes written as they
+    fill up, and with ``sink`` the episodes are written to a JSONL, text or
+    HTML file as they are packaged instead (``update`` then doesn't apply).
+    Finished episodes are journaled as they are extracted; with ``resume``,
+    those of an interrupted download of the work aren't fetched again.
+    Finished downloads are recorded in ``catalog``, with the text of the
+    fetched episodes.
+
+    Every page request is made while holding a slot from ``fetch_slot``, a
+    callable returning a context manager that waits for the slot. Batch
+    downloads pass one from their scheduler so many works share a request
+    budget; a single download doesn't wait.
+    """
+
+    def __init__(
+        self,
+        adapter: SiteAdapter,
+        client: HttpClient,
+        output_dir: Path = Path("epub"),
+        workers: int = DEFAULT_WORKERS,
+        cache: Optional[EpisodeCache] = None,
+        update: bool = False,
+        stream: bool = False,
+        parse_executor: Optional[Executor] = None,
+        parse_workers: Optional[int] = None,
+        resume: bool = False,
+        log: Optional[Callable[[str], None]] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+        images: Optional[ImageOptions] = None,
+        volumes: Optional[VolumeOptions] = None,
+        sink: Optional[SinkOptions] = None,
+        catalog: Optional[Catalog] = None,
+        fetch_slot: Optional[Callable[[], ContextManager[Any]]] = None,
+    ):
+        self.adapter = adapter
+        self.client = client
+        self.output_dir = Path(output_dir)
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.update = update
+        self.stream = stream
+        self.parse_executor = parse_executor
+        # One thread per worker process keeps every process of the pool busy
+        self.parse_workers = max(1, parse_workers or ((os.cpu_count() or 1) if parse_executor else 1))
+        self.resume = resume
+        self.log = log or print
+        # Called with the episodes done and the total (0 if unknown) as they are packaged
+        self.progress = progress or (lambda done, total: None)
+        self.images = images
+        self.volumes = volumes
+        self.sink = sink
+        self.catalog = catalog
+        self.fetch_slot = fetch_slot or nullcontext
+        # The download in progress, for callers showing or cancelling it
+        self.current_run: Optional[PipelineRun] = None
+
+    def iter_episodes(
+        self,
+        work_id: str,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        sequential: bool = False,
+        latest: Optional[int] = None,
+    ) -> Iterator[Episode]:
+        """Yield the episodes ``start`` to ``end`` (counted from 1, both included) of a work in reading order.
+
+        With ``latest``, the last ``latest`` episodes are yielded instead.
+
+        Episodes are fetched and extracted by the same stages as a download
+        and each one is yielded as soon as it and those before it are ready;
+        nothing is written to disk and nothing is journaled. The listing isn't
+        read past ``end``. Closing the generator early stops the download.
+        """
+        adapter = self.adapter
+        title, listing = adapter.list_episodes(self.client, work_id, self.log)
+        if not title and not adapter.title_on_episode_pages:
+            raise DownloadError("Could not find title")
+        listing, start, end = self.select_range(listing, start, end, latest)
+        if sequential:
+            listing = []
+        run = PipelineRun(self, work_id, listing, None, None, None, title, sequential, start=start, end=end)
+        for episode_num, episode, result in run.stream():
+            _, episode_title, content = adapter.unpack(result)
+            if not content:
+                self.log(f"[ERROR] Could not find content for episode {episode_num}")
+                continue
+            yield Episode(episode_num, episode_title, episode["url"], content)
+
+    def epub_path(self, title: str) -> Path:
+        return self.output_dir / f"{title}.epub"
+
+    def download(
+        self,
+        work_id: str,
+        sequential: bool = False,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+    ) -> bool:
+        """Download the episodes of a work and save them as an EPUB file.
+
+        With ``sequential`` the next episode links are followed one page at a
+        time instead of fetching the listed episodes in parallel. Only the
+        episodes ``start`` to ``end`` (counted from 1), or the ``latest``
+        episodes, are downloaded when given; the EPUB of such a part of a work
+        is titled with the range of episodes it holds.
+        """
+        try:
+            self.run(work_id, sequential, start, end, latest)
+            return True
+        except DownloadError as exc:
+            self.log(f"[ERROR] {exc}")
+            return False
+
+    def select_range(
+        self,
+        listing: Iterable[Dict[str, str]],
+        start: Optional[int],
+        end: Optional[int],
+        latest: Optional[int],
+    ) -> Tuple[Iterable[Dict[str, str]], int, Optional[int]]:
+        """Return the listing and the first and last episode (None for the end of the work) to download.
+
+        ``latest`` needs the number of episodes, so a lazy listing without
+        one is read to the end first.
+        """
+        if latest:
+            if not isinstance(listing, Sized):
+                listing = list(listing)
+            if not len(listing):
+                self.log("[WARN] The number of episodes isn't known; downloading every episode")
+                return listing, 1, None
+            start, end = episode_range(len(listing), latest=latest)
+        start = max(1, start or 1)
+        if start > 1 or end:
+            self.log(f"[INFO] Episodes {start} to {end or 'the last'}")
+        return listing, start, end
+
+    def run(
+        self,
+        work_id: str,
+        sequential: bool,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+    ) -> Tuple[Optional[str], List[Path]]:
+        """Download a work like ``download`` and return its title and the files written.
+
+        A work found up to date returns its existing EPUB. Failures raise
+        DownloadError (or the request's exception).
+        """
+        adapter = self.adapter
+        ranged = bool((start and start > 1) or end or latest)
+        # Only a single EPUB of the whole work is matched against the chapters of an earlier download
+        update = self.update and not self.volumes and not self.sink and not ranged
+        if self.update and self.volumes:
+            self.log("[WARN] --update doesn't apply when writing volumes; every episode is packaged again")
+        elif self.update and self.sink:
+            self.log(f"[WARN] --update doesn't apply to {self.sink.format} output; every episode is written again")
+        elif self.update and ranged:
+            self.log("[WARN] --update doesn't apply to a range of episodes; every episode in it is downloaded again")
+        known_title, stamp = adapter.work_stamp(self.client, work_id, self.log)
+        if update and known_title and stamp and read_work_stamp(self.epub_path(known_title)) == stamp:
+            self.log(f"[INFO] {self.epub_path(known_title)} is already up to date")
+            return known_title, [self.epub_path(known_title)]
+
+        title, listing = adapter.list_episodes(self.client, work_id, self.log)
+        if not title and not adapter.title_on_episode_pages:
+            raise DownloadError("Could not find title")
+        if title:
+            self.log(f"[INFO] title: {title}")
+        listing, start, end = self.select_range(listing, start, end, latest)
+        if sequential:
+            listing = []
+
+        existing = None
+        if update:
+            # Changes can only be told apart with the whole listing at hand
+            listing = list(listing)
+            if title and listing:
+                existing = read_existing_chapters(self.epub_path(title))
+                if is_up_to_date(existing, listing):
+                    self.log(f"[INFO] {self.epub_path(title)} is already up to date")
+                    return title, [self.epub_path(title)]
+
+        path = journal_path(self.output_dir, adapter.site, work_id)
+        if path.exists() and not self.resume:
+            self.log(f"[INFO] Restarting the interrupted download journaled in {path} (use --resume to continue it)")
+        journal = DownloadJournal(path, self.resume)
+        if len(journal.entries):
+            self.log(f"[INFO] Resuming: {len(journal.entries)} episodes already downloaded")
+
+        if self.sink and (self.images or self.volumes):
+            self.log(f"[WARN] Images and volumes only apply to EPUB output, not {self.sink.format}")
+        sink = open_sink(self.output_dir, self.sink, self.log) if self.sink else None
+        book = None if self.volumes or sink else adapter.create_book(work_id, title, self.stream, self.output_dir)
+        streamed = book if isinstance(book, StreamingEpubBook) else None
+        images = ImageStore(self.client, self.images, self.log, streamed) if self.images and not sink else None
+        volumes = VolumeWriter(adapter, work_id, self.output_dir, self.volumes, stamp, images, self.log) if self.volumes and not sink else None
+        run = self.current_run = PipelineRun(self, work_id, listing, existing, journal, book, title, sequential, stamp, images, volumes, start, end, sink)
+        saved = False
+        try:
+            epub_paths = run.execute()
+            saved = True
+        finally:
+            self.current_run = None
+            if saved or not len(journal.entries):
+                journal.discard()
+            else:
+                journal.close()
+                self.log(f"[INFO] {len(journal.entries)} finished episodes are kept in {journal.path}; rerun with --resume to continue")
+            if not saved and isinstance(book, StreamingEpubBook):
+                book.discard()
+            if not saved and volumes:
+                volumes.discard()
+            if not saved and sink:
+                sink.discard()
+            if images:
+                images.close()
+        for epub_path in epub_paths:
+            self.log(f"[INFO] Successfully saved to {epub_path}")
+        if self.catalog:
+            self.record(work_id, run, epub_paths)
+        return run.title, epub_paths
+
+    def record(self, work_id: str, run: "PipelineRun", paths: List[Path]) -> None:
+        """Record a finished download in the catalog; a whole work also drops episodes the site no longer lists."""
+        total = run.total if run.display_title() == run.title else None
+        try:
+            run.record_episodes()
+            self.catalog.record_work(self.adapter.site, work_id, run.title, run.stamp, paths, total)
+        except sqlite3.Error as exc:
+            self.log(f"[WARN] Could not record {work_id} in the catalog: {exc}")
+
+
+class PipelineRun:
+    """The stages and queues of one download by a DownloadEngine."""
+
+    def __init__(
+        self,
+        engine: DownloadEngine,
+        work_id: str,
+        listing: Iterable[Dict[str, str]],
+        existing: Optional[Dict[str, ExistingChapter]],
+        journal: Optional[DownloadJournal],
+        book: Optional[epub.EpubBook],
+        title: Optional[str],
+        sequential: bool,
+        stamp: Optional[str] = None,
+        images: Optional[ImageStore] = None,
+        volumes: Optional[VolumeWriter] = None,
+        start: int = 1,
+        end: Optional[int] = None,
+        sink: Optional[EpisodeSink] = None,
+    ):
+        self.engine = engine
+        self.adapter = engine.adapter
+        self.work_id = work_id
+        self.listing = listing
+        self.existing = existing
+        self.journal = journal
+        self.book = book
+        self.title = title
+        self.fetch_queue: "queue.Queue[Tuple[int, Dict[str, str]]]" = queue.Queue(engine.workers * QUEUE_DEPTH)
+        self.extract_queue: "queue.Queue[Tuple[int, Dict[str, str], Any]]" = queue.Queue(engine.parse_workers * QUEUE_DEPTH)
+        self.package_queue: "queue.Queue[Tuple[int, Dict[str, str], Any]]" = queue.Queue(QUEUE_DEPTH)
+        self.sequential = sequential
+        self.stamp = stamp
+        self.images = images
+        self.volumes = volumes
+        self.sink = sink
+        # Episodes start to end (counted from 1) are downloaded; the others are only listed
+        self.start = max(1, start)
+        self.end = end
+        # Number of the last episode, set by the discover stage once it has queued it
+        self.total: Optional[int] = None
+        # Episodes in the listing, if known up front
+        self.found = len(listing) if isinstance(listing, Sized) else 0
+        # Number of episodes shown as the progress total until the last one is known (0 if unknown)
+        self.expected = max(0, min(self.found, end or self.found) - self.start + 1)
+        self.listed = 0
+        # Whether episodes after the range were left out
+        self.truncated = False
+        self.stopped = threading.Event()
+        self.error: Optional[BaseException] = None
+        # Fetched episodes not written to the engine's catalog yet
+        self.catalog_entries: List[CatalogEntry] = []
+
+    def execute(self) -> List[Path]:
+        """Run the stages until every episode is packaged and write the EPUB (or its volumes)."""
+        chapters: List[epub.EpubHtml] = []
+        records: List[Dict[str, str]] = []
+        for episode_num, episode, result in self.stream():
+            chapter = self.add(episode_num, episode, result)
+            if chapter:
+                chapters.append(chapter)
+                records.append({"url": episode["url"], "stamp": episode["stamp"], "file": chapter.file_name, "title": chapter.title})
+        if self.total is not None and self.total < self.start:
+            raise DownloadError(f"The work has only {self.total} episodes")
+        if not self.title:
+            raise DownloadError("Could not find title")
+        if self.volumes:
+            return self.volumes.finish()
+        title = self.display_title()
+        if self.sink:
+            return [self.sink.close(title)]
+        if self.stamp and title == self.title:
+            write_work_stamp(self.book, self.stamp)
+        if title != self.title:
+            self.book.title = title
+            self.book.set_unique_metadata("DC", "title", title)
+        return [self.adapter.save_book(self.book, chapters, title, self.engine.output_dir, records)]
+
+    def display_title(self) -> Optional[str]:
+        """The work title, followed by the range of episodes when only part of the work is downloaded."""
+        if not self.title:
+            return None
+        if self.start > 1:
+            partial = True
+        elif self.end is None:
+            partial = False
+        elif self.total is not None:
+            partial = self.truncated
+        else:
+            partial = not self.found or self.end < self.found
+        if not partial:
+            return self.title
+        last = self.total
+        if last is None:
+            last = min(filter(None, (self.end, self.found)), default=None)
+        return range_title(self.title, self.start, last)
+
+    def cancel(self, reason: str = "cancelled") -> None:
+        """Stop the download from another thread; ``execute`` raises DownloadError(reason)."""
+        if self.error is None:
+            self.error = DownloadError(reason)
+        self.stopped.set()
+
+    def guard(self, stage: Callable[[], None]) -> None:
+        """Run a stage thread, stopping the whole download if it fails."""
+        try:
+            stage()
+        except BaseException as exc:
+            if self.error is None:
+                self.error = exc
+            self.stopped.set()
+
+    def put(self, target: queue.Queue, item: Any) -> bool:
+        """Put ``item`` on a bounded queue, waiting for room; return False if the download stopped."""
+        while not self.stopped.is_set():
+            try:
+                target.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def take(self, source: queue.Queue, done: Callable[[], bool] = lambda: False) -> Any:
+        """Return the next item of a queue, or None once the download stopped or ``done`` is true.
+
+        Threads of the fetch and extract stages wait here until the packaging
+        stage has every episode and stops the download.
+        """
+        while not self.stopped.is_set():
+            try:
+                return source.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if done():
+                    return None
+        return None
+
+    def discover(self) -> None:
+        """List the episodes and queue the ones that have to be fetched."""
+        engine = self.engine
+        if not self.dispatch_all(self.listing):
+            return
+        if not self.listed and not self.sequential:
+            if not self.dispatch_all(self.adapter.fallback_episodes(engine.client, self.work_id, engine.log)):
+                return
+        if not self.listed:
+            self.follow()
+        elif not self.found and not self.end:
+            engine.log(f"[INFO] Found {self.listed} episodes")
+        self.total = self.listed
+
+    def dispatch_all(self, episodes: Iterable[Dict[str, str]]) -> bool:
+        """Number listed episodes and dispatch those in range; return False if the download stopped."""
+        for episode in episodes:
+            if self.end and self.listed >= self.end:
+                # Lazy listings aren't read past the range
+                self.truncated = True
+                break
+            self.listed += 1
+            if self.listed >= self.start and not self.dispatch(self.listed, episode):
+                return False
+        return True
+
+    def dispatch(self, episode_num: int, episode: Dict[str, str]) -> bool:
+        """Hand an episode to the fetch stage, or straight to packaging if it needn't be fetched."""
+        reusable = find_reusable(self.existing, episode["url"], episode["stamp"])
+        if reusable:
+            return self.put(self.package_queue, (episode_num, episode, reusable))
+        entry = self.journal.lookup(episode["url"], episode["stamp"]) if self.journal else None
+        if entry:
+            return self.put(self.package_queue, (episode_num, episode, tuple(entry["result"])))
+        return self.put(self.fetch_queue, (episode_num, episode))
+
+    def follow(self) -> None:
+        """Discover episodes one page at a time by following the next episode links.
+
+        Every page has to be parsed for its next link, so this stage fetches
+        and extracts them itself, including those before the range. Episodes
+        already recorded in the journal are replayed from it without a request.
+        Following stops at the first page without a next link or without a
+        chapter, or at the end of the range.
+        """
+        engine = self.engine
+        url = None
+        if self.start > 1:
+            url = self.adapter.episode_url(engine.client, self.work_id, self.start, engine.log)
+            if url:
+                # Start at the range instead of walking the chain of episodes before it
+                self.listed = self.start - 1
+        if not url:
+            url = self.adapter.first_episode_url(engine.client, self.work_id, engine.log)
+        if not url:
+            raise DownloadError("Could not find first episode link")
+        engine.log(f"[INFO] First episode URL: {url}")
+        while url:
+            if self.end and self.listed >= self.end:
+                self.truncated = True
+                break
+            episode_num = self.listed + 1
+            entry = self.journal.lookup(url) if self.journal else None
+            if entry:
+                result, next_url = tuple(entry["result"]), entry["next"]
+            else:
+                engine.log(f"[LOG] Downloading episode {episode_num}: {url}")
+                with engine.fetch_slot():
+                    response = engine.client.get(url)
+                response.raise_for_status()
+                *result, next_url = parse_in(engine.parse_executor, self.adapter.parse_page_with_next, response.text, episode_num)
+                result = tuple(result)
+                if self.journal:
+                    self.journal.record(url, "", result, next_url)
+            if not self.adapter.unpack(result)[2]:
+                # Past the last episode the next link can lead to a page without a chapter
+                break
+            self.listed += 1
+            if episode_num >= self.start and not self.put(self.package_queue, (episode_num, {"url": url, "stamp": ""}, result)):
+                return
+            url = next_url
+        if not self.truncated:
+            engine.log("[LOG] No more episodes found")
+
+    def fetch(self) -> None:
+        """Fetch episode pages; runs on ``workers`` threads."""
+        engine = self.engine
+        while True:
+            item = self.take(self.fetch_queue)
+            if item is None:
+                return
+            episode_num, episode = item
+            with engine.fetch_slot():
+                engine.log(f"[LOG] Downloading episode {episode_num}: {episode['url']}")
+                page = fetch_page(engine.client, engine.cache, self.adapter.site, episode["url"])
+            if not self.put(self.extract_queue, (episode_num, episode, page)):
+                return
+
+    def extract(self) -> None:
+        """Parse fetched pages, cache and journal the results; runs on ``parse_workers`` threads."""
+        engine = self.engine
+        while True:
+            item = self.take(self.extract_queue)
+            if item is None:
+                return
+            episode_num, episode, page = item
+            result = page.extracted
+            if result is None:
+                result = parse_in(engine.parse_executor, self.adapter.parse_page, page.text, episode_num)
+            store_page(engine.cache, self.adapter.site, self.work_id, page, result)
+            result = tuple(result)
+            if self.journal:
+                self.journal.record(episode["url"], episode["stamp"], result)
+            if self.images:
+                self.images.prefetch(find_image_urls(self.adapter.unpack(result)[2] or "", episode["url"]))
+            if not self.put(self.package_queue, (episode_num, episode, result)):
+                return
+
+    def stream(self) -> Generator[Tuple[int, Dict[str, str], Any], None, None]:
+        """Run the stages and yield the number, listing entry and result of each episode in reading order.
+
+        The consumer runs on the calling thread; the stages keep fetching
+        ahead of it while it handles an episode, up to what the queues hold.
+        Closing the generator early stops the stages.
+        """
+        engine = self.engine
+        if self.found:
+            engine.log(f"[INFO] Found {self.found} episodes")
+        threads = [threading.Thread(target=self.guard, args=(self.discover,), daemon=True)]
+        threads += [threading.Thread(target=self.guard, args=(self.fetch,), daemon=True) for _ in range(engine.workers)]
+        threads += [threading.Thread(target=self.guard, args=(self.extract,), daemon=True) for _ in range(engine.parse_workers)]
+        for thread in threads:
+            thread.start()
+        pending: Dict[int, Tuple[Dict[str, str], Any]] = {}
+        next_num = self.start
+
+        def finished() -> bool:
+            return self.total is not None and next_num > self.total
+
+        def count(number: int) -> int:
+            return max(0, number - self.start + 1)
+
+        try:
+            while not finished():
+                item = self.take(self.package_queue, finished)
+                if item is None:
+                    break
+                episode_num, episode, result = item
+                pending[episode_num] = (episode, result)
+                while next_num in pending:
+                    episode, result = pending.pop(next_num)
+                    yield next_num, episode, result
+                    engine.progress(count(next_num), count(self.total) if self.total else self.expected)
+                    next_num += 1
+            if finished() and count(self.total):
+                # The total may only have become known after the last episode was added
+                engine.progress(count(self.total), count(self.total))
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+        if self.error:
+            raise self.error
+
+    def record_episodes(self) -> None:
+        """Write the fetched episodes kept so far to the engine's catalog."""
+        entries, self.catalog_entries = self.catalog_entries, []
+        self.engine.catalog.record_episodes(self.adapter.site, self.work_id, entries)
+
+    def add(self, episode_num: int, episode: Dict[str, str], result: Any) -> Optional[epub.EpubHtml]:
+        if isinstance(result, ExistingChapter):
+            return reuse_chapter(self.book, episode_num, result, self.images)
+        page_title, episode_title, content = self.adapter.unpack(result)
+        if not self.title and page_title:
+            self.title = page_title
+            self.engine.log(f"[INFO] title: {self.title}")
+            if self.book:
+                self.book.set_title(self.title)
+        if not content:
+            self.engine.log(f"[ERROR] Could not find content for episode {episode_num}")
+            return None
+        if self.engine.catalog:
+            self.catalog_entries.append(CatalogEntry.from_episode(Episode(episode_num, episode_title, episode["url"], content)))
+            if len(self.catalog_entries) >= CATALOG_BATCH:
+                try:
+                    self.record_episodes()
+                except sqlite3.Error as exc:
+                    self.engine.log(f"[WARN] Could not record episodes of {self.work_id} in the catalog: {exc}")
+        if self.volumes:
+            self.volumes.title = self.display_title()
+            self.volumes.add(episode_num, episode, episode_title, content)
+            return None
+        if self.sink:
+            self.sink.title = self.display_title()
+            self.sink.write(Episode(episode_num, episode_title, episode["url"], content))
+            return None
+        if self.images:
+            content = self.images.embed(self.book, content, episode["url"])
+        return self.adapter.add_chapter(self.book, episode_num, episode_title, content)
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+JOURNAL_DIR = ".journal"
+
+
+def journal_path(output_dir: Path, site: str, work_id: str) -> Path:
+    """Return where the journal of a work downloaded into ``output_dir`` is kept."""
+    return Path(output_dir) / JOURNAL_DIR / f"{site}-{work_id}.jsonl"
+
+
+class DownloadJournal:
+    """Append-only log of the episodes of one download finished so far.
+
+    Every episode is written as one JSON line and flushed to disk as soon as
+    it is fetched, so a download that crashes or loses its connection can be
+    resumed from what was already fetched. A torn last line is cut off.
+
+    Only the stamp and file offset of each episode are kept in memory; its
+    result is read back from the file when it is looked up on resume.
+    """
+
+    def __init__(self, path: Path, resume: bool = False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Stamp and offset in the file of every journaled episode, by URL
+        self.entries: Dict[str, Tuple[str, int]] = {}
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a+b" if resume else "w+b")
+        if resume:
+            self.load()
+
+    def load(self) -> None:
+        self.file.seek(0)
+        offset = 0
+        for line in self.file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            self.entries[entry["url"]] = (entry["stamp"], offset)
+            offset += len(line)
+        # Appending after a torn line would glue the next entry to it
+        self.file.truncate(offset)
+
+    def lookup(self, url: str, stamp: Optional[str] = "") -> Optional[Dict[str, Any]]:
+        """Return the journaled entry for ``url`` unless the episode changed since."""
+        known = self.entries.get(url)
+        if known is None or (stamp and known[0] != stamp):
+            return None
+        with self.lock:
+            self.file.seek(known[1])
+            return json.loads(self.file.readline())
+
+    def record(self, url: str, stamp: Optional[str], result: Sequence[Any], next_url: Optional[str] = None) -> None:
+        """Append a finished episode and flush it to disk."""
+        entry = {"url": url, "stamp": stamp or "", "result": list(result), "next": next_url}
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[url] = (entry["stamp"], offset)
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+    def discard(self) -> None:
+        """Close and delete the journal once the EPUB has been written."""
+        self.close()
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,168 @@
+import cProfile
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+# Stages in pipeline order; dns and connect are part of ttfb, which is part of fetch
+STAGES = ("wait", "dns", "connect", "ttfb", "body", "fetch", "parse", "build", "image", "write")
+PROMETHEUS_PREFIX = "novel_downloader"
+
+
+class DownloadMetrics:
+    """Thread-safe totals of the time spent in each stage of the downloads and their counters.
+
+    Stage times are summed over every call, so with concurrent workers they
+    can add up to more than the elapsed time of the run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = time.monotonic()
+            self.stages: Dict[str, List[float]] = {}
+            self.counters: Dict[str, int] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Record the time spent in the ``with`` block under stage ``name``."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self) -> Dict[str, Any]:
+        """Return the totals as a JSON-serializable dict."""
+        with self.lock:
+            return {
+                "elapsed_seconds": time.monotonic() - self.started,
+                "stages": {
+                    name: {"calls": int(calls), "seconds": seconds, "max_seconds": longest}
+                    for name, (calls, seconds, longest) in sorted(self.stages.items(), key=stage_order)
+                },
+                "counters": dict(self.counters),
+            }
+
+    def describe(self) -> str:
+        """Return a one-line summary for the end of a run."""
+        summary = self.summary()
+        parts = [f"{name} {totals['seconds']:.1f}s" for name, totals in summary["stages"].items()]
+        counters = summary["counters"]
+        parts.append(f"{counters.get('requests', 0)} requests")
+        parts.append(f"{counters.get('bytes', 0) / (1024 * 1024):.1f} MB")
+        parts.append(f"{counters.get('retries', 0)} retries")
+        return f"Finished in {summary['elapsed_seconds']:.1f}s (stage totals: " + ", ".join(parts) + ")"
+
+    def write_json(self, path: Path) -> None:
+        Path(path).write_text(json.dumps(self.summary(), indent=2), encoding="utf-8")
+
+    def prometheus(self) -> str:
+        """Return the totals in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [
+            f"# HELP {PROMETHEUS_PREFIX}_stage_seconds_total Time spent in each download stage.",
+            f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds_total counter",
+        ]
+        for name, totals in summary["stages"].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_total{{stage="{name}"}} {totals["seconds"]:.6f}')
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_stage_calls_total Calls of each download stage.",
+            f"# TYPE {PROMETHEUS_PREFIX}_stage_calls_total counter",
+        ]
+        for name, totals in summary["stages"].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_calls_total{{stage="{name}"}} {totals["calls"]}')
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}_total {value}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_uptime_seconds gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}_uptime_seconds {summary['elapsed_seconds']:.3f}")
+        return "\n".join(lines) + "\n"
+
+
+def stage_order(item) -> int:
+    name = item[0]
+    return STAGES.index(name) if name in STAGES else len(STAGES)
+
+
+# Shared by every downloader in this process
+metrics = DownloadMetrics()
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port: int, host: str = "") -> ThreadingHTTPServer:
+    """Serve the metrics at ``/metrics`` on ``port`` from a background thread."""
+    server = ThreadingHTTPServer((host, port), PrometheusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextmanager
+def profiled(path: Optional[Path]) -> Iterator[None]:
+    """Profile the ``with`` block with cProfile and dump the stats to ``path`` (no-op if None).
+
+    Threads started inside the block are profiled too where the interpreter
+    allows several profilers at once; worker processes aren't.
+    """
+    if path is None:
+        yield
+        return
+
+    profiles = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(*args):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows only one active profiler per process
+            return
+        with lock:
+            profiles.append(profile)
+
+    threading.setprofile(profile_thread)
+    profiles[0].enable()
+    try:
+        yield
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(*profiles)
+        stats.dump_stats(str(path))
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+
+from http_client import HttpClient
+
+DEFAULT_CACHE_DIR = Path("cache")
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_AGE_DAYS = 90
+# Bumped when the parsers extract something different, so older entries are dropped
+EXTRACT_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS episodes (
+    site TEXT NOT NULL,
+    work_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT NOT NULL,
+    extracted BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (site, url)
+);
+CREATE INDEX IF NOT EXISTS episodes_work ON episodes (site, work_id);
+CREATE INDEX IF NOT EXISTS episodes_accessed ON episodes (accessed_at);
+"""
+
+
+class CachedEpisode:
+    """A cached episode: its response validators and the parser's extracted result."""
+
+    __slots__ = ("etag", "last_modified", "content_hash", "extracted")
+
+    def __init__(self, etag: Optional[str], last_modified: Optional[str], content_hash: str, extracted: Sequence[Any]):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.extracted = extracted
+
+    def validators(self) -> Dict[str, str]:
+        """Return the headers for a conditional GET."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class EpisodeCache:
+    """On-disk cache of extracted episodes keyed by site, work and episode URL.
+
+    Entries live in one SQLite database with the extracted chapter stored as a
+    zlib-compressed JSON blob. The connection is shared by all worker threads.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_age_days: float = DEFAULT_MAX_AGE_DAYS,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.cache_dir / "episodes.sqlite3"), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != EXTRACT_VERSION:
+            with self.db:
+                self.db.execute("DELETE FROM episodes")
+                self.db.execute(f"PRAGMA user_version = {EXTRACT_VERSION}")
+
+    def lookup(self, site: str, url: str) -> Optional[CachedEpisode]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified, content_hash, extracted FROM episodes WHERE site = ? AND url = ?",
+                (site, url),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_hash, extracted = row
+        return CachedEpisode(etag, last_modified, content_hash, json.loads(zlib.decompress(extracted)))
+
+    def store(
+        self,
+        site: str,
+        work_id: str,
+        url: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        content_hash: str,
+        extracted: Sequence[Any],
+    ) -> None:
+        blob = zlib.compress(json.dumps(list(extracted), ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (site, work_id, url, etag, last_modified, content_hash, blob, len(blob), now, now),
+            )
+
+    def touch(self, site: str, url: str) -> None:
+        """Mark an entry as used so size-based eviction keeps it."""
+        with self.lock, self.db:
+            self.db.execute("UPDATE episodes SET accessed_at = ? WHERE site = ? AND url = ?", (time.time(), site, url))
+
+    def evict(self) -> int:
+        """Drop entries older than ``max_age_days``, then the least recently used beyond ``max_bytes``."""
+        removed = 0
+        with self.lock, self.db:
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 86400
+                removed += self.db.execute("DELETE FROM episodes WHERE accessed_at < ?", (cutoff,)).rowcount
+            if self.max_bytes:
+                total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM episodes").fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self.db.execute("SELECT site, url, size FROM episodes ORDER BY accessed_at").fetchall()
+                    for site, url, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        self.db.execute("DELETE FROM episodes WHERE site = ? AND url = ?", (site, url))
+                        total -= size
+                        removed += 1
+        return removed
+
+    def close(self) -> None:
+        self.evict()
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self) -> "EpisodeCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class FetchedPage:
+    """An episode page fetched by ``fetch_page``.
+
+    ``extracted`` is the cached result when the page hasn't changed since it
+    was cached; otherwise ``text`` still has to be parsed.
+    """
+
+    __slots__ = ("url", "text", "etag", "last_modified", "content_hash", "extracted")
+
+    def __init__(
+        self,
+        url: str,
+        text: Optional[str],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        extracted: Optional[Sequence[Any]] = None,
+    ):
+        self.url = url
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = content_hash
+        self.extracted = extracted
+
+
+def fetch_page(client: HttpClient, cache: Optional[EpisodeCache], site: str, url: str) -> FetchedPage:
+    """Fetch an episode page with the cached validators, without parsing it.
+
+    On ``304 Not Modified``, or when the body hashes to the cached content,
+    the page carries the cached result.
+    """
+    entry = cache.lookup(site, url) if cache else None
+    response = client.get(url, headers=entry.validators() if entry else None)
+    if entry and response.status_code == 304:
+        cache.touch(site, url)
+        return FetchedPage(url, None, extracted=entry.extracted)
+    response.raise_for_status()
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    return FetchedPage(
+        url, response.text,
+        response.headers.get("ETag"), response.headers.get("Last-Modified"), content_hash,
+        entry.extracted if entry and entry.content_hash == content_hash else None,
+    )
+
+
+def store_page(cache: Optional[EpisodeCache], site: str, work_id: str, page: FetchedPage, extracted: Sequence[Any]) -> None:
+    """Cache the result extracted from a page returned by ``fetch_page``."""
+    if cache and page.content_hash:
+        cache.store(site, work_id, page.url, page.etag, page.last_modified, page.content_hash, extracted)
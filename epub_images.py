@@ -0,0 +1,235 @@
+import hashlib
+import html
+import io
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urljoin
+
+import requests
+from ebooklib import epub
+
+from download_metrics import metrics
+from epub_stream import StreamingEpubBook
+from http_client import HttpClient
+
+try:
+    from PIL import Image
+except ImportError:  # downscaling and recompressing images is optional
+    Image = None
+
+# Folder of the EPUB the images are stored in, next to the chapters
+IMAGE_DIR = "images"
+DEFAULT_IMAGE_WORKERS = 4
+DEFAULT_IMAGE_QUALITY = 80
+
+IMG_SRC = re.compile(r'(<img\b[^>]*?\bsrc\s*=\s*)(["\'])(.*?)\2', re.IGNORECASE | re.DOTALL)
+EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+}
+SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+
+class ImageOptions:
+    """How the images of a chapter are embedded.
+
+    ``max_size`` is the longest edge in pixels images are scaled down to and
+    ``quality`` the JPEG quality they are recompressed with; both need Pillow
+    and leave images as downloaded when None.
+    """
+
+    def __init__(self, max_size: Optional[int] = None, quality: Optional[int] = None, workers: int = DEFAULT_IMAGE_WORKERS):
+        self.max_size = max_size
+        self.quality = quality
+        self.workers = max(1, workers)
+
+    @property
+    def recompress(self) -> bool:
+        return bool(self.max_size or self.quality)
+
+
+class ImageAsset:
+    """An image stored once per distinct content, under a name derived from its hash.
+
+    ``data`` is None once the image is written into a streamed archive.
+    """
+
+    __slots__ = ("digest", "file_name", "media_type", "data")
+
+    def __init__(self, digest: str, media_type: str, data: bytes):
+        self.digest = digest
+        self.file_name = f"{IMAGE_DIR}/{digest[:32]}{EXTENSIONS.get(media_type, '')}"
+        self.media_type = media_type
+        self.data: Optional[bytes] = data
+
+    def item(self) -> epub.EpubImage:
+        return epub.EpubImage(uid=f"image_{self.digest[:32]}", file_name=self.file_name, media_type=self.media_type, content=self.data)
+
+
+def find_image_urls(content: str, page_url: str) -> List[str]:
+    """Return the absolute URLs of the images of a chapter, in order and without repeats."""
+    urls = []
+    for match in IMG_SRC.finditer(content):
+        url = urljoin(page_url, html.unescape(match.group(3).strip()))
+        if url.startswith(("http://", "https://")) and url not in urls:
+            urls.append(url)
+    return urls
+
+
+def sniff_media_type(data: bytes, declared: str) -> Optional[str]:
+    """Return the image type of a response, trusting its content over the declared type."""
+    for signature, media_type in SIGNATURES:
+        if data.startswith(signature):
+            return media_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    declared = declared.split(";")[0].strip().lower()
+    return declared if declared in EXTENSIONS else None
+
+
+def recompress(data: bytes, media_type: str, options: ImageOptions) -> Tuple[bytes, str]:
+    """Scale an image down to ``options.max_size`` and re-encode it, if that makes it smaller.
+
+    Images with transparency stay PNG; others become JPEG. Animated and
+    vector images are left alone.
+    """
+    if Image is None or media_type == "image/svg+xml":
+        return data, media_type
+    with metrics.stage("image"), Image.open(io.BytesIO(data)) as image:
+        if getattr(image, "is_animated", False):
+            return data, media_type
+        resized = bool(options.max_size) and max(image.size) > options.max_size
+        if resized:
+            image.thumbnail((options.max_size, options.max_size))
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(output, "PNG", optimize=True)
+            new_type = "image/png"
+        else:
+            image.convert("RGB").save(output, "JPEG", quality=options.quality or DEFAULT_IMAGE_QUALITY, optimize=True)
+            new_type = "image/jpeg"
+    if not resized and output.tell() >= len(data):
+        return data, media_type
+    return output.getvalue(), new_type
+
+
+class ImageStore:
+    """Fetch the images of a work's chapters concurrently and add each one to the book once.
+
+    ``prefetch`` starts downloading the images of a chapter on a small pool
+    of threads as soon as its page is parsed; ``embed`` waits for them while
+    the chapter is added, adds every image not in the book yet as an
+    ``EpubImage`` and points the chapter at it. Images are stored by the hash
+    of their content, so one used on many pages, or behind several URLs, is
+    stored once. Images that can't be downloaded keep their remote link.
+
+    With a ``StreamingEpubBook``, each image is written into its archive as
+    soon as it is fetched and only its file name is kept, so images don't
+    stay in memory until the work is finished.
+    """
+
+    def __init__(
+        self,
+        client: HttpClient,
+        options: Optional[ImageOptions] = None,
+        log: Optional[Callable[[str], None]] = None,
+        book: Optional[StreamingEpubBook] = None,
+    ):
+        self.client = client
+        self.options = options or ImageOptions()
+        self.log = log or print
+        self.book = book
+        self.executor = ThreadPoolExecutor(self.options.workers, thread_name_prefix="images")
+        self.lock = threading.Lock()
+        self.by_url: Dict[str, "Future[Optional[ImageAsset]]"] = {}
+        self.by_digest: Dict[str, ImageAsset] = {}
+        # File names of the images in the book last added to (one book at a time, as volumes are written)
+        self.added_book: Optional[epub.EpubBook] = book
+        self.added: Set[str] = set()
+        if self.options.recompress and Image is None:
+            self.log("[WARN] Pillow is not installed (pip install pillow); images are embedded as downloaded")
+
+    def prefetch(self, urls: Iterable[str]) -> None:
+        """Start downloading images that weren't requested yet."""
+        with self.lock:
+            for url in urls:
+                if url not in self.by_url:
+                    self.by_url[url] = self.executor.submit(self.load, url)
+
+    def get(self, url: str) -> Optional[ImageAsset]:
+        self.prefetch([url])
+        return self.by_url[url].result()
+
+    def load(self, url: str) -> Optional[ImageAsset]:
+        try:
+            response = self.client.get(url)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as exc:
+            self.log(f"[WARN] Could not download image {url}: {exc}")
+            return None
+        data = response.content
+        media_type = sniff_media_type(data, response.headers.get("Content-Type", ""))
+        if media_type is None:
+            self.log(f"[WARN] Not an image: {url}")
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            asset = self.by_digest.get(digest)
+        if asset:
+            return asset
+        if self.options.recompress:
+            try:
+                data, media_type = recompress(data, media_type, self.options)
+            except (OSError, ValueError) as exc:
+                self.log(f"[WARN] Could not recompress image {url}: {exc}")
+        with self.lock:
+            asset = self.by_digest.get(digest)
+            if asset:
+                return asset
+            asset = self.by_digest[digest] = ImageAsset(digest, media_type, data)
+        if self.book is not None:
+            if self.add(self.book, asset.item()):
+                metrics.count("images")
+            asset.data = None
+        return asset
+
+    def add(self, book: epub.EpubBook, item: epub.EpubImage) -> bool:
+        """Add an image to ``book`` unless one with its file name already is; return whether it was added."""
+        with self.lock:
+            if book is not self.added_book:
+                self.added_book, self.added = book, set()
+            if item.file_name in self.added:
+                return False
+            self.added.add(item.file_name)
+            book.add_item(item)
+            return True
+
+    def embed(self, book: epub.EpubBook, content: str, page_url: str) -> str:
+        """Add the images of a chapter to ``book`` and return the chapter pointing at them."""
+        self.prefetch(find_image_urls(content, page_url))
+
+        def replace(match: "re.Match[str]") -> str:
+            url = urljoin(page_url, html.unescape(match.group(3).strip()))
+            if not url.startswith(("http://", "https://")):
+                return match.group(0)
+            asset = self.get(url)
+            if asset is None:
+                return match.group(0)
+            # A streamed book already has the image; others get it with their first chapter using it
+            if self.book is None and self.add(book, asset.item()):
+                metrics.count("images")
+            return f"{match.group(1)}{match.group(2)}{asset.file_name}{match.group(2)}"
+
+        return IMG_SRC.sub(replace, content)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,168 @@
+import os
+import tempfile
+import threading
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List
+from xml.sax.saxutils import escape, quoteattr
+
+import ebooklib
+from ebooklib import epub
+
+CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles>
+    <rootfile media-type="application/oebps-package+xml" full-path="EPUB/content.opf"/>
+  </rootfiles>
+</container>
+"""
+
+
+class StreamingEpubBook(epub.EpubBook):
+    """EpubBook that writes each chapter into the archive as soon as it is added.
+
+    Chapters are serialized into a temporary zip next to the destination and
+    their content is dropped, so memory doesn't grow with the length of the
+    work. Only the file name and title of every chapter are kept to write the
+    OPF manifest, spine, NCX and nav in ``finish``. Images may be added from
+    other threads while chapters are.
+    """
+
+    def __init__(self, temp_dir: Path):
+        super().__init__()
+        temp_dir = Path(temp_dir)
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(suffix=".epub.part", dir=str(temp_dir))
+        os.close(handle)
+        self.temp_path = Path(temp_path)
+        self.archive = zipfile.ZipFile(self.temp_path, "w", zipfile.ZIP_DEFLATED)
+        # The mimetype entry must come first and be stored uncompressed
+        self.archive.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.archive.writestr("META-INF/container.xml", CONTAINER_XML)
+        self.written = set()
+        self.lock = threading.Lock()
+
+    def add_item(self, item):
+        with self.lock:
+            if isinstance(item, epub.EpubImage):
+                # Only the manifest entry of an image is kept once it is written
+                self.archive.writestr(f"EPUB/{item.file_name}", item.get_content())
+                item.content = b""
+                return super().add_item(item)
+            if not isinstance(item, epub.EpubHtml) or isinstance(item, epub.EpubNav):
+                return super().add_item(item)
+            item.book = self
+            self.archive.writestr(f"EPUB/{item.file_name}", item.get_content())
+            self.written.add(item.file_name)
+            item.content = ""
+            return item
+
+    def finish(self, epub_path: Path, chapters: List[epub.EpubHtml]) -> Path:
+        """Write the package documents for ``chapters`` and move the archive to ``epub_path``."""
+        chapters = [chapter for chapter in chapters if chapter.file_name in self.written]
+        with self.lock:
+            self.archive.writestr("EPUB/content.opf", self.build_opf(chapters))
+            self.archive.writestr("EPUB/toc.ncx", self.build_ncx(chapters))
+            self.archive.writestr("EPUB/nav.xhtml", self.build_nav(chapters))
+            self.archive.close()
+        os.replace(self.temp_path, epub_path)
+        return Path(epub_path)
+
+    def discard(self) -> None:
+        """Close and delete the partly written archive."""
+        with self.lock:
+            self.archive.close()
+        self.temp_path.unlink(missing_ok=True)
+
+    def build_opf(self, chapters: List[epub.EpubHtml]) -> str:
+        identifier = escape(self.uid or str(uuid.uuid4()))
+        modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        metadata = [
+            f'    <meta property="dcterms:modified">{modified}</meta>',
+            f'    <dc:identifier id="id">{identifier}</dc:identifier>',
+            f'    <dc:title>{escape(self.title)}</dc:title>',
+            f'    <dc:language>{escape(self.language)}</dc:language>',
+        ]
+        for creator, _ in self.get_metadata("DC", "creator"):
+            metadata.append(f'    <dc:creator>{escape(creator)}</dc:creator>')
+        # add_metadata(None, "meta", ...) files the <meta> elements under no namespace
+        for _, attributes in self.get_metadata("OPF", "meta") + self.metadata.get(None, {}).get("meta", []):
+            if "name" in attributes:
+                metadata.append(
+                    f'    <meta name={quoteattr(attributes["name"])} content={quoteattr(attributes.get("content", ""))}/>'
+                )
+
+        manifest = [
+            '    <item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>',
+            '    <item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>',
+        ]
+        spine = ['    <itemref idref="nav"/>']
+        for number, chapter in enumerate(chapters):
+            manifest.append(f'    <item href={quoteattr(chapter.file_name)} id="chapter_{number}" media-type="application/xhtml+xml"/>')
+            spine.append(f'    <itemref idref="chapter_{number}"/>')
+        for number, image in enumerate(self.get_items_of_type(ebooklib.ITEM_IMAGE)):
+            manifest.append(f'    <item href={quoteattr(image.file_name)} id="image_{number}" media-type={quoteattr(image.media_type)}/>')
+
+        return "\n".join([
+            "<?xml version='1.0' encoding='utf-8'?>",
+            '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">',
+            '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">',
+            *metadata,
+            "  </metadata>",
+            "  <manifest>",
+            *manifest,
+            "  </manifest>",
+            '  <spine toc="ncx">',
+            *spine,
+            "  </spine>",
+            "</package>",
+            "",
+        ])
+
+    def build_ncx(self, chapters: List[epub.EpubHtml]) -> str:
+        nav_points = []
+        for number, chapter in enumerate(chapters, start=1):
+            nav_points.append(
+                f'    <navPoint id="navpoint_{number}" playOrder="{number}">'
+                f'<navLabel><text>{escape(chapter.title)}</text></navLabel>'
+                f'<content src={quoteattr(chapter.file_name)}/></navPoint>'
+            )
+        return "\n".join([
+            "<?xml version='1.0' encoding='utf-8'?>",
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">',
+            "  <head>",
+            f'    <meta content={quoteattr(self.uid or "")} name="dtb:uid"/>',
+            '    <meta content="1" name="dtb:depth"/>',
+            "  </head>",
+            f"  <docTitle><text>{escape(self.title)}</text></docTitle>",
+            "  <navMap>",
+            *nav_points,
+            "  </navMap>",
+            "</ncx>",
+            "",
+        ])
+
+    def build_nav(self, chapters: List[epub.EpubHtml]) -> str:
+        items = [
+            f'        <li><a href={quoteattr(chapter.file_name)}>{escape(chapter.title)}</a></li>'
+            for chapter in chapters
+        ]
+        language = quoteattr(self.language)
+        return "\n".join([
+            "<?xml version='1.0' encoding='utf-8'?>",
+            "<!DOCTYPE html>",
+            f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang={language} xml:lang={language}>',
+            f"  <head><title>{escape(self.title)}</title></head>",
+            "  <body>",
+            '    <nav epub:type="toc" id="id" role="doc-toc">',
+            f"      <h2>{escape(self.title)}</h2>",
+            "      <ol>",
+            *items,
+            "      </ol>",
+            "    </nav>",
+            "  </body>",
+            "</html>",
+            "",
+        ])
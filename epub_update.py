@@ -0,0 +1,135 @@
+import json
+import zipfile
+from collections import OrderedDict
+from xml.etree import ElementTree
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ebooklib import epub
+
+from epub_images import IMAGE_DIR, IMG_SRC, ImageStore
+
+# OPF <meta> holding the source URL and TOC stamp of every chapter
+EPISODE_INDEX_META = "kakuyomu-downloader:episodes"
+# OPF <meta> holding when the site last reported the work as changed
+WORK_STAMP_META = "kakuyomu-downloader:updated"
+
+
+class ExistingChapter:
+    """A chapter of a previously written EPUB, as recorded in its episode index."""
+
+    __slots__ = ("url", "stamp", "title", "content", "images")
+
+    def __init__(self, url: str, stamp: Optional[str], title: str, content: str, images: Optional[List[epub.EpubItem]] = None):
+        self.url = url
+        self.stamp = stamp
+        self.title = title
+        self.content = content
+        # Images embedded in the book that the chapter shows
+        self.images = images or []
+
+
+def write_episode_index(book: epub.EpubBook, records: List[Dict[str, Optional[str]]]) -> None:
+    """Embed the ``url``/``stamp``/``file``/``title`` record of every chapter in the book's metadata."""
+    book.add_metadata(None, 'meta', '', {
+        'name': EPISODE_INDEX_META,
+        'content': json.dumps(records, ensure_ascii=False),
+    })
+
+
+def write_work_stamp(book: epub.EpubBook, stamp: str) -> None:
+    """Embed the work's last update time, as reported by the site, in the book's metadata."""
+    book.add_metadata(None, 'meta', '', {'name': WORK_STAMP_META, 'content': stamp})
+
+
+def read_work_stamp(epub_path: Path) -> Optional[str]:
+    """Return the work stamp of an EPUB written by this tool, or None.
+
+    Only the package document is read, so this stays cheap for large books.
+    """
+    try:
+        with zipfile.ZipFile(epub_path) as archive:
+            for name in archive.namelist():
+                if not name.endswith('.opf'):
+                    continue
+                root = ElementTree.fromstring(archive.read(name))
+                for meta in root.iter('{http://www.idpf.org/2007/opf}meta'):
+                    if meta.get('name') == WORK_STAMP_META:
+                        return meta.get('content')
+    except (OSError, zipfile.BadZipFile, ElementTree.ParseError):
+        return None
+    return None
+
+
+def read_existing_chapters(epub_path: Path) -> Optional["OrderedDict[str, ExistingChapter]"]:
+    """Return the chapters of an EPUB written by this tool, keyed by source URL.
+
+    Returns None when the file doesn't exist or has no episode index.
+    """
+    if not Path(epub_path).exists():
+        return None
+    book = epub.read_epub(str(epub_path))
+    records = None
+    for _, attributes in book.get_metadata('OPF', 'meta'):
+        if attributes.get('name') == EPISODE_INDEX_META:
+            records = json.loads(attributes['content'])
+    if records is None:
+        return None
+
+    chapters = OrderedDict()
+    for record in records:
+        item = book.get_item_with_href(record['file'])
+        if item is None:
+            continue
+        content = item.get_body_content().decode('utf-8')
+        images = [book.get_item_with_href(match.group(3)) for match in IMG_SRC.finditer(content) if match.group(3).startswith(f"{IMAGE_DIR}/")]
+        chapters[record['url']] = ExistingChapter(
+            record['url'],
+            record.get('stamp'),
+            record.get('title') or item.title or '',
+            content,
+            [image for image in images if image is not None],
+        )
+    return chapters
+
+
+def reuse_chapter(book: epub.EpubBook, episode_num: int, existing: ExistingChapter, images: Optional[ImageStore] = None) -> epub.EpubHtml:
+    """Add an unchanged chapter from an existing EPUB, with its images, to a new book.
+
+    With ``images``, the images go through the store so it knows the book has them.
+    """
+    for image in existing.images:
+        item = epub.EpubImage(uid=image.id, file_name=image.file_name, media_type=image.media_type, content=image.get_content())
+        if images:
+            images.add(book, item)
+        elif book.get_item_with_href(image.file_name) is None:
+            book.add_item(item)
+    chapter = epub.EpubHtml(title=existing.title, file_name=f'chapter_{episode_num}.xhtml', lang='ja')
+    chapter.content = existing.content
+    book.add_item(chapter)
+    return chapter
+
+
+def find_reusable(
+    existing: Optional[Dict[str, ExistingChapter]],
+    url: str,
+    stamp: Optional[str],
+) -> Optional[ExistingChapter]:
+    """Return the existing chapter for ``url`` if its stamp shows it hasn't changed."""
+    if not existing:
+        return None
+    chapter = existing.get(url)
+    if chapter is None or not stamp or chapter.stamp != stamp:
+        return None
+    return chapter
+
+
+def is_up_to_date(existing: Optional[Dict[str, ExistingChapter]], episodes: List[Dict[str, str]]) -> bool:
+    """Whether an existing EPUB already holds exactly these episodes, unchanged."""
+    if not existing or len(existing) != len(episodes):
+        return False
+    return all(
+        find_reusable(existing, episode['url'], episode.get('stamp')) is not None
+        and url == episode['url']
+        for url, episode in zip(existing, episodes)
+    )
@@ -0,0 +1,239 @@
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from ebooklib import epub
+
+from download_metrics import metrics
+from epub_images import ImageStore
+from epub_update import write_episode_index, write_work_stamp
+
+# Volumes written at the same time
+DEFAULT_VOLUME_WORKERS = 4
+
+
+class VolumeOptions:
+    """How a work is split into volumes and how its episodes are packed into files.
+
+    A volume ends before the episode that would take it past
+    ``max_episodes`` episodes or ``max_bytes`` bytes, and with ``by_arc``
+    wherever the site's arc (chapter) changes. Consecutive episodes of one
+    arc are bundled into XHTML files of up to ``bundle_bytes`` bytes, and
+    ``arc_toc`` nests the table of contents by arc.
+    """
+
+    def __init__(
+        self,
+        max_episodes: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        by_arc: bool = False,
+        bundle_bytes: Optional[int] = None,
+        arc_toc: bool = False,
+        workers: int = DEFAULT_VOLUME_WORKERS,
+    ):
+        self.max_episodes = max_episodes
+        self.max_bytes = max_bytes
+        self.by_arc = by_arc
+        self.bundle_bytes = bundle_bytes
+        self.arc_toc = arc_toc
+        self.workers = max(1, workers)
+
+    @property
+    def splits(self) -> bool:
+        return bool(self.max_episodes or self.max_bytes or self.by_arc)
+
+    @property
+    def enabled(self) -> bool:
+        return self.splits or bool(self.bundle_bytes) or self.arc_toc
+
+
+class TocEntry:
+    """Where an episode landed in a volume."""
+
+    __slots__ = ("href", "title", "arc", "uid", "url", "stamp")
+
+    def __init__(self, href: str, title: str, arc: str, uid: str, url: str, stamp: str):
+        self.href = href
+        self.title = title
+        self.arc = arc
+        self.uid = uid
+        self.url = url
+        self.stamp = stamp
+
+
+def build_toc(entries: List[TocEntry], nested: bool) -> List[Any]:
+    """Return the table of contents of a volume, with a section per arc when ``nested``."""
+    if not nested:
+        return [epub.Link(entry.href, entry.title, entry.uid) for entry in entries]
+    toc: List[Any] = []
+    for arc, group in itertools.groupby(entries, key=lambda entry: entry.arc):
+        links = [epub.Link(entry.href, entry.title, entry.uid) for entry in group]
+        if arc:
+            toc.append((epub.Section(arc, links[0].href), links))
+        else:
+            toc.extend(links)
+    return toc
+
+
+def write_volume(book: epub.EpubBook, epub_path: Path) -> Path:
+    with metrics.stage("write"):
+        epub_path.parent.mkdir(parents=True, exist_ok=True)
+        epub.write_epub(str(epub_path), book)
+    return epub_path
+
+
+class VolumeWriter:
+    """Package the episodes of a work into one or more EPUB volumes as they arrive.
+
+    Episodes are added in reading order. Once a volume is full it is handed
+    to a pool of ``options.workers`` threads to be written while the next
+    one fills, so only the volume being filled and those being written are
+    held in memory. Volumes are named ``<title> 01.epub``, ``<title> 02.epub``
+    and so on; a work that isn't split is written to ``<title>.epub``.
+    """
+
+    def __init__(
+        self,
+        adapter: Any,
+        work_id: str,
+        output_dir: Path,
+        options: VolumeOptions,
+        stamp: Optional[str] = None,
+        images: Optional[ImageStore] = None,
+        log: Optional[Callable[[str], None]] = None,
+    ):
+        self.adapter = adapter
+        self.work_id = work_id
+        self.output_dir = Path(output_dir)
+        self.options = options
+        self.stamp = stamp
+        self.images = images
+        self.log = log or print
+        # Work title; may only become known from the first episode page
+        self.title: Optional[str] = None
+        self.executor = ThreadPoolExecutor(options.workers, thread_name_prefix="volumes")
+        self.written: List["Future[Path]"] = []
+        self.number = 0
+        self.book: Optional[epub.EpubBook] = None
+        self.chapters: List[epub.EpubHtml] = []
+        self.entries: List[TocEntry] = []
+        self.size = 0
+        # Episodes waiting to be written into one bundled file: number, title, content and source
+        self.bundle: List[Tuple[int, str, str, Dict[str, str]]] = []
+        self.bundle_size = 0
+
+    def add(self, episode_num: int, episode: Dict[str, str], episode_title: str, content: str) -> None:
+        """Add the next episode, starting a new volume first if it doesn't fit in the current one."""
+        arc = episode.get("chapter") or ""
+        size = len(content.encode("utf-8"))
+        if self.book is not None and self.is_full(arc, size):
+            self.flush()
+        if self.book is None:
+            self.start()
+        if self.images:
+            images_before = len(self.book.items)
+            content = self.images.embed(self.book, content, episode["url"])
+            size += sum(len(item.get_content()) for item in self.book.items[images_before:])
+        self.size += size
+
+        if not self.options.bundle_bytes:
+            chapter = self.adapter.add_chapter(self.book, episode_num, episode_title, content)
+            self.chapters.append(chapter)
+            self.entries.append(TocEntry(chapter.file_name, chapter.title, arc, chapter.file_name, episode["url"], episode["stamp"]))
+            return
+        if self.bundle and (self.bundle_size + size > self.options.bundle_bytes or (self.bundle[-1][3].get("chapter") or "") != arc):
+            self.close_bundle()
+        self.bundle.append((episode_num, episode_title, content, episode))
+        self.bundle_size += size
+
+    def is_full(self, arc: str, size: int) -> bool:
+        options = self.options
+        episodes = len(self.entries) + len(self.bundle)
+        if not episodes:
+            return False
+        if options.max_episodes and episodes >= options.max_episodes:
+            return True
+        if options.max_bytes and self.size + size > options.max_bytes:
+            return True
+        return options.by_arc and self.entries_arc() != arc
+
+    def entries_arc(self) -> str:
+        if self.bundle:
+            return self.bundle[-1][3].get("chapter") or ""
+        return self.entries[-1].arc
+
+    def start(self) -> None:
+        self.number += 1
+        self.book = self.adapter.create_book(self.work_id, self.title, False, self.output_dir)
+        if self.options.splits:
+            # Readers tell books apart by their identifier, so every volume gets its own
+            self.book.set_identifier(f"{self.work_id}-{self.number}")
+        self.chapters = []
+        self.entries = []
+        self.size = 0
+
+    def close_bundle(self) -> None:
+        """Write the bundled episodes into one XHTML file, each under its own anchor."""
+        if not self.bundle:
+            return
+        first, last = self.bundle[0][0], self.bundle[-1][0]
+        file_name = f"chapter_{first}.xhtml" if first == last else f"chapters_{first}-{last}.xhtml"
+        with metrics.stage("build"):
+            chapter = epub.EpubHtml(title=self.bundle[0][1], file_name=file_name, lang='ja')
+            chapter.content = "".join(
+                f'<div id="episode_{episode_num}"><h3>{escape(episode_title)}</h3>{content}</div>'
+                for episode_num, episode_title, content, _ in self.bundle
+            )
+            self.book.add_item(chapter)
+        metrics.count("chapters", len(self.bundle))
+        self.chapters.append(chapter)
+        for episode_num, episode_title, _, episode in self.bundle:
+            self.entries.append(TocEntry(
+                f"{file_name}#episode_{episode_num}", episode_title, episode.get("chapter") or "",
+                f"episode_{episode_num}", episode["url"], episode["stamp"],
+            ))
+        self.bundle = []
+        self.bundle_size = 0
+
+    def flush(self) -> None:
+        """Finish the current volume and queue it to be written."""
+        self.close_bundle()
+        book, self.book = self.book, None
+        if book is None or not self.entries:
+            return
+        title = self.title or self.work_id
+        epub_path = self.output_dir / f"{title}.epub"
+        if self.options.splits:
+            volume_title = f"{title} {self.number:02d}"
+            if self.options.by_arc and self.entries[0].arc:
+                volume_title += f" {self.entries[0].arc}"
+            epub_path = self.output_dir / f"{title} {self.number:02d}.epub"
+        else:
+            volume_title = title
+        book.title = volume_title
+        book.set_unique_metadata("DC", "title", volume_title)
+        write_episode_index(book, [
+            {"url": entry.url, "stamp": entry.stamp, "file": entry.href, "title": entry.title} for entry in self.entries
+        ])
+        if self.stamp:
+            write_work_stamp(book, self.stamp)
+        book.toc = build_toc(self.entries, self.options.arc_toc)
+        book.add_item(epub.EpubNcx())
+        book.add_item(epub.EpubNav())
+        book.spine = ['nav'] + self.chapters
+        self.log(f"[INFO] Writing volume {self.number} ({len(self.entries)} episodes) to {epub_path}")
+        self.written.append(self.executor.submit(write_volume, book, epub_path))
+
+    def finish(self) -> List[Path]:
+        """Write the last volume, wait for every volume to be written and return their paths."""
+        try:
+            self.flush()
+            return [future.result() for future in self.written]
+        finally:
+            self.executor.shutdown()
+
+    def discard(self) -> None:
+        """Stop writing volumes of a download that failed."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,128 @@
+import queue
+import time
+import tkinter as tk
+from collections import deque
+from tkinter import ttk
+from typing import Callable, Deque, List, Optional, Tuple
+
+POLL_INTERVAL_MS = 100
+MAX_LOG_LINES = 2000
+# Seconds of progress the episode rate is averaged over
+RATE_WINDOW = 15.0
+
+
+class GuiEvents:
+    """Thread-safe channel from download threads to the Tk main loop.
+
+    Download threads only put events on a queue and never wait for the UI;
+    EventPump applies them from the main loop.
+    """
+
+    def __init__(self):
+        self.queue: "queue.SimpleQueue[Tuple[str, object]]" = queue.SimpleQueue()
+
+    def log(self, message: str) -> None:
+        self.queue.put(("log", message))
+
+    def progress(self, done: int, total: int) -> None:
+        """Report ``done`` episodes out of ``total`` (0 when the total isn't known)."""
+        self.queue.put(("progress", (done, total)))
+
+    def call(self, function: Callable[[], None]) -> None:
+        """Run ``function`` on the Tk main loop, after the events queued before it."""
+        self.queue.put(("call", function))
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class EventPump:
+    """Drain GuiEvents on a Tk timer into a log widget, a progress bar and a status label.
+
+    Log lines that arrived since the last tick are inserted at once and the
+    widget keeps only the last ``max_lines`` lines. Only the latest progress
+    report of a tick is shown, with the episode rate and ETA.
+    """
+
+    def __init__(
+        self,
+        root: tk.Misc,
+        events: GuiEvents,
+        log_text: tk.Text,
+        progress_bar: ttk.Progressbar,
+        status_var: tk.StringVar,
+        interval_ms: int = POLL_INTERVAL_MS,
+        max_lines: int = MAX_LOG_LINES,
+    ):
+        self.root = root
+        self.events = events
+        self.log_text = log_text
+        self.progress_bar = progress_bar
+        self.status_var = status_var
+        self.interval_ms = interval_ms
+        self.max_lines = max_lines
+        self.samples: Deque[Tuple[float, int]] = deque()
+        self.root.after(self.interval_ms, self.drain)
+
+    def reset_progress(self) -> None:
+        self.samples.clear()
+        self.progress_bar.configure(mode="determinate", maximum=1, value=0)
+
+    def drain(self) -> None:
+        lines: List[str] = []
+        progress: Optional[Tuple[int, int]] = None
+        while True:
+            try:
+                kind, payload = self.events.queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "log":
+                lines.append(payload)
+            elif kind == "progress":
+                progress = payload
+            else:
+                self.flush(lines, progress)
+                lines, progress = [], None
+                payload()
+        self.flush(lines, progress)
+        self.root.after(self.interval_ms, self.drain)
+
+    def flush(self, lines: List[str], progress: Optional[Tuple[int, int]]) -> None:
+        if lines:
+            self.append(lines)
+        if progress:
+            self.show_progress(*progress)
+
+    def append(self, lines: List[str]) -> None:
+        # Only follow the end of the log if the user hasn't scrolled up
+        following = self.log_text.yview()[1] >= 0.999
+        self.log_text.insert(tk.END, "\n".join(lines[-self.max_lines:]) + "\n")
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - self.max_lines
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+        if following:
+            self.log_text.see(tk.END)
+
+    def show_progress(self, done: int, total: int) -> None:
+        now = time.monotonic()
+        self.samples.append((now, done))
+        while len(self.samples) > 2 and now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+        first_time, first_done = self.samples[0]
+        rate = (done - first_done) / (now - first_time) if now > first_time else 0.0
+
+        if total:
+            self.progress_bar.configure(mode="determinate", maximum=total, value=done)
+            status = f"{done}/{total} episodes"
+            if rate > 0:
+                status += f" - {rate:.1f}/s - ETA {format_duration((total - done) / rate)}"
+        else:
+            self.progress_bar.configure(mode="indeterminate")
+            self.progress_bar.step()
+            status = f"{done} episodes"
+            if rate > 0:
+                status += f" - {rate:.1f}/s"
+        self.status_var.set(status)
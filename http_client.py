@@ -0,0 +1,503 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from download_metrics import metrics
+
+try:
+    import aiohttp
+except ImportError:  # the asyncio engine is optional
+    aiohttp = None
+
+try:
+    import brotli  # noqa: F401  (lets urllib3 decode "br" responses)
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+# Requests per second allowed for each host (0 disables the limit)
+DEFAULT_RATE_LIMITS = {
+    "kakuyomu.jp": 5.0,
+    "ncode.syosetu.com": 5.0,
+}
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = 30
+DEFAULT_ASYNC_CONCURRENCY = 64
+
+# Retries with jittered exponential backoff (or the server's Retry-After)
+DEFAULT_MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+RETRY_AFTER_CAP = 300.0
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Adaptive (AIMD) limit on requests in flight per host, and its circuit breaker
+LATENCY_FACTOR = 3.0
+DECREASE_INTERVAL = 1.0
+BREAKER_THRESHOLD = 8
+BREAKER_COOLDOWN = 60.0
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a host that keeps failing."""
+
+
+# Exceptions raised by AsyncHttpClient for network and HTTP errors
+ASYNC_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) if aiohttp else (asyncio.TimeoutError, CircuitOpenError)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number ``attempt`` (from 0)."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the delay in seconds requested by a Retry-After header."""
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(RETRY_AFTER_CAP, max(0.0, delay))
+
+
+class AdaptiveLimit:
+    """Additive-increase/multiplicative-decrease limit on the requests in flight to one host.
+
+    Every success grows the limit by about one per round of requests, unless
+    recent latency exceeds ``LATENCY_FACTOR`` times its long-run average.
+    Throttling, server errors and such slow responses halve it (at most once
+    per ``DECREASE_INTERVAL``).
+    After ``BREAKER_THRESHOLD`` failures in a row the circuit opens and
+    requests fail fast for ``BREAKER_COOLDOWN`` seconds, then it lets a single
+    request through and reopens if that one fails too.
+
+    Not thread-safe: callers serialize access.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = min(min_limit, self.max_limit)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.last_decrease = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def check_circuit(self, host: str, now: float) -> None:
+        if not self.open_until:
+            return
+        if now < self.open_until:
+            raise CircuitOpenError(f"{host} is failing; not sending requests for {self.open_until - now:.0f}s")
+        # Half open: one more failure reopens the circuit
+        self.open_until = 0.0
+        self.failures = BREAKER_THRESHOLD - 1
+        self.limit = float(self.min_limit)
+
+    def can_start(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def finished(self, ok: bool, latency: Optional[float], now: float) -> None:
+        self.in_flight -= 1
+        if ok and latency is not None:
+            self.failures = 0
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.baseline = latency if self.baseline is None else 0.98 * self.baseline + 0.02 * latency
+            if self.latency > LATENCY_FACTOR * self.baseline:
+                self.decrease(now)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            return
+        self.failures += 1
+        self.decrease(now)
+        if self.failures >= BREAKER_THRESHOLD:
+            self.open_until = now + BREAKER_COOLDOWN
+
+    def decrease(self, now: float) -> None:
+        if now - self.last_decrease < DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit / 2)
+
+
+class TokenBucket:
+    """Thread-safe token bucket that allows ``rate`` requests per second on average."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available, then take it."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with metrics.stage("connect"):
+            super().connect()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with metrics.stage("connect"):
+            super().connect()
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter recording the time spent opening connections (DNS, TCP and TLS)."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+class HttpClient:
+    """Pooled keep-alive HTTP session shared by the downloaders.
+
+    One user agent is picked per client and used for every request it makes.
+    Requests are throttled per host by a token bucket, their number in flight
+    adapts to how the host responds (see AdaptiveLimit), and network errors,
+    429 and 5xx responses are retried up to ``max_retries`` times.
+    """
+
+    def __init__(
+        self,
+        user_agents: List[str],
+        pool_size: int = DEFAULT_POOL_SIZE,
+        rate_limits: Optional[Dict[str, float]] = None,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        log: Optional[Callable[[str], None]] = None,
+    ):
+        self.user_agent = random.choice(user_agents)
+        self.timeout = timeout
+        self.pool_size = max(1, pool_size)
+        self.max_retries = max(0, max_retries)
+        self.log = log or print
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        if rate_limits:
+            self.rate_limits.update(rate_limits)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+        self.limits: Dict[str, AdaptiveLimit] = {}
+        self.limits_condition = threading.Condition()
+
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=max(1, pool_size), pool_maxsize=max(1, pool_size))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "User-Agent": self.user_agent,
+            "Accept-Encoding": ACCEPT_ENCODING,
+        })
+
+    def bucket_for(self, host: str) -> Optional[TokenBucket]:
+        """Return the token bucket for a host, or None if it isn't rate limited."""
+        rate = self.rate_limits.get(host, 0)
+        if rate <= 0:
+            return None
+        with self.buckets_lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(rate)
+            return bucket
+
+    def start_request(self, host: str) -> AdaptiveLimit:
+        """Wait until the host's adaptive limit allows another request in flight."""
+        with self.limits_condition:
+            limit = self.limits.get(host)
+            if limit is None:
+                limit = self.limits[host] = AdaptiveLimit(self.pool_size)
+            while True:
+                limit.check_circuit(host, time.monotonic())
+                if limit.can_start():
+                    limit.in_flight += 1
+                    return limit
+                self.limits_condition.wait(timeout=1.0)
+
+    def finish_request(self, limit: AdaptiveLimit, ok: bool, latency: Optional[float] = None) -> None:
+        with self.limits_condition:
+            limit.finished(ok, latency, time.monotonic())
+            self.limits_condition.notify_all()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Send a GET request through the pooled session, retrying transient failures.
+
+        After the last retry the final 429/5xx response is returned (or the
+        network error raised) for the caller to handle.
+        """
+        host = urlsplit(url).hostname or ""
+        bucket = self.bucket_for(host)
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.max_retries + 1):
+            with metrics.stage("wait"):
+                limit = self.start_request(host)
+                if bucket:
+                    bucket.acquire()
+            metrics.count("requests")
+            started = time.monotonic()
+            response = None
+            latency = None
+            try:
+                with metrics.stage("fetch"):
+                    response = self.session.get(url, **kwargs)
+                latency = time.monotonic() - started
+            except requests.exceptions.RequestException as exc:
+                if attempt == self.max_retries:
+                    metrics.count("failed_requests")
+                    raise
+                delay = backoff_delay(attempt)
+                self.log(f"[WARN] {url}: {type(exc).__name__}, retrying in {delay:.1f}s")
+            finally:
+                # The slot is freed however the request ended, or the host would stay at its limit for good
+                self.finish_request(limit, response is not None and response.status_code not in RETRY_STATUSES, latency)
+            if response is not None:
+                # The body is read before session.get returns; elapsed stops at the headers
+                metrics.record("ttfb", response.elapsed.total_seconds())
+                metrics.record("body", max(0.0, latency - response.elapsed.total_seconds()))
+                metrics.count("bytes", len(response.content))
+                failed = response.status_code in RETRY_STATUSES
+                if not failed or attempt == self.max_retries:
+                    if response.status_code >= 400:
+                        metrics.count("failed_requests")
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                self.log(f"[WARN] {url}: HTTP {response.status_code}, retrying in {delay:.1f}s")
+                response.close()
+            metrics.count("retries")
+            with metrics.stage("wait"):
+                time.sleep(delay)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "HttpClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class AsyncTokenBucket:
+    """Token bucket for coroutines sharing one event loop."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available, then take it."""
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncHttpClient:
+    """aiohttp counterpart of HttpClient for the asyncio download engine.
+
+    ``concurrency`` caps the number of open connections; any number of
+    requests may be awaited at once and queue for a free connection.
+    """
+
+    def __init__(
+        self,
+        user_agents: List[str],
+        concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+        rate_limits: Optional[Dict[str, float]] = None,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        log: Optional[Callable[[str], None]] = None,
+    ):
+        if aiohttp is None:
+            raise RuntimeError("The asyncio engine requires aiohttp (pip install aiohttp)")
+        self.user_agent = random.choice(user_agents)
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.max_retries = max(0, max_retries)
+        self.log = log or print
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        if rate_limits:
+            self.rate_limits.update(rate_limits)
+        self.buckets: Dict[str, AsyncTokenBucket] = {}
+        self.limits: Dict[str, AdaptiveLimit] = {}
+        self.limits_condition: Optional[asyncio.Condition] = None
+        self.session = None
+
+    async def __aenter__(self) -> "AsyncHttpClient":
+        self.limits_condition = asyncio.Condition()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            headers={"User-Agent": self.user_agent},
+            trace_configs=[timing_trace_config()],
+            # No total timeout: requests may wait a long time for a free connection
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+
+    def bucket_for(self, host: str) -> Optional[AsyncTokenBucket]:
+        rate = self.rate_limits.get(host, 0)
+        if rate <= 0:
+            return None
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = AsyncTokenBucket(rate)
+        return bucket
+
+    async def start_request(self, host: str) -> AdaptiveLimit:
+        async with self.limits_condition:
+            limit = self.limits.get(host)
+            if limit is None:
+                limit = self.limits[host] = AdaptiveLimit(self.concurrency)
+            while True:
+                limit.check_circuit(host, time.monotonic())
+                if limit.can_start():
+                    limit.in_flight += 1
+                    return limit
+                try:
+                    await asyncio.wait_for(self.limits_condition.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def finish_request(self, limit: AdaptiveLimit, ok: bool, latency: Optional[float] = None) -> None:
+        async with self.limits_condition:
+            limit.finished(ok, latency, time.monotonic())
+            self.limits_condition.notify_all()
+
+    async def get_text(self, url: str, allow_missing: bool = False) -> Optional[str]:
+        """Return the decoded body of a GET request, retrying transient failures.
+
+        With ``allow_missing`` a 404 returns None instead of raising.
+        """
+        host = urlsplit(url).hostname or ""
+        bucket = self.bucket_for(host)
+        for attempt in range(self.max_retries + 1):
+            with metrics.stage("wait"):
+                limit = await self.start_request(host)
+                if bucket:
+                    await bucket.acquire()
+            metrics.count("requests")
+            started = time.monotonic()
+            response = None
+            latency = None
+            try:
+                with metrics.stage("fetch"):
+                    async with self.session.get(url) as response:
+                        metrics.record("ttfb", time.monotonic() - started)
+                        text = None
+                        if response.status < 400:
+                            with metrics.stage("body"):
+                                body = await response.read()
+                            metrics.count("bytes", len(body))
+                            text = await response.text()
+                latency = time.monotonic() - started
+            except ASYNC_ERRORS as exc:
+                response = None
+                if attempt == self.max_retries:
+                    metrics.count("failed_requests")
+                    raise
+                delay = backoff_delay(attempt)
+                self.log(f"[WARN] {url}: {type(exc).__name__}, retrying in {delay:.1f}s")
+            finally:
+                # The slot is freed however the request ended, or the host would stay at its limit for good
+                await self.finish_request(limit, latency is not None and response.status not in RETRY_STATUSES, latency)
+            if response is not None:
+                failed = response.status in RETRY_STATUSES
+                if not failed or attempt == self.max_retries:
+                    if allow_missing and response.status == 404:
+                        return None
+                    if response.status >= 400:
+                        metrics.count("failed_requests")
+                    response.raise_for_status()
+                    return text
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                self.log(f"[WARN] {url}: HTTP {response.status}, retrying in {delay:.1f}s")
+            metrics.count("retries")
+            with metrics.stage("wait"):
+                await asyncio.sleep(delay)
+
+
+def timing_trace_config() -> "aiohttp.TraceConfig":
+    """Return an aiohttp trace config recording DNS lookup and connection times."""
+
+    def timer(stage: str):
+        async def start(session, context, params):
+            setattr(context, stage, time.perf_counter())
+
+        async def end(session, context, params):
+            metrics.record(stage, time.perf_counter() - getattr(context, stage))
+        return start, end
+
+    trace_config = aiohttp.TraceConfig()
+    dns_start, dns_end = timer("dns")
+    trace_config.on_dns_resolvehost_start.append(dns_start)
+    trace_config.on_dns_resolvehost_end.append(dns_end)
+    connect_start, connect_end = timer("connect")
+    trace_config.on_connection_create_start.append(connect_start)
+    trace_config.on_connection_create_end.append(connect_end)
+    return trace_config
+
+
+def parse_rate_limit(value: str) -> Dict[str, float]:
+    """Parse a ``host=rate`` command line option into a rate limit mapping."""
+    host, _, rate = value.partition("=")
+    if not rate:
+        raise ValueError(f"expected HOST=RATE, got {value!r}")
+    return {host.strip(): float(rate)}
@@ -2,134 +2,504 @@ import requests
 from bs4 import BeautifulSoup
 import json
 import argparse
-from typing import Optional, List
+from typing import Any, Callable, Iterator, Optional, List, Dict, Sequence, Tuple
 from pathlib import Path
-import random
+import asyncio
+import sqlite3
+from concurrent.futures import Executor
 from ebooklib import epub
 
+from catalog import CATALOG_NAME, Catalog, CatalogEntry
+from download_engine import DownloadEngine, Episode, SiteAdapter, check_episode_range, episode_range, range_title
+from download_metrics import metrics, profiled
+from episode_cache import DEFAULT_CACHE_DIR, EpisodeCache
+from epub_images import DEFAULT_IMAGE_QUALITY, ImageOptions
+from epub_stream import StreamingEpubBook
+from epub_volumes import VolumeOptions
+from epub_update import write_episode_index
+from http_client import ASYNC_ERRORS, DEFAULT_ASYNC_CONCURRENCY, DEFAULT_MAX_RETRIES, AsyncHttpClient, HttpClient, parse_rate_limit
+from output_sinks import FORMATS, SinkOptions
+from page_parser import BACKENDS, ElementStrainer, create_parse_pool, make_soup, parse_in_async, set_backend
+
+KAKUYOMU_ROOT = "https://kakuyomu.jp"
+DEFAULT_WORKERS = 8
+# Times the work page is loaded when it comes back without the first episode link
+WORK_PAGE_ATTEMPTS = 3
+
+# Containers of the table of contents markup, which leave out the first and latest episode buttons above it
+TOC_SELECTOR = '[class*="WorkTocSection"], [class*="widget-toc"], #table-of-contents'
+
+# Episode pages are only parsed for the title, the body and the next episode link
+EPISODE_STRAINER = ElementStrainer(
+    ids=["contentMain-readNextEpisode"],
+    classes=["widget-episodeTitle", "widget-episodeBody"],
+)
+
+
+def parse_table_of_contents(soup: BeautifulSoup, book_id: str) -> List[Dict[str, str]]:
+    """Collect every episode of a work, in reading order, from its work page.
+
+    The embedded ``__NEXT_DATA__`` page state is preferred; the table of
+    contents markup is used when the page state is missing or unreadable.
+    """
+    episodes = []
+    next_data = soup.select_one("script#__NEXT_DATA__")
+    if next_data and next_data.string:
+        try:
+            state = json.loads(next_data.string)["props"]["pageProps"]["__APOLLO_STATE__"]
+        except (ValueError, KeyError, TypeError):
+            state = {}
+        work = state.get(f"Work:{book_id}") or {}
+        for toc_ref in work.get("tableOfContents") or []:
+            toc = state.get((toc_ref or {}).get("__ref"), {})
+            chapter = state.get((toc.get("chapter") or {}).get("__ref"), {})
+            for episode_ref in toc.get("episodeUnions") or []:
+                episode = state.get((episode_ref or {}).get("__ref"), {})
+                if not episode.get("id"):
+                    continue
+                episodes.append({
+                    "url": f"{KAKUYOMU_ROOT}/works/{book_id}/episodes/{episode['id']}",
+                    "title": episode.get("title") or "",
+                    "chapter": chapter.get("title") or "",
+                    "stamp": episode.get("publishedAt") or "",
+                })
+
+    if not episodes:
+        link_selector = f'a[href*="/works/{book_id}/episodes/"]'
+        links = [link for toc in soup.select(TOC_SELECTOR) for link in toc.select(link_selector)] or soup.select(link_selector)
+        # Buttons to the first and latest episodes come before the table of contents, so an episode
+        # linked more than once takes the place of its last link
+        last_links = {}
+        for link in links:
+            href = link["href"].split("#")[0].split("?")[0]
+            last_links.pop(href, None)
+            last_links[href] = link
+        for href, link in last_links.items():
+            url = href if href.startswith("http") else f"{KAKUYOMU_ROOT}{href}"
+            published = link.find("time")
+            stamp = published.get("datetime", "") if published else ""
+            episodes.append({"url": url, "title": link.get_text(strip=True), "chapter": "", "stamp": stamp})
+    return episodes
+
+
+def parse_episode(soup: BeautifulSoup, episode_num: int) -> Tuple[str, Optional[str]]:
+    """Return the episode title and prettified body of an episode page."""
+    episode_title_element = soup.select_one(".widget-episodeTitle.js-vertical-composition-item")
+    episode_title = episode_title_element.text.strip() if episode_title_element else f"Episode {episode_num}"
+
+    episode_content = soup.select_one(".widget-episodeBody.js-episode-body")
+    return episode_title, episode_content.prettify() if episode_content else None
+
+
+def parse_title(soup: BeautifulSoup) -> Optional[str]:
+    """Return the work title from a work page."""
+    title_element = soup.select_one("#app > div.DefaultTemplate_fixed__DLjCr.DefaultTemplate_isWeb__QRPlB.DefaultTemplate_fixedGlobalFooter___dZog > div > div > main > div.NewBox_box__45ont.NewBox_padding-px-4l__Kx_xT.NewBox_padding-pt-7l__Czm59 > div > div.Gap_size-2l__HWqrr.Gap_direction-y__Ee6Qv > div.Gap_size-3s__fjxCP.Gap_direction-y__Ee6Qv > h1 > span > a")
+    return title_element.text if title_element else None
+
+
+def parse_work_page(html: str, book_id: str) -> Tuple[Optional[str], List[Dict[str, str]]]:
+    """Return the title and table of contents of a work page."""
+    soup = make_soup(html)
+    return parse_title(soup), parse_table_of_contents(soup, book_id)
+
+
+def parse_episode_html(html: str, episode_num: int) -> Tuple[str, Optional[str]]:
+    """Parse an episode page and return its title and prettified body."""
+    return parse_episode(make_soup(html, EPISODE_STRAINER), episode_num)
+
+
+def parse_episode_with_next(html: str, episode_num: int) -> Tuple[str, Optional[str], Optional[str]]:
+    """Parse an episode page and return its title, prettified body and the next episode URL."""
+    soup = make_soup(html, EPISODE_STRAINER)
+    next_link = soup.select_one("#contentMain-readNextEpisode")
+    next_url = f"{KAKUYOMU_ROOT}{next_link['href']}" if next_link else None
+    return parse_episode(soup, episode_num) + (next_url,)
+
+
+def create_book(book_id: str, title: str, stream: bool = False, epub_folder: Path = Path("epub")) -> epub.EpubBook:
+    """Create an empty EPUB book for a work.
+
+    With ``stream`` the book writes its chapters into a temporary file in
+    ``epub_folder`` as they are added.
+    """
+    book = StreamingEpubBook(epub_folder) if stream else epub.EpubBook()
+    book.set_identifier(book_id)
+    book.set_title(title)
+    book.set_language('ja')
+
+    # Add a default author
+    book.add_author("Unknown Author")
+    return book
+
+
+def get_epub_path(title: str, epub_folder: Path = Path("epub")) -> Path:
+    return epub_folder / f"{title}.epub"
+
+
+def save_book(
+    book: epub.EpubBook,
+    chapters: List[epub.EpubHtml],
+    title: str,
+    epub_folder: Path = Path("epub"),
+    records: Optional[List[Dict[str, str]]] = None,
+) -> Path:
+    """Add navigation for the chapters and write the book into ``epub_folder``.
+
+    ``records`` (the source ``url`` and ``stamp`` of every chapter) are
+    embedded so the EPUB can be updated in place later.
+    """
+    with metrics.stage("write"):
+        if records:
+            write_episode_index(book, records)
+
+        epub_path = get_epub_path(title, epub_folder)
+        if isinstance(book, StreamingEpubBook):
+            return book.finish(epub_path, chapters)
+
+        # Add chapters to the Table of Contents
+        book.toc = tuple(epub.Link(chapter.file_name, chapter.title, chapter.file_name) for chapter in chapters)
+
+        # Add navigation files
+        book.add_item(epub.EpubNcx())
+        book.add_item(epub.EpubNav())
+
+        # Define spine (reading order)
+        book.spine = ['nav'] + chapters
+
+        # make or check epub folder
+        epub_folder.mkdir(parents=True, exist_ok=True)
+        epub.write_epub(epub_path, book)
+        return epub_path
+
+
+def add_chapter(book: epub.EpubBook, episode_num: int, episode_title: str, content: str) -> epub.EpubHtml:
+    """Create a chapter for an episode and add it to the book."""
+    with metrics.stage("build"):
+        chapter = epub.EpubHtml(title=episode_title, file_name=f'chapter_{episode_num}.xhtml', lang='ja')
+        chapter.content = f"<h3>{episode_title}</h3>{content}"
+        book.add_item(chapter)
+    metrics.count("chapters")
+    return chapter
+
+
+class KakuyomuAdapter(SiteAdapter):
+    """Kakuyomu URLs, table of contents and episode pages for the download engine."""
+
+    site = "kakuyomu"
+    parse_page = staticmethod(parse_episode_html)
+    parse_page_with_next = staticmethod(parse_episode_with_next)
+
+    def work_url(self, book_id: str) -> str:
+        return f"{KAKUYOMU_ROOT}/works/{book_id}"
+
+    def list_episodes(self, client: HttpClient, book_id: str, log: Callable[[str], None]) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """Return the title and every episode of the table of contents, read in one request."""
+        response = client.get(self.work_url(book_id))
+        response.raise_for_status()
+        return parse_work_page(response.text, book_id)
+
+    def first_episode_url(self, client: HttpClient, book_id: str, log: Callable[[str], None]) -> Optional[str]:
+        """Return the URL of the first episode, reloading the work page if the link is missing."""
+        for attempt in range(1, WORK_PAGE_ATTEMPTS + 1):
+            response = client.get(self.work_url(book_id))
+            response.raise_for_status()
+            soup = make_soup(response.text)
+            first_link = soup.select_one("#app > div.DefaultTemplate_fixed__DLjCr.DefaultTemplate_isWeb__QRPlB.DefaultTemplate_fixedGlobalFooter___dZog > div > div > main > div.NewBox_box__45ont.NewBox_padding-px-4l__Kx_xT.NewBox_padding-pt-7l__Czm59 > div > div.Gap_size-2l__HWqrr.Gap_direction-y__Ee6Qv > div.Gap_size-m__thYv4.Gap_direction-y__Ee6Qv > div > a")
+            if first_link:
+                return f"{KAKUYOMU_ROOT}{first_link['href']}"
+            if attempt < WORK_PAGE_ATTEMPTS:
+                log(f"[LOG] First episode link missing, reloading the work page ({attempt}/{WORK_PAGE_ATTEMPTS - 1})")
+        return None
+
+    def episode_url(self, client: HttpClient, book_id: str, episode_num: int, log: Callable[[str], None]) -> Optional[str]:
+        """Look an episode up in the table of contents, so the next links are followed from there."""
+        _, episodes = self.list_episodes(client, book_id, log)
+        return episodes[episode_num - 1]["url"] if len(episodes) >= episode_num else None
+
+    def unpack(self, result: Sequence[Any]) -> Tuple[Optional[str], str, Optional[str]]:
+        episode_title, content = result
+        return None, episode_title, content
+
+    def create_book(self, book_id: str, title: Optional[str], stream: bool, output_dir: Path) -> epub.EpubBook:
+        return create_book(book_id, title, stream, output_dir)
+
+    def add_chapter(self, book: epub.EpubBook, episode_num: int, episode_title: str, content: str) -> epub.EpubHtml:
+        return add_chapter(book, episode_num, episode_title, content)
+
+    def save_book(
+        self,
+        book: epub.EpubBook,
+        chapters: List[epub.EpubHtml],
+        title: str,
+        output_dir: Path,
+        records: List[Dict[str, str]],
+    ) -> Path:
+        return save_book(book, chapters, title, output_dir, records)
+
+
 class KakuyomuApp:
-    def __init__(self, book_id: Optional[str] = None):
-        print("Initializing Kakuyomu App...")
+    def __init__(
+        self,
+        book_id: Optional[str] = None,
+        log: Optional[Callable[[str], None]] = None,
+        output_dir: Optional[Path] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        self.log = log or print
+        # Called with the episodes done and the total (0 if unknown) as they are added
+        self.progress = progress or (lambda done, total: None)
+        self.output_dir = Path(output_dir) if output_dir else Path("epub")
+        self.log("Initializing Kakuyomu App...")
         self.book_id = book_id
         if book_id is None:
-            print("Book ID not found")
+            self.log("Book ID not found")
         else:
-            print(f"Book ID: {book_id}")
+            self.log(f"Book ID: {book_id}")
 
     def get_base_url(self, book_id: Optional[str] = None) -> Optional[str]:
         """Generate base URL for the book."""
         book_id = book_id or self.book_id
         if not book_id:
-            print("Book id doesn't set.")
+            self.log("Book id doesn't set.")
             return None
-        return f"https://kakuyomu.jp/works/{book_id}"
+        return f"{KAKUYOMU_ROOT}/works/{book_id}"
+
+    def download(
+        self,
+        user_agents: List[str],
+        book_id: Optional[str] = None,
+        workers: int = DEFAULT_WORKERS,
+        sequential: bool = False,
+        rate_limits: Optional[Dict[str, float]] = None,
+        cache: Optional[EpisodeCache] = None,
+        update: bool = False,
+        stream: bool = False,
+        parse_executor: Optional[Executor] = None,
+        resume: bool = False,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        images: Optional[ImageOptions] = None,
+        volumes: Optional[VolumeOptions] = None,
+        sink: Optional[SinkOptions] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+        catalog: Optional[Catalog] = None,
+    ) -> bool:
+        """Download all episodes of a book and save as an EPUB file.
 
-    def download(self, user_agents: List[str], book_id: Optional[str] = None) -> bool:
-        """Download all episodes of a book and save as an EPUB file."""
+        Runs the download engine: episodes are listed from the table of
+        contents and fetched by up to ``workers`` threads. With ``sequential``
+        (or when the table of contents can't be read) the next episode links
+        are followed one page at a time. Episodes unchanged since they were
+        stored in ``cache`` aren't parsed again. With ``update``, chapters of an
+        EPUB previously written for the book are reused and only new or changed
+        episodes are fetched. With ``stream``, chapters are written to disk as
+        they arrive instead of kept in memory. Episode pages are parsed in
+        ``parse_executor`` (such as the process pool from ``create_parse_pool``)
+        when given, leaving only I/O to this process. Finished episodes are
+        journaled as they arrive; with ``resume``, those of an interrupted
+        download of the book aren't fetched again. Failed requests are retried
+        up to ``max_retries`` times. With ``images`` the images of the chapters
+        are downloaded and embedded, with ``volumes`` the book is split into
+        volumes, and with ``sink`` the episodes are written to a JSONL, text
+        or HTML file instead of an EPUB. Only the episodes ``start`` to ``end``
+        (counted from 1), or the ``latest`` episodes, are downloaded when given.
+        Finished downloads are recorded in ``catalog``.
+        """
         book_id = book_id or self.book_id
         if not book_id:
-            print("Book id doesn't set.")
+            self.log("Book id doesn't set.")
             return False
 
-        base_url = self.get_base_url(book_id)
-        print(f"[INFO] base_url: {base_url}")
+        self.log(f"[INFO] base_url: {self.get_base_url(book_id)}")
 
-        # Randomly select a user agent
-        user_agent = random.choice(user_agents)
-        print(f"[INFO] Use userAgent: {user_agent}")
+        # One pooled session (and one randomly selected user agent) per download
+        with HttpClient(user_agents, pool_size=workers, rate_limits=rate_limits, max_retries=max_retries, log=self.log) as client:
+            self.log(f"[INFO] Use userAgent: {client.user_agent}")
+            engine = DownloadEngine(
+                KakuyomuAdapter(), client, self.output_dir, workers, cache, update, stream, parse_executor,
+                resume=resume, log=self.log, progress=self.progress, images=images, volumes=volumes, sink=sink,
+                catalog=catalog,
+            )
+            try:
+                return engine.download(book_id, sequential, start, end, latest)
+            except requests.exceptions.RequestException as exc:
+                self.log(f"[ERROR] Request failed: {exc}")
+                return False
 
-        headers = {'User-Agent': user_agent}
+    def iter_episodes(
+        self,
+        user_agents: List[str],
+        book_id: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        workers: int = DEFAULT_WORKERS,
+        sequential: bool = False,
+        rate_limits: Optional[Dict[str, float]] = None,
+        cache: Optional[EpisodeCache] = None,
+        parse_executor: Optional[Executor] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        latest: Optional[int] = None,
+    ) -> Iterator[Episode]:
+        """Yield the episodes ``start`` to ``end`` (counted from 1), or the ``latest`` episodes, of a book as soon as each one is ready.
 
-        # Get first page
-        response = requests.get(base_url, headers=headers)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        Episodes are fetched by the same engine as ``download``, but handed to
+        the caller as ``Episode`` records in reading order instead of being
+        written to an EPUB. Failed requests raise
+        ``requests.exceptions.RequestException`` and a book whose pages can't
+        be read raises ``DownloadError``.
+        """
+        book_id = book_id or self.book_id
+        if not book_id:
+            self.log("Book id doesn't set.")
+            return
+
+        with HttpClient(user_agents, pool_size=workers, rate_limits=rate_limits, max_retries=max_retries, log=self.log) as client:
+            engine = DownloadEngine(
+                KakuyomuAdapter(), client, self.output_dir, workers, cache, parse_executor=parse_executor,
+                log=self.log, progress=self.progress,
+            )
+            yield from engine.iter_episodes(book_id, start, end, sequential, latest)
 
-        # Get title
-        title_element = soup.select_one("#app > div.DefaultTemplate_fixed__DLjCr.DefaultTemplate_isWeb__QRPlB.DefaultTemplate_fixedGlobalFooter___dZog > div > div > main > div.NewBox_box__45ont.NewBox_padding-px-4l__Kx_xT.NewBox_padding-pt-7l__Czm59 > div > div.Gap_size-2l__HWqrr.Gap_direction-y__Ee6Qv > div.Gap_size-3s__fjxCP.Gap_direction-y__Ee6Qv > h1 > span > a")
-        if not title_element:
-            print("[ERROR] Could not find title")
+    async def download_async(
+        self,
+        user_agents: List[str],
+        book_id: Optional[str] = None,
+        concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+        rate_limits: Optional[Dict[str, float]] = None,
+        executor: Optional[Executor] = None,
+        parse_executor: Optional[Executor] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+        catalog: Optional[Catalog] = None,
+    ) -> bool:
+        """Download a book on the running event loop and save it as an EPUB file.
+
+        Every episode request is in flight at once, limited to ``concurrency``
+        open connections. Parsing and EPUB writing run in ``executor`` (the
+        loop's default executor if None) so they don't block the loop; episode
+        pages are parsed in ``parse_executor`` instead when given. Only the
+        episodes ``start`` to ``end``, or the ``latest`` episodes, are
+        downloaded when given. The download is recorded in ``catalog``.
+        """
+        book_id = book_id or self.book_id
+        if not book_id:
+            self.log("Book id doesn't set.")
             return False
-            
-        title = title_element.text
-        print(f"[INFO] title: {title}")
-
-        # Create an EPUB book
-        book = epub.EpubBook()
-        book.set_identifier(book_id)
-        book.set_title(title)
-        book.set_language('ja')
-
-        # Add a default author
-        book.add_author("Unknown Author")
-
-        # Get first episode link
-        print("[LOG] start getting url...")
-        first_link = soup.select_one("#app > div.DefaultTemplate_fixed__DLjCr.DefaultTemplate_isWeb__QRPlB.DefaultTemplate_fixedGlobalFooter___dZog > div > div > main > div.NewBox_box__45ont.NewBox_padding-px-4l__Kx_xT.NewBox_padding-pt-7l__Czm59 > div > div.Gap_size-2l__HWqrr.Gap_direction-y__Ee6Qv > div.Gap_size-m__thYv4.Gap_direction-y__Ee6Qv > div > a")
-        
-        if not first_link:
-            print("[ERROR] Could not find first episode link")
-            return self.download(user_agents)
-
-        first_url = f"https://kakuyomu.jp{first_link['href']}"
-        print(f"[INFO] First url: {first_url}")
-
-        # Download all episodes
-        current_url = first_url
-        chapters = []
-        episode_num = 1
-
-        while True:
-            print(f"[LOG] Downloading episode {episode_num}")
-            
-            response = requests.get(current_url, headers=headers)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Get episode title
-            episode_title_element = soup.select_one(".widget-episodeTitle.js-vertical-composition-item")
-            episode_title = episode_title_element.text.strip() if episode_title_element else f"Episode {episode_num}"
-
-            # Get episode content
-            episode_content = soup.select_one(".widget-episodeBody.js-episode-body")
-            if episode_content:
-                # Create a chapter
-                chapter = epub.EpubHtml(title=episode_title, file_name=f'chapter_{episode_num}.xhtml', lang='ja')
-                chapter.content = f"<h3>{episode_title}</h3>{episode_content.prettify()}"
-                book.add_item(chapter)
-                chapters.append(chapter)  # Collect chapters for navigation
-            
-            # Get next episode link
-            next_link = soup.select_one("#contentMain-readNextEpisode")
-            if not next_link:
-                print("[LOG] No more episodes found")
-                break
-                
-            current_url = f"https://kakuyomu.jp{next_link['href']}"
-            episode_num += 1
 
-        # Add chapters to the Table of Contents
-        book.toc = tuple(epub.Link(chapter.file_name, chapter.title, chapter.file_name) for chapter in chapters)
+        loop = asyncio.get_running_loop()
+        async with AsyncHttpClient(user_agents, concurrency=concurrency, rate_limits=rate_limits, max_retries=max_retries) as client:
+            self.log(f"[INFO] Use userAgent: {client.user_agent}")
+            try:
+                html = await client.get_text(self.get_base_url(book_id))
+                title, episodes = await loop.run_in_executor(executor, parse_work_page, html, book_id)
+                if not title:
+                    self.log("[ERROR] Could not find title")
+                    return False
+                if not episodes:
+                    self.log("[ERROR] Could not read the table of contents")
+                    return False
+                self.log(f"[INFO] title: {title}")
+                self.log(f"[INFO] Found {len(episodes)} episodes in table of contents")
+                first, last = episode_range(len(episodes), start, end, latest)
+                if first > last:
+                    self.log(f"[ERROR] The work has only {len(episodes)} episodes")
+                    return False
+                count = len(episodes)
+                work_title = title
+                if first > 1 or last < count:
+                    self.log(f"[INFO] Episodes {first} to {last}")
+                    title = range_title(title, first, last)
+                    episodes = episodes[first - 1:last]
 
-        # Add navigation files
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
+                async def fetch(episode_num: int, episode: Dict[str, str]) -> Tuple[str, Optional[str]]:
+                    self.log(f"[LOG] Downloading episode {episode_num}")
+                    episode_html = await client.get_text(episode["url"])
+                    return await parse_in_async(parse_executor or executor, parse_episode_html, episode_html, episode_num)
 
-        # Define spine (reading order)
-        book.spine = ['nav'] + chapters
+                results = await asyncio.gather(*(
+                    fetch(episode_num, episode) for episode_num, episode in enumerate(episodes, start=first)
+                ))
+            except ASYNC_ERRORS as exc:
+                self.log(f"[ERROR] Request failed: {exc}")
+                return False
 
-        # Save the book
-        # make or check epub folder
-        epub_folder = Path("epub")
-        epub_folder.mkdir(exist_ok=True)
-        epub_path = epub_folder / f"{title}.epub"
-        epub.write_epub(epub_path, book)
-        print(f"[INFO] Successfully saved to {epub_path}")
+        book = create_book(book_id, title)
+        chapters = []
+        records = []
+        entries = []
+        for episode_num, (episode, (episode_title, content)) in enumerate(zip(episodes, results), start=first):
+            if content:
+                if catalog:
+                    entries.append(CatalogEntry.from_episode(Episode(episode_num, episode_title, episode["url"], content)))
+                chapter = add_chapter(book, episode_num, episode_title, content)
+                chapters.append(chapter)
+                records.append({"url": episode["url"], "stamp": episode["stamp"], "file": chapter.file_name, "title": chapter.title})
+        epub_path = await loop.run_in_executor(executor, save_book, book, chapters, title, self.output_dir, records)
+        self.log(f"[INFO] Successfully saved to {epub_path}")
+        if catalog:
+            try:
+                catalog.record(KakuyomuAdapter.site, book_id, work_title, None, [epub_path], entries, count if title == work_title else None)
+            except sqlite3.Error as exc:
+                self.log(f"[WARN] Could not record {book_id} in the catalog: {exc}")
         return True
 
 def main():
     parser = argparse.ArgumentParser(description='Download stories from Kakuyomu')
     parser.add_argument('mode', nargs='?', help='Operation mode (install)')
     parser.add_argument('book_id', nargs='?', help='Kakuyomu book ID')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of episodes fetched in parallel')
+    parser.add_argument('--sequential', action='store_true', help='Follow next episode links one page at a time')
+    parser.add_argument('--from', dest='from_episode', type=int, metavar='N', help='First episode to download (counted from 1)')
+    parser.add_argument('--to', dest='to_episode', type=int, metavar='N', help='Last episode to download')
+    parser.add_argument('--latest', type=int, metavar='N', help='Download only the last N episodes')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Use the asyncio engine (requires aiohttp)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_ASYNC_CONCURRENCY, help='Open connections used by the asyncio engine')
+    parser.add_argument('--processes', type=int, default=0, help='Parse episode pages in this many worker processes (0 parses in-process)')
+    parser.add_argument('--parser', choices=['auto', *BACKENDS], default='auto', help='HTML parser backend (auto picks lxml when installed)')
+    parser.add_argument('--stream', action='store_true', help='Write chapters to disk as they arrive to keep memory flat')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted download from its journal')
+    parser.add_argument('--update', action='store_true', help='Only fetch new or changed episodes of an existing EPUB')
+    parser.add_argument('--volume-episodes', type=int, help='Split the work into volumes of at most this many episodes')
+    parser.add_argument('--volume-size', type=float, help='Split the work into volumes of at most this many megabytes')
+    parser.add_argument('--volume-by-arc', action='store_true', help="Start a new volume at every arc (chapter) of the work's table of contents")
+    parser.add_argument('--bundle-size', type=int, help='Bundle consecutive episodes of an arc into files of up to this many kilobytes')
+    parser.add_argument('--arc-toc', action='store_true', help='Nest the table of contents by arc')
+    parser.add_argument('--format', choices=FORMATS, default='epub', help='Output an EPUB, or one JSONL, text or HTML file written as the episodes arrive')
+    parser.add_argument('--zstd', action='store_true', help='Compress JSONL output with zstd (requires zstandard)')
+    parser.add_argument('--strip-ruby', action='store_true', help='Drop ruby readings from text and JSONL output instead of writing them as |base《reading》')
+    parser.add_argument('--images', action='store_true', help='Download the illustrations of the chapters and embed them in the EPUB')
+    parser.add_argument('--image-max-size', type=int, help='Scale embedded images down to this many pixels on the longest edge (requires Pillow)')
+    parser.add_argument('--image-quality', type=int, help=f'Recompress embedded images as JPEG of this quality (requires Pillow, default {DEFAULT_IMAGE_QUALITY} when scaling)')
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR, help='Directory of the episode cache')
+    parser.add_argument('--no-cache', action='store_true', help='Download and parse every episode again')
+    parser.add_argument('--no-catalog', action='store_true', help=f'Don\'t record the download in {CATALOG_NAME} in the output directory')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='Retries of a request after network errors, 429 or 5xx responses')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='HOST=RATE', help='Requests per second allowed for a host (0 disables the limit)')
+    parser.add_argument('--metrics', type=Path, help='Write the time spent in each download stage to this JSON file')
+    parser.add_argument('--profile', type=Path, help='Profile the download with cProfile and write the stats to this file')
     args = parser.parse_args()
+    if args.latest and (args.from_episode or args.to_episode):
+        parser.error('--latest can not be combined with --from or --to')
+    try:
+        check_episode_range(args.from_episode, args.to_episode, args.latest)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.use_async:
+        # The asyncio engine only fetches the episodes into one EPUB
+        unsupported = [flag for flag, given in (
+            ('--sequential', args.sequential), ('--stream', args.stream), ('--resume', args.resume), ('--update', args.update),
+            ('--images', args.images), ('--volume-episodes', args.volume_episodes), ('--volume-size', args.volume_size),
+            ('--volume-by-arc', args.volume_by_arc), ('--bundle-size', args.bundle_size), ('--arc-toc', args.arc_toc),
+            ('--format', args.format != 'epub'),
+        ) if given]
+        if unsupported:
+            parser.error(f"--async can not be combined with {', '.join(unsupported)}")
+        if not args.no_cache:
+            print("[WARN] The asyncio engine doesn't use the episode cache; every episode is downloaded and parsed")
+    set_backend(args.parser)
 
     # Load user agents
     with open('userAgents.json', 'r') as f:
@@ -146,7 +516,42 @@ def main():
 
     # Initialize and run
     app = KakuyomuApp(book_id=book_id)
-    app.download(user_agents=user_agents)
+    rate_limits = {host: rate for limit in args.rate_limit for host, rate in limit.items()}
+    parse_executor = create_parse_pool(args.processes) if args.processes > 0 else None
+    images = ImageOptions(args.image_max_size, args.image_quality) if args.images else None
+    volumes = VolumeOptions(
+        args.volume_episodes,
+        int(args.volume_size * 1024 * 1024) if args.volume_size else None,
+        args.volume_by_arc,
+        args.bundle_size * 1024 if args.bundle_size else None,
+        args.arc_toc,
+    )
+    volumes = volumes if volumes.enabled else None
+    sink = SinkOptions(args.format, args.zstd, args.strip_ruby) if args.format != 'epub' else None
+    metrics.reset()
+    with profiled(args.profile):
+        try:
+            catalog = None if args.no_catalog else Catalog(app.output_dir / CATALOG_NAME)
+            try:
+                if args.use_async:
+                    asyncio.run(app.download_async(user_agents=user_agents, concurrency=args.concurrency, rate_limits=rate_limits, parse_executor=parse_executor, max_retries=args.max_retries, start=args.from_episode, end=args.to_episode, latest=args.latest, catalog=catalog))
+                else:
+                    cache = None if args.no_cache else EpisodeCache(args.cache_dir)
+                    try:
+                        app.download(user_agents=user_agents, workers=args.workers, sequential=args.sequential, rate_limits=rate_limits, cache=cache, update=args.update, stream=args.stream, parse_executor=parse_executor, resume=args.resume, max_retries=args.max_retries, images=images, volumes=volumes, sink=sink, start=args.from_episode, end=args.to_episode, latest=args.latest, catalog=catalog)
+                    finally:
+                        if cache:
+                            cache.close()
+            finally:
+                if catalog:
+                    catalog.close()
+        finally:
+            if parse_executor:
+                parse_executor.shutdown()
+
+    print(f"[INFO] {metrics.describe()}")
+    if args.metrics:
+        metrics.write_json(args.metrics)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file
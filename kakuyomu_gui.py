@@ -1,21 +1,22 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-import requests
-from bs4 import BeautifulSoup
 import json
-from typing import Optional, List
 from pathlib import Path
-import random
-from ebooklib import epub
 import threading
 import os
 import sys
 
+from catalog import CATALOG_NAME, Catalog
+from download_engine import check_episode_range
+from episode_cache import EpisodeCache
+from gui_events import EventPump, GuiEvents
+from kakuyomu import KakuyomuApp
+
 class KakuyomuGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Kakuyomu Downloader")
-        self.root.geometry("600x400")
+        self.root.geometry("600x440")
         
         # Create main frame
         main_frame = ttk.Frame(root, padding="10")
@@ -47,23 +48,45 @@ class KakuyomuGUI:
         self.output_dir_entry.grid(row=0, column=1, sticky=(tk.W, tk.E))
         ttk.Button(dir_frame, text="Browse", command=self.browse_output_dir).grid(row=0, column=2, padx=(5, 0))
         
+        # Episode range (all episodes when left empty)
+        range_frame = ttk.Frame(main_frame)
+        range_frame.grid(row=2, column=0, columnspan=2, sticky=tk.W, pady=5)
+        
+        ttk.Label(range_frame, text="Episodes from:").grid(row=0, column=0, padx=(0, 5))
+        self.from_var = tk.StringVar()
+        ttk.Entry(range_frame, textvariable=self.from_var, width=6).grid(row=0, column=1)
+        ttk.Label(range_frame, text="to:").grid(row=0, column=2, padx=5)
+        self.to_var = tk.StringVar()
+        ttk.Entry(range_frame, textvariable=self.to_var, width=6).grid(row=0, column=3)
+        ttk.Label(range_frame, text="or latest:").grid(row=0, column=4, padx=5)
+        self.latest_var = tk.StringVar()
+        ttk.Entry(range_frame, textvariable=self.latest_var, width=6).grid(row=0, column=5)
+        
         # Download button
         self.download_button = ttk.Button(main_frame, text="Download", command=self.start_download)
-        self.download_button.grid(row=2, column=0, columnspan=2, pady=10)
+        self.download_button.grid(row=3, column=0, columnspan=2, pady=10)
         
         # Progress label
         self.progress_var = tk.StringVar(value="Ready")
-        ttk.Label(main_frame, textvariable=self.progress_var).grid(row=3, column=0, columnspan=2, sticky=tk.W, pady=5)
+        ttk.Label(main_frame, textvariable=self.progress_var).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=5)
+        
+        # Progress bar
+        self.progress_bar = ttk.Progressbar(main_frame, orient="horizontal")
+        self.progress_bar.grid(row=5, column=0, columnspan=2, sticky=(tk.W, tk.E))
         
         # Log text area
         self.log_text = tk.Text(main_frame, height=15, width=60)
-        self.log_text.grid(row=4, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
+        self.log_text.grid(row=6, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=10)
         
         # Scrollbar for log
         scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=self.log_text.yview)
-        scrollbar.grid(row=4, column=1, sticky=(tk.N, tk.S))
+        scrollbar.grid(row=6, column=1, sticky=(tk.N, tk.S))
         self.log_text.configure(yscrollcommand=scrollbar.set)
         
+        # Download threads post log lines and progress here; the main loop applies them
+        self.events = GuiEvents()
+        self.pump = EventPump(root, self.events, self.log_text, self.progress_bar, self.progress_var)
+        
         # Load user agents
         self.user_agents = self.load_user_agents()
         
@@ -104,11 +127,20 @@ class KakuyomuGUI:
             self.log(f"Warning: Could not load user agents file, using defaults. Error: {str(e)}")
             return default_agents
 
+    def episode_range(self):
+        """Return the first, last and latest episode numbers entered, None where left empty."""
+        numbers = []
+        for var in (self.from_var, self.to_var, self.latest_var):
+            text = var.get().strip()
+            numbers.append(int(text) if text else None)
+        check_episode_range(*numbers)
+        if numbers[2] and (numbers[0] or numbers[1]):
+            raise ValueError("Enter either a range of episodes or the latest episodes, not both")
+        return tuple(numbers)
+
     def log(self, message):
-        """Add message to log text area."""
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        """Queue a message for the log text area; safe to call from any thread."""
+        self.events.log(message)
 
     def start_download(self):
         """Start download in a separate thread."""
@@ -117,6 +149,12 @@ class KakuyomuGUI:
             messagebox.showerror("Error", "Please enter a book ID")
             return
         
+        try:
+            episodes = self.episode_range()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid episodes: {str(e)}")
+            return
+        
         output_dir = Path(self.output_dir_var.get())
         try:
             output_dir.mkdir(parents=True, exist_ok=True)
@@ -126,128 +164,34 @@ class KakuyomuGUI:
         
         self.download_button.configure(state='disabled')
         self.progress_var.set("Downloading...")
+        self.pump.reset_progress()
         
         # Start download in a separate thread
-        thread = threading.Thread(target=self.download_book, args=(book_id, output_dir))
+        thread = threading.Thread(target=self.download_book, args=(book_id, output_dir, episodes))
         thread.daemon = True
         thread.start()
 
-    def download_book(self, book_id, output_dir):
-        """Download the book."""
+    def download_book(self, book_id, output_dir, episodes):
+        """Download the book on a worker thread, reporting back through self.events."""
+        start, end, latest = episodes
         try:
-            downloader = KakuyomuDownloader(book_id, self.log, output_dir)
-            success = downloader.download(self.user_agents)
+            with EpisodeCache(output_dir / ".cache") as cache, Catalog(output_dir / CATALOG_NAME) as catalog:
+                app = KakuyomuApp(book_id, log=self.log, output_dir=output_dir, progress=self.events.progress)
+                success = app.download(self.user_agents, cache=cache, start=start, end=end, latest=latest, catalog=catalog)
             
             if success:
-                self.progress_var.set("Download completed!")
-                messagebox.showinfo("Success", "Book downloaded successfully!")
+                self.events.call(lambda: self.finish("Download completed!", messagebox.showinfo, "Success", "Book downloaded successfully!"))
             else:
-                self.progress_var.set("Download failed")
-                messagebox.showerror("Error", "Failed to download book")
+                self.events.call(lambda: self.finish("Download failed", messagebox.showerror, "Error", "Failed to download book"))
         except Exception as e:
-            self.progress_var.set("Error occurred")
-            messagebox.showerror("Error", f"An error occurred: {str(e)}")
-        finally:
-            self.root.after(0, lambda: self.download_button.configure(state='normal'))
-
-class KakuyomuDownloader:
-    def __init__(self, book_id: str, log_callback, output_dir: Path):
-        self.book_id = book_id
-        self.log = log_callback
-        self.output_dir = output_dir
-
-    def get_base_url(self) -> str:
-        return f"https://kakuyomu.jp/works/{self.book_id}"
-
-    def download(self, user_agents: List[str]) -> bool:
-        base_url = self.get_base_url()
-        self.log(f"Base URL: {base_url}")
-
-        user_agent = random.choice(user_agents)
-        self.log(f"Using User Agent: {user_agent}")
-
-        headers = {'User-Agent': user_agent}
-
-        try:
-            # Get first page
-            response = requests.get(base_url, headers=headers, timeout=30)
-            response.raise_for_status()  # Raise exception for bad status codes
-            soup = BeautifulSoup(response.text, 'html.parser')
+            message = f"An error occurred: {str(e)}"
+            self.events.call(lambda: self.finish("Error occurred", messagebox.showerror, "Error", message))
 
-            # Get title
-            title_element = soup.select_one("#app > div.DefaultTemplate_fixed__DLjCr.DefaultTemplate_isWeb__QRPlB.DefaultTemplate_fixedGlobalFooter___dZog > div > div > main > div.NewBox_box__45ont.NewBox_padding-px-4l__Kx_xT.NewBox_padding-pt-7l__Czm59 > div > div.Gap_size-2l__HWqrr.Gap_direction-y__Ee6Qv > div.Gap_size-3s__fjxCP.Gap_direction-y__Ee6Qv > h1 > span > a")
-            if not title_element:
-                self.log("Could not find title")
-                return False
-                
-            title = title_element.text
-            self.log(f"Title: {title}")
-
-            # Create EPUB book
-            book = epub.EpubBook()
-            book.set_identifier(self.book_id)
-            book.set_title(title)
-            book.set_language('ja')
-            book.add_author("Unknown Author")
-
-            # Get first episode link
-            first_link = soup.select_one("#app > div.DefaultTemplate_fixed__DLjCr.DefaultTemplate_isWeb__QRPlB.DefaultTemplate_fixedGlobalFooter___dZog > div > div > main > div.NewBox_box__45ont.NewBox_padding-px-4l__Kx_xT.NewBox_padding-pt-7l__Czm59 > div > div.Gap_size-2l__HWqrr.Gap_direction-y__Ee6Qv > div.Gap_size-m__thYv4.Gap_direction-y__Ee6Qv > div > a")
-            
-            if not first_link:
-                self.log("Could not find first episode link")
-                return False
-
-            first_url = f"https://kakuyomu.jp{first_link['href']}"
-            self.log(f"First URL: {first_url}")
-
-            # Download all episodes
-            current_url = first_url
-            chapters = []
-            episode_num = 1
-
-            while True:
-                self.log(f"Downloading episode {episode_num}")
-                
-                response = requests.get(current_url, headers=headers, timeout=30)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                episode_title_element = soup.select_one(".widget-episodeTitle.js-vertical-composition-item")
-                episode_title = episode_title_element.text.strip() if episode_title_element else f"Episode {episode_num}"
-
-                episode_content = soup.select_one(".widget-episodeBody.js-episode-body")
-                if episode_content:
-                    chapter = epub.EpubHtml(title=episode_title, file_name=f'chapter_{episode_num}.xhtml', lang='ja')
-                    chapter.content = f"<h3>{episode_title}</h3>{episode_content.prettify()}"
-                    book.add_item(chapter)
-                    chapters.append(chapter)
-                
-                next_link = soup.select_one("#contentMain-readNextEpisode")
-                if not next_link:
-                    self.log("No more episodes found")
-                    break
-                    
-                current_url = f"https://kakuyomu.jp{next_link['href']}"
-                episode_num += 1
-
-            # Finalize EPUB
-            book.toc = tuple(epub.Link(chapter.file_name, chapter.title, chapter.file_name) for chapter in chapters)
-            book.add_item(epub.EpubNcx())
-            book.add_item(epub.EpubNav())
-            book.spine = ['nav'] + chapters
-
-            # Save the book
-            epub_path = self.output_dir / f"{title}.epub"
-            epub.write_epub(str(epub_path), book)
-            self.log(f"Successfully saved to {epub_path}")
-            return True
-            
-        except requests.exceptions.RequestException as e:
-            self.log(f"Network error: {str(e)}")
-            return False
-        except Exception as e:
-            self.log(f"Error: {str(e)}")
-            return False
+    def finish(self, status, show, title, message):
+        """Show the outcome of a download; runs on the Tk main loop."""
+        self.progress_var.set(status)
+        self.download_button.configure(state='normal')
+        show(title, message)
 
 def main():
     root = tk.Tk()
@@ -255,4 +199,4 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file
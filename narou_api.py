@@ -0,0 +1,94 @@
+import argparse
+import json
+import sys
+from typing import Any, Dict, Iterable, Optional
+
+import requests
+
+from http_client import HttpClient
+
+NAROU_API_URL = "https://api.syosetu.com/novelapi/api/"
+# Ncodes asked for in one request (the API answers at most 500 novels per request)
+API_BATCH_SIZE = 100
+# Output fields: title, ncode, writer, general_all_no, general_lastup, novelupdated_at
+API_FIELDS = "t-n-w-ga-gl-nu"
+
+
+class NovelInfo:
+    """What the Syosetu novel API tells about a novel."""
+
+    __slots__ = ("ncode", "title", "writer", "episodes", "last_posted", "updated")
+
+    def __init__(self, ncode: str, title: str, writer: str, episodes: int, last_posted: str, updated: str):
+        self.ncode = ncode
+        self.title = title
+        self.writer = writer
+        self.episodes = episodes
+        self.last_posted = last_posted
+        self.updated = updated
+
+    @classmethod
+    def from_api(cls, entry: Dict[str, Any]) -> "NovelInfo":
+        return cls(
+            str(entry.get("ncode") or "").lower(),
+            entry.get("title") or "",
+            entry.get("writer") or "",
+            int(entry.get("general_all_no") or 0),
+            entry.get("general_lastup") or "",
+            entry.get("novelupdated_at") or "",
+        )
+
+    @property
+    def stamp(self) -> str:
+        """When the novel last changed, including edits of old episodes where the API reports them."""
+        return self.updated or self.last_posted
+
+
+def fetch_novel_info(
+    client: HttpClient,
+    ncodes: Iterable[str],
+    api_url: str = NAROU_API_URL,
+) -> Dict[str, Optional[NovelInfo]]:
+    """Look up novels in the novel API, ``API_BATCH_SIZE`` ncodes per request.
+
+    Returns the info keyed by lowercase ncode; ncodes the API doesn't know
+    (such as novels only listed by the R18 API) map to None.
+    """
+    novels: Dict[str, Optional[NovelInfo]] = {ncode.lower(): None for ncode in ncodes}
+    codes = list(novels)
+    for start in range(0, len(codes), API_BATCH_SIZE):
+        batch = codes[start:start + API_BATCH_SIZE]
+        response = client.get(api_url, params={"out": "json", "of": API_FIELDS, "lim": len(batch), "ncode": "-".join(batch)})
+        response.raise_for_status()
+        # The first element only holds the number of matches
+        for entry in response.json()[1:]:
+            info = NovelInfo.from_api(entry)
+            if info.ncode in novels:
+                novels[info.ncode] = info
+    return novels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Look up Narou novels in the Syosetu novel API')
+    parser.add_argument('ncodes', nargs='+', help='Novel IDs (e.g., n5511kh)')
+    parser.add_argument('--api-url', default=NAROU_API_URL, help='Base URL of the novel API')
+    args = parser.parse_args()
+
+    with open('userAgents.json', 'r') as f:
+        user_agents = json.load(f)
+
+    try:
+        with HttpClient(user_agents) as client:
+            novels = fetch_novel_info(client, args.ncodes, args.api_url)
+    except (requests.exceptions.RequestException, ValueError) as exc:
+        print(f"[ERROR] Could not query the novel API: {exc}")
+        sys.exit(1)
+    for ncode, info in novels.items():
+        if info is None:
+            print(f"[WARN] {ncode}: not found")
+        else:
+            print(f"[INFO] {ncode}: {info.title} by {info.writer}, {info.episodes} episodes, updated {info.stamp}")
+    sys.exit(0 if all(novels.values()) else 1)
+
+if __name__ == "__main__":
+    main()
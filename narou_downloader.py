@@ -2,11 +2,397 @@ import requests
 from bs4 import BeautifulSoup
 import json
 import argparse
-from typing import Optional, List, Callable
+from typing import Any, Optional, Iterable, Iterator, List, Callable, Dict, Sequence, Tuple
 from pathlib import Path
-import random
+import asyncio
+import sqlite3
+from concurrent.futures import Executor
+import re
 from ebooklib import epub
 import bs4
+from xml.sax.saxutils import escape, quoteattr
+
+from catalog import CATALOG_NAME, Catalog, CatalogEntry
+from download_engine import DownloadEngine, Episode, EpisodeListing, SiteAdapter, check_episode_range, episode_range, range_title
+from download_metrics import metrics, profiled
+from episode_cache import DEFAULT_CACHE_DIR, EpisodeCache
+from epub_images import DEFAULT_IMAGE_QUALITY, ImageOptions
+from epub_stream import StreamingEpubBook
+from epub_volumes import VolumeOptions
+from epub_update import write_episode_index
+from http_client import ASYNC_ERRORS, DEFAULT_ASYNC_CONCURRENCY, DEFAULT_MAX_RETRIES, AsyncHttpClient, HttpClient, parse_rate_limit
+from narou_api import NAROU_API_URL, NovelInfo, fetch_novel_info
+from output_sinks import FORMATS, SinkOptions
+from page_parser import BACKENDS, ElementStrainer, create_parse_pool, make_soup, parse_in_async, set_backend
+
+NAROU_ROOT = "https://ncode.syosetu.com"
+DEFAULT_WORKERS = 8
+
+# Episode pages are only parsed for the novel title and the article (with its next buttons)
+EPISODE_STRAINER = ElementStrainer(names=["title", "article", "h1"], classes=["novel_view"])
+
+
+def parse_novel_title(soup: BeautifulSoup) -> Optional[str]:
+    """Return the novel title from the <title> of an episode page."""
+    title_tag = soup.find('title')
+    if not title_tag or not title_tag.text:
+        return None
+    novel_title = title_tag.text.strip()
+    if ' - ' in novel_title:
+        novel_title = novel_title.split(' - ')[0]
+    return novel_title
+
+
+def inline_html(element: bs4.element.Tag) -> str:
+    """Return the text of an element with its ruby kept and any other markup dropped."""
+    parts = []
+    for child in element.children:
+        if isinstance(child, bs4.element.Comment):
+            continue
+        if isinstance(child, bs4.element.NavigableString):
+            parts.append(escape(str(child)))
+        elif child.name == 'ruby':
+            base = ''.join(child.find_all(string=True, recursive=False)).strip() + ''.join(rb.text for rb in child.find_all('rb'))
+            reading = ''.join(rt.text for rt in child.find_all('rt'))
+            parts.append(f'<ruby>{escape(base)}<rp>(</rp><rt>{escape(reading)}</rt><rp>)</rp></ruby>')
+        elif child.name not in ('rt', 'rp'):
+            parts.append(inline_html(child))
+    return ''.join(parts)
+
+
+def paragraph_html(paragraph: bs4.element.Tag) -> str:
+    """Return a paragraph as text with its ruby, keeping the illustrations (usually hosted on Mitemin) it shows."""
+    images = ''.join(
+        f'<img src={quoteattr(img["src"])} alt={quoteattr(img.get("alt", ""))}/>'
+        for img in paragraph.find_all('img') if img.get('src')
+    )
+    return f'<p>{images}{inline_html(paragraph)}</p>'
+
+
+def parse_episode(soup: BeautifulSoup, episode_num: int) -> Tuple[str, Optional[str]]:
+    """Return the episode title and chapter HTML of an episode page."""
+    episode_title_elem = soup.select_one('article > h1')
+    if not episode_title_elem:
+        episode_title_elem = soup.select_one('h1')
+    episode_title = episode_title_elem.text.strip() if episode_title_elem else f"Episode {episode_num}"
+
+    # Get episode content (list of <p> tags)
+    content_div = soup.select_one('article > div.p-novel__body')
+    if not content_div:
+        content_div = soup.find('div', class_='novel_view')
+    if not content_div:
+        return episode_title, None
+    if isinstance(content_div, bs4.element.Tag):
+        paragraphs = content_div.find_all('p')
+        content_html = ''.join([paragraph_html(p) for p in paragraphs])
+    else:
+        content_html = str(content_div)
+    return episode_title, content_html
+
+
+def parse_episode_page(html: str, episode_num: int) -> Tuple[Optional[str], str, Optional[str]]:
+    """Parse an episode page and return the novel title, episode title and chapter HTML."""
+    soup = make_soup(html, EPISODE_STRAINER)
+    return (parse_novel_title(soup),) + parse_episode(soup, episode_num)
+
+
+def parse_next_episode_url(soup: BeautifulSoup, episode_num: int) -> Optional[str]:
+    """Return the URL behind the next button of an episode page.
+
+    The first episode has no previous button, so its next button is the second link.
+    """
+    if episode_num == 1:
+        next_link = soup.select_one('article > div:nth-of-type(1) > a:nth-of-type(2)')
+    else:
+        next_link = soup.select_one('article > div:nth-of-type(1) > a:nth-of-type(3)')
+        if not next_link:
+            next_link = soup.select_one('article > div:nth-of-type(1) > a:nth-of-type(2)')
+    if not next_link or not next_link.get('href'):
+        return None
+    next_href = str(next_link['href'])
+    return next_href if next_href.startswith('http') else f"{NAROU_ROOT}{next_href}"
+
+
+def parse_episode_with_next(html: str, episode_num: int) -> Tuple[Optional[str], str, Optional[str], Optional[str]]:
+    """Parse an episode page and return the novel title, episode title, chapter HTML and next episode URL."""
+    soup = make_soup(html, EPISODE_STRAINER)
+    return (parse_novel_title(soup),) + parse_episode(soup, episode_num) + (parse_next_episode_url(soup, episode_num),)
+
+
+def parse_last_index_page(soup: BeautifulSoup) -> int:
+    """Return the number of the last episode index page."""
+    last_page = soup.select_one('a.c-pager__item--last')
+    if last_page and last_page.get('href'):
+        match = re.search(r'[?&]p=(\d+)', str(last_page['href']))
+        if match:
+            return int(match.group(1))
+    return 1
+
+
+def parse_index_episode_count(soup: BeautifulSoup, novel_id: str) -> int:
+    """Return the highest episode number linked from an episode index page."""
+    pattern = re.compile(rf'/{re.escape(novel_id)}/(\d+)/?$', re.IGNORECASE)
+    numbers = [
+        int(match.group(1))
+        for link in soup.select('a[href]')
+        for match in [pattern.search(str(link['href']))]
+        if match
+    ]
+    return max(numbers, default=0)
+
+
+def parse_index_episodes(soup: BeautifulSoup, chapter: str = '') -> List[Dict[str, str]]:
+    """Return the episodes listed on an episode index page with their update stamps and arcs.
+
+    ``chapter`` is the arc the page starts in, which is only named on the
+    index page where it begins.
+    """
+    episodes = []
+    for entry in soup.select('.p-eplist__chapter-title, .p-eplist__sublist'):
+        if 'p-eplist__chapter-title' in entry.get('class', []):
+            chapter = entry.get_text(strip=True)
+            continue
+        link = entry.select_one('a.p-eplist__subtitle')
+        if not link or not link.get('href'):
+            continue
+        href = str(link['href'])
+        update = entry.select_one('.p-eplist__update')
+        stamp = ''
+        if update:
+            revised = update.select_one('[title]')
+            stamp = update.get_text(' ', strip=True) + (f" {revised['title']}" if revised else '')
+        episodes.append({
+            "url": href if href.startswith('http') else f"{NAROU_ROOT}{href}",
+            "title": link.get_text(strip=True),
+            "chapter": chapter,
+            "stamp": stamp,
+        })
+    return episodes
+
+
+def create_book(novel_id: str, stream: bool = False, target_dir: Path = Path("epub"), author: Optional[str] = None) -> epub.EpubBook:
+    """Create an empty EPUB book for a novel; the title is set once it is known.
+
+    With ``stream`` the book writes its chapters into a temporary file in
+    ``target_dir`` as they are added.
+    """
+    book = StreamingEpubBook(target_dir) if stream else epub.EpubBook()
+    book.set_identifier(novel_id)
+    book.set_language('ja')
+    book.add_author(author or "Unknown Author")
+    return book
+
+
+def save_book(
+    book: epub.EpubBook,
+    chapters: List[epub.EpubHtml],
+    target_dir: Path,
+    title: str,
+    records: Optional[List[Dict[str, str]]] = None,
+) -> Path:
+    """Add navigation for the chapters and write the book into ``target_dir``.
+
+    ``records`` (the source ``url`` and ``stamp`` of every chapter) are
+    embedded so the EPUB can be updated in place later.
+    """
+    with metrics.stage("write"):
+        if records:
+            write_episode_index(book, records)
+
+        epub_path = target_dir / f"{title}.epub"
+        if isinstance(book, StreamingEpubBook):
+            return book.finish(epub_path, chapters)
+
+        # Add chapters to the Table of Contents
+        book.toc = [epub.Link(chapter.file_name, chapter.title, chapter.file_name) for chapter in chapters]
+        book.add_item(epub.EpubNcx())
+        book.add_item(epub.EpubNav())
+        book.spine = ['nav'] + chapters
+
+        target_dir.mkdir(parents=True, exist_ok=True)
+        epub.write_epub(str(epub_path), book)
+        return epub_path
+
+
+def add_chapter(book: epub.EpubBook, episode_num: int, episode_title: str, content_html: str) -> epub.EpubHtml:
+    """Create a chapter for an episode and add it to the book."""
+    with metrics.stage("build"):
+        chapter = epub.EpubHtml(title=episode_title, file_name=f'chapter_{episode_num}.xhtml', lang='ja')
+        chapter.content = f"<h3>{episode_title}</h3>{content_html}"
+        book.add_item(chapter)
+    metrics.count("chapters")
+    return chapter
+
+
+def episode_url(novel_id: str, episode_num: int) -> str:
+    return f"{NAROU_ROOT}/{novel_id}/{episode_num}/"
+
+
+class NarouAdapter(SiteAdapter):
+    """Narou URLs, episode index and episode pages for the download engine.
+
+    With ``api_url`` the Syosetu novel API is asked for the title, author,
+    episode count and last update of novels, so downloads know their size up
+    front and ``update`` can skip unchanged novels without loading a page.
+    """
+
+    site = "narou"
+    title_on_episode_pages = True
+    parse_page = staticmethod(parse_episode_page)
+    parse_page_with_next = staticmethod(parse_episode_with_next)
+
+    def __init__(self, api_url: Optional[str] = None):
+        self.api_url = api_url
+        # API answers by novel ID; None for novels the API doesn't know
+        self.novels: Dict[str, Optional[NovelInfo]] = {}
+
+    def prefetch(self, client: HttpClient, novel_ids: List[str], log: Callable[[str], None]) -> None:
+        """Ask the API about every novel not looked up yet, in as few requests as possible."""
+        missing = [novel_id for novel_id in novel_ids if novel_id not in self.novels]
+        if not self.api_url or not missing:
+            return
+        try:
+            self.novels.update(fetch_novel_info(client, missing, self.api_url))
+        except (requests.exceptions.RequestException, ValueError) as exc:
+            log(f"[WARN] Could not query the novel API: {exc}")
+            self.novels.update((novel_id, None) for novel_id in missing)
+
+    def novel_info(self, client: HttpClient, novel_id: str, log: Callable[[str], None]) -> Optional[NovelInfo]:
+        self.prefetch(client, [novel_id], log)
+        return self.novels.get(novel_id)
+
+    def work_stamp(self, client: HttpClient, novel_id: str, log: Callable[[str], None]) -> Tuple[Optional[str], Optional[str]]:
+        info = self.novel_info(client, novel_id, log)
+        return (info.title, info.stamp) if info else (None, None)
+
+    def latest_episodes(self, client: HttpClient, novel_id: str, log: Callable[[str], None]) -> Optional[Tuple[int, List[Dict[str, str]]]]:
+        """Return the number of episodes and those of the last index page, reading at most two index pages."""
+        soup = self.read_last_index_page(novel_id, client)
+        episodes = parse_index_episodes(soup)
+        if not episodes:
+            return None
+        return parse_index_episode_count(soup, novel_id), episodes
+
+    def list_episodes(self, client: HttpClient, novel_id: str, log: Callable[[str], None]) -> Tuple[Optional[str], Iterable[Dict[str, str]]]:
+        """Return the novel title and the episodes of the index pages.
+
+        Index pages after the first are only requested as the episodes are
+        consumed, so the first episodes can be fetched meanwhile. The title
+        comes from the API when it knows the novel, as does the number of
+        episodes. A novel whose index can't be read has no episodes.
+        """
+        info = self.novel_info(client, novel_id, log)
+        index_url = f"{NAROU_ROOT}/{novel_id}/"
+        try:
+            response = client.get(index_url)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as exc:
+            log(f"[WARN] Could not read index of {novel_id}: {exc}")
+            return (info.title if info else None), iter(())
+        soup = make_soup(response.text)
+
+        def episodes() -> Iterator[Dict[str, str]]:
+            page_episodes = parse_index_episodes(soup)
+            yield from page_episodes
+            for page in range(2, parse_last_index_page(soup) + 1):
+                page_response = client.get(f"{index_url}?p={page}")
+                page_response.raise_for_status()
+                page_episodes = parse_index_episodes(make_soup(page_response.text), page_episodes[-1]["chapter"] if page_episodes else '')
+                yield from page_episodes
+
+        if info and info.episodes:
+            return info.title, EpisodeListing(episodes(), info.episodes)
+        return parse_novel_title(soup), episodes()
+
+    def fallback_episodes(self, client: HttpClient, novel_id: str, log: Callable[[str], None]) -> List[Dict[str, str]]:
+        """Number the episodes up to the episode count when the index lists none."""
+        info = self.novel_info(client, novel_id, log)
+        count = info.episodes if info and info.episodes else self.count_episodes(novel_id, client, log)
+        return [{"url": episode_url(novel_id, episode_num), "stamp": ""} for episode_num in range(1, count + 1)]
+
+    def first_episode_url(self, client: HttpClient, novel_id: str, log: Callable[[str], None]) -> Optional[str]:
+        return episode_url(novel_id, 1)
+
+    def episode_url(self, client: HttpClient, novel_id: str, episode_num: int, log: Callable[[str], None]) -> Optional[str]:
+        """Episode URLs are numbered, so any episode can be started from."""
+        return episode_url(novel_id, episode_num)
+
+    def count_episodes(self, novel_id: str, client: HttpClient, log: Callable[[str], None]) -> int:
+        """Find the number of episodes from the index pages, probing if they can't be read."""
+        try:
+            count = self.count_episodes_from_index(novel_id, client)
+        except requests.exceptions.RequestException as exc:
+            log(f"[WARN] Could not read index of {novel_id}: {exc}")
+            count = 0
+        if count:
+            return count
+        log("[INFO] Probing for the last episode")
+        return self.probe_episode_count(novel_id, client)
+
+    def count_episodes_from_index(self, novel_id: str, client: HttpClient) -> int:
+        """Read the highest episode number from the last page of the episode index."""
+        return parse_index_episode_count(self.read_last_index_page(novel_id, client), novel_id)
+
+    def read_last_index_page(self, novel_id: str, client: HttpClient) -> BeautifulSoup:
+        """Return the last page of the episode index, found from the pager of the first."""
+        index_url = f"{NAROU_ROOT}/{novel_id}/"
+        response = client.get(index_url)
+        response.raise_for_status()
+        soup = make_soup(response.text)
+
+        last_page = parse_last_index_page(soup)
+        if last_page > 1:
+            response = client.get(f"{index_url}?p={last_page}")
+            response.raise_for_status()
+            soup = make_soup(response.text)
+        return soup
+
+    def probe_episode_count(self, novel_id: str, client: HttpClient) -> int:
+        """Find the last episode with exponential then binary probing for the first 404."""
+        def exists(episode_num: int) -> bool:
+            response = client.get(episode_url(novel_id, episode_num))
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+            return True
+
+        if not exists(1):
+            return 0
+        low, high = 1, 2
+        while exists(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if exists(middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def unpack(self, result: Sequence[Any]) -> Tuple[Optional[str], str, Optional[str]]:
+        page_title, episode_title, content_html = result
+        return page_title, episode_title, content_html
+
+    def create_book(self, novel_id: str, title: Optional[str], stream: bool, output_dir: Path) -> epub.EpubBook:
+        info = self.novels.get(novel_id)
+        book = create_book(novel_id, stream, output_dir, info.writer if info else None)
+        if title:
+            book.set_title(title)
+        return book
+
+    def add_chapter(self, book: epub.EpubBook, episode_num: int, episode_title: str, content: str) -> epub.EpubHtml:
+        return add_chapter(book, episode_num, episode_title, content)
+
+    def save_book(
+        self,
+        book: epub.EpubBook,
+        chapters: List[epub.EpubHtml],
+        title: str,
+        output_dir: Path,
+        records: List[Dict[str, str]],
+    ) -> Path:
+        return save_book(book, chapters, output_dir, title, records)
+
 
 class NarouDownloader:
     def __init__(
@@ -14,8 +400,11 @@ class NarouDownloader:
         novel_id: Optional[str] = None,
         log: Optional[Callable[[str], None]] = None,
         output_dir: Optional[Path] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
     ):
         self.log = log or print
+        # Called with the episodes done and the total (0 if unknown) as they are added
+        self.progress = progress or (lambda done, total: None)
         self.novel_id = novel_id
         self.output_dir = Path(output_dir) if output_dir else Path("epub")
 
@@ -25,131 +414,294 @@ class NarouDownloader:
         else:
             self.log(f"Novel ID: {novel_id}")
 
-    def get_first_episode_url(self, novel_id: Optional[str] = None) -> Optional[str]:
+    def download(
+        self,
+        user_agents: List[str],
+        novel_id: Optional[str] = None,
+        output_dir: Optional[Path] = None,
+        workers: int = DEFAULT_WORKERS,
+        sequential: bool = False,
+        rate_limits: Optional[Dict[str, float]] = None,
+        cache: Optional[EpisodeCache] = None,
+        update: bool = False,
+        stream: bool = False,
+        parse_executor: Optional[Executor] = None,
+        resume: bool = False,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        api_url: Optional[str] = None,
+        images: Optional[ImageOptions] = None,
+        volumes: Optional[VolumeOptions] = None,
+        sink: Optional[SinkOptions] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+        catalog: Optional[Catalog] = None,
+    ) -> bool:
+        """Download every episode of a novel and save it as an EPUB file.
+
+        Runs the download engine: episodes are listed from the index pages
+        (numbered up to the episode count if the index lists none) and fetched
+        by up to ``workers`` threads while the rest of the index is read. With
+        ``sequential`` the next buttons are followed one page at a time
+        instead. Episodes unchanged since they were stored in ``cache`` aren't
+        parsed again. With ``update``, the episode index is compared with an
+        EPUB previously written for the novel, whose unchanged chapters are
+        reused; the file isn't rewritten if nothing changed. With ``stream``,
+        chapters are written to disk as they arrive instead of kept in memory.
+        Episode pages are parsed in ``parse_executor`` (such as the process
+        pool from ``create_parse_pool``) when given. Finished episodes are
+        journaled as they arrive; with ``resume``, those of an interrupted
+        download of the novel aren't fetched again. Failed requests are
+        retried up to ``max_retries`` times. With ``api_url`` the novel API
+        provides the title, author and episode count, and with ``update`` a
+        novel it reports unchanged since the EPUB was written isn't read at all.
+        With ``images`` the illustrations are downloaded and embedded, with
+        ``volumes`` the novel is split into volumes, and with ``sink`` the
+        episodes are written to a JSONL, text or HTML file instead of an EPUB.
+        Only the episodes ``start`` to ``end`` (counted from 1), or the
+        ``latest`` episodes, are downloaded when given.
+        Finished downloads are recorded in ``catalog``.
+        """
         novel_id = novel_id or self.novel_id
         if not novel_id:
             self.log("Novel id not set.")
-            return None
-        return f"https://ncode.syosetu.com/{novel_id}/1/"
+            return False
 
-    def download(
+        target_dir = Path(output_dir) if output_dir else self.output_dir
+        with HttpClient(user_agents, pool_size=workers, rate_limits=rate_limits, max_retries=max_retries, log=self.log) as client:
+            self.log(f"[INFO] Using User-Agent: {client.user_agent}")
+            engine = DownloadEngine(
+                NarouAdapter(api_url), client, target_dir, workers, cache, update, stream, parse_executor,
+                resume=resume, log=self.log, progress=self.progress, images=images, volumes=volumes, sink=sink,
+                catalog=catalog,
+            )
+            try:
+                return engine.download(novel_id, sequential, start, end, latest)
+            except requests.exceptions.RequestException as exc:
+                self.log(f"[ERROR] Request failed: {exc}")
+                return False
+
+    def iter_episodes(
+        self,
+        user_agents: List[str],
+        novel_id: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        workers: int = DEFAULT_WORKERS,
+        sequential: bool = False,
+        rate_limits: Optional[Dict[str, float]] = None,
+        cache: Optional[EpisodeCache] = None,
+        parse_executor: Optional[Executor] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        api_url: Optional[str] = None,
+        latest: Optional[int] = None,
+    ) -> Iterator[Episode]:
+        """Yield the episodes ``start`` to ``end`` (counted from 1), or the ``latest`` episodes, of a novel as soon as each one is ready.
+
+        Episodes are fetched by the same engine as ``download`` and handed to
+        the caller as ``Episode`` records in reading order; index pages after
+        the one listing ``end`` aren't read. Failed requests raise
+        ``requests.exceptions.RequestException`` and a novel whose pages can't
+        be read raises ``DownloadError``.
+        """
+        novel_id = novel_id or self.novel_id
+        if not novel_id:
+            self.log("Novel id not set.")
+            return
+
+        with HttpClient(user_agents, pool_size=workers, rate_limits=rate_limits, max_retries=max_retries, log=self.log) as client:
+            engine = DownloadEngine(
+                NarouAdapter(api_url), client, self.output_dir, workers, cache, parse_executor=parse_executor,
+                log=self.log, progress=self.progress,
+            )
+            yield from engine.iter_episodes(novel_id, start, end, sequential, latest)
+
+    async def download_async(
         self,
         user_agents: List[str],
         novel_id: Optional[str] = None,
         output_dir: Optional[Path] = None,
+        concurrency: int = DEFAULT_ASYNC_CONCURRENCY,
+        rate_limits: Optional[Dict[str, float]] = None,
+        executor: Optional[Executor] = None,
+        parse_executor: Optional[Executor] = None,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        latest: Optional[int] = None,
+        catalog: Optional[Catalog] = None,
     ) -> bool:
+        """Download every episode on the running event loop and save an EPUB file.
+
+        All episode requests are in flight at once, limited to ``concurrency``
+        open connections. Parsing and EPUB writing run in ``executor`` (the
+        loop's default executor if None) so they don't block the loop; episode
+        pages are parsed in ``parse_executor`` instead when given. Only the
+        episodes ``start`` to ``end``, or the ``latest`` episodes, are
+        downloaded when given. The download is recorded in ``catalog``.
+        """
         novel_id = novel_id or self.novel_id
         if not novel_id:
             self.log("Novel id not set.")
             return False
 
-        current_url = self.get_first_episode_url(novel_id)
-        self.log(f"[INFO] First episode URL: {current_url}")
+        loop = asyncio.get_running_loop()
+        async with AsyncHttpClient(
+            user_agents, concurrency=concurrency, rate_limits=rate_limits, max_retries=max_retries, log=self.log,
+        ) as client:
+            self.log(f"[INFO] Using User-Agent: {client.user_agent}")
+            try:
+                episode_count = await self.count_episodes_async(novel_id, client, executor)
+                self.log(f"[INFO] Found {episode_count} episodes")
+                first, last = episode_range(episode_count, start, end, latest)
+                if first > last:
+                    self.log(f"[ERROR] The novel has only {episode_count} episodes")
+                    return False
+                if first > 1 or last < episode_count:
+                    self.log(f"[INFO] Episodes {first} to {last}")
 
-        user_agent = random.choice(user_agents)
-        self.log(f"[INFO] Using User-Agent: {user_agent}")
-        headers = {'User-Agent': user_agent}
+                done = 0
 
-        chapters = []
-        episode_num = 1
-        novel_title = None
-        book = epub.EpubBook()
-        book.set_identifier(novel_id)
-        book.set_language('ja')
-        book.add_author("Unknown Author")
-
-        while current_url:
-            self.log(f"[LOG] Downloading episode {episode_num}: {current_url}")
-            try:
-                response = requests.get(current_url, headers=headers, timeout=30)
-                response.raise_for_status()
-            except requests.exceptions.RequestException as exc:
-                self.log(f"[ERROR] Request failed for {current_url}: {exc}")
+                async def fetch(episode_num: int) -> Tuple[Optional[str], str, Optional[str]]:
+                    nonlocal done
+                    url = episode_url(novel_id, episode_num)
+                    self.log(f"[LOG] Downloading episode {episode_num}: {url}")
+                    html = await client.get_text(url)
+                    result = await parse_in_async(parse_executor or executor, parse_episode_page, html, episode_num)
+                    done += 1
+                    self.progress(done, last - first + 1)
+                    return result
+
+                results = await asyncio.gather(*(fetch(n) for n in range(first, last + 1)))
+            except ASYNC_ERRORS as exc:
+                self.log(f"[ERROR] Request failed: {exc}")
                 return False
 
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            # Get novel title from the first episode only
-            if episode_num == 1:
-                title_tag = soup.find('title')
-                if title_tag and title_tag.text:
-                    novel_title_candidate = title_tag.text.strip()
-                    if ' - ' in novel_title_candidate:
-                        novel_title_candidate = novel_title_candidate.split(' - ')[0]
-                    self.log(f"[INFO] Novel title: {novel_title_candidate}")
-                    novel_title = novel_title_candidate
-                else:
-                    self.log("[ERROR] Could not find novel title")
-                    return False
-                book.set_title(novel_title)
-
-            # Get episode title
-            episode_title_elem = soup.select_one('body > div.l-container > main > article > h1')
-            if not episode_title_elem:
-                episode_title_elem = soup.select_one('h1')
-            episode_title = episode_title_elem.text.strip() if episode_title_elem else f"Episode {episode_num}"
-
-            # Get episode content (list of <p> tags)
-            content_div = soup.select_one('body > div.l-container > main > article > div.p-novel__body')
-            if not content_div:
-                content_div = soup.find('div', class_='novel_view')
-            if not content_div:
-                self.log(f"[ERROR] Could not find content for episode {episode_num}")
-                break
-            if isinstance(content_div, bs4.element.Tag):
-                paragraphs = content_div.find_all('p')
-                content_html = ''.join([f'<p>{p.text}</p>' for p in paragraphs])
-            else:
-                self.log(f"[ERROR] content_div is not a Tag for episode {episode_num}")
-                content_html = str(content_div)
+        novel_title = results[0][0] if results else None
+        if not novel_title:
+            self.log("[ERROR] Could not find novel title")
+            return False
+        self.log(f"[INFO] Novel title: {novel_title}")
+        work_title = novel_title
+        if first > 1 or last < episode_count:
+            novel_title = range_title(novel_title, first, last)
 
-            # Create a chapter
-            chapter = epub.EpubHtml(title=episode_title, file_name=f'chapter_{episode_num}.xhtml', lang='ja')
-            chapter.content = f"<h3>{episode_title}</h3>{content_html}"
-            book.add_item(chapter)
+        book = create_book(novel_id)
+        book.set_title(novel_title)
+        chapters = []
+        records = []
+        entries = []
+        for episode_num, (_, episode_title, content_html) in enumerate(results, start=first):
+            if content_html is None:
+                self.log(f"[ERROR] Could not find content for episode {episode_num}")
+                continue
+            if catalog:
+                entries.append(CatalogEntry.from_episode(Episode(episode_num, episode_title, episode_url(novel_id, episode_num), content_html)))
+            chapter = add_chapter(book, episode_num, episode_title, content_html)
             chapters.append(chapter)
+            records.append({"url": episode_url(novel_id, episode_num), "stamp": "", "file": chapter.file_name, "title": chapter.title})
 
-            # Find next episode link
-            next_link = None
-            if episode_num == 1:
-                next_link = soup.select_one('body > div.l-container > main > article > div:nth-of-type(1) > a:nth-of-type(2)')
-                self.log("[DEBUG] First episode: trying next button a:nth-of-type(2)")
-            else:
-                next_link = soup.select_one('body > div.l-container > main > article > div:nth-of-type(1) > a:nth-of-type(3)')
-                self.log("[DEBUG] Subsequent episode: trying next button a:nth-of-type(3)")
-                if not next_link:
-                    self.log("[DEBUG] Fallback: trying next button a:nth-of-type(2)")
-                    next_link = soup.select_one('body > div.l-container > main > article > div:nth-of-type(1) > a:nth-of-type(2)')
-            if not next_link or not next_link.get('href'):
-                self.log("[LOG] No more episodes found")
-                break
-            next_href = str(next_link['href'])
-            if next_href.startswith('http'):
-                current_url = next_href
-            else:
-                current_url = f"https://ncode.syosetu.com{next_href}"
-            episode_num += 1
-
-        # Add chapters to the Table of Contents
-        book.toc = [epub.Link(chapter.file_name, chapter.title, chapter.file_name) for chapter in chapters]
-        book.add_item(epub.EpubNcx())
-        book.add_item(epub.EpubNav())
-        book.spine = ['nav'] + chapters
-
-        # Save the book
         target_dir = Path(output_dir) if output_dir else self.output_dir
-        target_dir.mkdir(parents=True, exist_ok=True)
-        safe_title = novel_title or novel_id
-        epub_path = target_dir / f"{safe_title}.epub"
-        epub.write_epub(str(epub_path), book)
+        epub_path = await loop.run_in_executor(executor, save_book, book, chapters, target_dir, novel_title, records)
         self.log(f"[INFO] Successfully saved to {epub_path}")
+        if catalog:
+            try:
+                catalog.record(NarouAdapter.site, novel_id, work_title, None, [epub_path], entries, episode_count if novel_title == work_title else None)
+            except sqlite3.Error as exc:
+                self.log(f"[WARN] Could not record {novel_id} in the catalog: {exc}")
         return True
 
+    async def count_episodes_async(self, novel_id: str, client: AsyncHttpClient, executor: Optional[Executor] = None) -> int:
+        """Asyncio counterpart of count_episodes."""
+        loop = asyncio.get_running_loop()
+        index_url = f"{NAROU_ROOT}/{novel_id}/"
+        try:
+            soup = await loop.run_in_executor(executor, make_soup, await client.get_text(index_url))
+            last_page = parse_last_index_page(soup)
+            if last_page > 1:
+                html = await client.get_text(f"{index_url}?p={last_page}")
+                soup = await loop.run_in_executor(executor, make_soup, html)
+            count = parse_index_episode_count(soup, novel_id)
+        except ASYNC_ERRORS as exc:
+            self.log(f"[WARN] Could not read index of {novel_id}: {exc}")
+            count = 0
+        if count:
+            return count
+
+        self.log("[INFO] Probing for the last episode")
+
+        async def exists(episode_num: int) -> bool:
+            return await client.get_text(episode_url(novel_id, episode_num), allow_missing=True) is not None
+
+        if not await exists(1):
+            return 0
+        low, high = 1, 2
+        while await exists(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if await exists(middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
 def main():
     parser = argparse.ArgumentParser(description='Download stories from Syosetu (Narou)')
     parser.add_argument('mode', nargs='?', help='Operation mode (install)')
     parser.add_argument('novel_id', nargs='?', help='Syosetu novel ID (e.g., n5511kh)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of episodes fetched in parallel')
+    parser.add_argument('--sequential', action='store_true', help='Follow next episode buttons one page at a time')
+    parser.add_argument('--from', dest='from_episode', type=int, metavar='N', help='First episode to download (counted from 1)')
+    parser.add_argument('--to', dest='to_episode', type=int, metavar='N', help='Last episode to download')
+    parser.add_argument('--latest', type=int, metavar='N', help='Download only the last N episodes')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Use the asyncio engine (requires aiohttp)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_ASYNC_CONCURRENCY, help='Open connections used by the asyncio engine')
+    parser.add_argument('--processes', type=int, default=0, help='Parse episode pages in this many worker processes (0 parses in-process)')
+    parser.add_argument('--parser', choices=['auto', *BACKENDS], default='auto', help='HTML parser backend (auto picks lxml when installed)')
+    parser.add_argument('--stream', action='store_true', help='Write chapters to disk as they arrive to keep memory flat')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted download from its journal')
+    parser.add_argument('--update', action='store_true', help='Only fetch new or changed episodes of an existing EPUB')
+    parser.add_argument('--volume-episodes', type=int, help='Split the work into volumes of at most this many episodes')
+    parser.add_argument('--volume-size', type=float, help='Split the work into volumes of at most this many megabytes')
+    parser.add_argument('--volume-by-arc', action='store_true', help="Start a new volume at every arc (chapter) of the work's table of contents")
+    parser.add_argument('--bundle-size', type=int, help='Bundle consecutive episodes of an arc into files of up to this many kilobytes')
+    parser.add_argument('--arc-toc', action='store_true', help='Nest the table of contents by arc')
+    parser.add_argument('--format', choices=FORMATS, default='epub', help='Output an EPUB, or one JSONL, text or HTML file written as the episodes arrive')
+    parser.add_argument('--zstd', action='store_true', help='Compress JSONL output with zstd (requires zstandard)')
+    parser.add_argument('--strip-ruby', action='store_true', help='Drop ruby readings from text and JSONL output instead of writing them as |base《reading》')
+    parser.add_argument('--images', action='store_true', help='Download the illustrations of the chapters and embed them in the EPUB')
+    parser.add_argument('--image-max-size', type=int, help='Scale embedded images down to this many pixels on the longest edge (requires Pillow)')
+    parser.add_argument('--image-quality', type=int, help=f'Recompress embedded images as JPEG of this quality (requires Pillow, default {DEFAULT_IMAGE_QUALITY} when scaling)')
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR, help='Directory of the episode cache')
+    parser.add_argument('--no-cache', action='store_true', help='Download and parse every episode again')
+    parser.add_argument('--no-catalog', action='store_true', help=f'Don\'t record the download in {CATALOG_NAME} in the output directory')
+    parser.add_argument('--api', action='store_true', help='Get the title, author and episode count from the Syosetu novel API')
+    parser.add_argument('--api-url', default=NAROU_API_URL, help='Base URL of the novel API (for a mirror or local stand-in)')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='Retries of a request after network errors, 429 or 5xx responses')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='HOST=RATE', help='Requests per second allowed for a host (0 disables the limit)')
+    parser.add_argument('--metrics', type=Path, help='Write the time spent in each download stage to this JSON file')
+    parser.add_argument('--profile', type=Path, help='Profile the download with cProfile and write the stats to this file')
     args = parser.parse_args()
+    if args.latest and (args.from_episode or args.to_episode):
+        parser.error('--latest can not be combined with --from or --to')
+    try:
+        check_episode_range(args.from_episode, args.to_episode, args.latest)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.use_async:
+        # The asyncio engine only fetches the episodes into one EPUB
+        unsupported = [flag for flag, given in (
+            ('--sequential', args.sequential), ('--stream', args.stream), ('--resume', args.resume), ('--update', args.update), ('--api', args.api),
+            ('--images', args.images), ('--volume-episodes', args.volume_episodes), ('--volume-size', args.volume_size),
+            ('--volume-by-arc', args.volume_by_arc), ('--bundle-size', args.bundle_size), ('--arc-toc', args.arc_toc),
+            ('--format', args.format != 'epub'),
+        ) if given]
+        if unsupported:
+            parser.error(f"--async can not be combined with {', '.join(unsupported)}")
+        if not args.no_cache:
+            print("[WARN] The asyncio engine doesn't use the episode cache; every episode is downloaded and parsed")
+    set_backend(args.parser)
 
     # Load user agents
     with open('userAgents.json', 'r') as f:
@@ -166,7 +718,42 @@ def main():
 
     # Initialize and run
     app = NarouDownloader(novel_id=novel_id, log=print)
-    app.download(user_agents=user_agents)
+    rate_limits = {host: rate for limit in args.rate_limit for host, rate in limit.items()}
+    parse_executor = create_parse_pool(args.processes) if args.processes > 0 else None
+    images = ImageOptions(args.image_max_size, args.image_quality) if args.images else None
+    volumes = VolumeOptions(
+        args.volume_episodes,
+        int(args.volume_size * 1024 * 1024) if args.volume_size else None,
+        args.volume_by_arc,
+        args.bundle_size * 1024 if args.bundle_size else None,
+        args.arc_toc,
+    )
+    volumes = volumes if volumes.enabled else None
+    sink = SinkOptions(args.format, args.zstd, args.strip_ruby) if args.format != 'epub' else None
+    metrics.reset()
+    with profiled(args.profile):
+        try:
+            catalog = None if args.no_catalog else Catalog(app.output_dir / CATALOG_NAME)
+            try:
+                if args.use_async:
+                    asyncio.run(app.download_async(user_agents=user_agents, concurrency=args.concurrency, rate_limits=rate_limits, parse_executor=parse_executor, max_retries=args.max_retries, start=args.from_episode, end=args.to_episode, latest=args.latest, catalog=catalog))
+                else:
+                    cache = None if args.no_cache else EpisodeCache(args.cache_dir)
+                    try:
+                        app.download(user_agents=user_agents, workers=args.workers, sequential=args.sequential, rate_limits=rate_limits, cache=cache, update=args.update, stream=args.stream, parse_executor=parse_executor, resume=args.resume, max_retries=args.max_retries, api_url=args.api_url if args.api else None, images=images, volumes=volumes, sink=sink, start=args.from_episode, end=args.to_episode, latest=args.latest, catalog=catalog)
+                    finally:
+                        if cache:
+                            cache.close()
+            finally:
+                if catalog:
+                    catalog.close()
+        finally:
+            if parse_executor:
+                parse_executor.shutdown()
+
+    print(f"[INFO] {metrics.describe()}")
+    if args.metrics:
+        metrics.write_json(args.metrics)
 
 if __name__ == "__main__":
     main()
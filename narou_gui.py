@@ -2,11 +2,15 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import json
 from pathlib import Path
-from typing import List
+from typing import Callable, List, Optional, Tuple
 import threading
 import os
 import sys
 
+from catalog import CATALOG_NAME, Catalog
+from download_engine import check_episode_range
+from episode_cache import EpisodeCache
+from gui_events import EventPump, GuiEvents
 from narou_downloader import NarouDownloader
 
 
@@ -14,7 +18,7 @@ class NarouGUI:
     def __init__(self, root: tk.Tk):
         self.root = root
         self.root.title("Narou Downloader")
-        self.root.geometry("600x400")
+        self.root.geometry("600x440")
 
         main_frame = ttk.Frame(root, padding="10")
         main_frame.grid(row=0, column=0, sticky="nsew")
@@ -42,19 +46,40 @@ class NarouGUI:
         self.output_dir_entry.grid(row=0, column=1, sticky="we")
         ttk.Button(dir_frame, text="Browse", command=self.browse_output_dir).grid(row=0, column=2, padx=(5, 0))
 
+        # Episode range (all episodes when left empty)
+        range_frame = ttk.Frame(main_frame)
+        range_frame.grid(row=2, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        ttk.Label(range_frame, text="Episodes from:").grid(row=0, column=0, padx=(0, 5))
+        self.from_var = tk.StringVar()
+        ttk.Entry(range_frame, textvariable=self.from_var, width=6).grid(row=0, column=1)
+        ttk.Label(range_frame, text="to:").grid(row=0, column=2, padx=5)
+        self.to_var = tk.StringVar()
+        ttk.Entry(range_frame, textvariable=self.to_var, width=6).grid(row=0, column=3)
+        ttk.Label(range_frame, text="or latest:").grid(row=0, column=4, padx=5)
+        self.latest_var = tk.StringVar()
+        ttk.Entry(range_frame, textvariable=self.latest_var, width=6).grid(row=0, column=5)
+
         self.download_button = ttk.Button(main_frame, text="Download", command=self.start_download)
-        self.download_button.grid(row=2, column=0, columnspan=2, pady=10)
+        self.download_button.grid(row=3, column=0, columnspan=2, pady=10)
 
         self.progress_var = tk.StringVar(value="Ready")
-        ttk.Label(main_frame, textvariable=self.progress_var).grid(row=3, column=0, columnspan=2, sticky=tk.W, pady=5)
+        ttk.Label(main_frame, textvariable=self.progress_var).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        self.progress_bar = ttk.Progressbar(main_frame, orient="horizontal")
+        self.progress_bar.grid(row=5, column=0, columnspan=2, sticky="we")
 
         self.log_text = tk.Text(main_frame, height=15, width=60)
-        self.log_text.grid(row=4, column=0, sticky="nsew", pady=10)
+        self.log_text.grid(row=6, column=0, sticky="nsew", pady=10)
 
         scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=self.log_text.yview)
-        scrollbar.grid(row=4, column=1, sticky="ns")
+        scrollbar.grid(row=6, column=1, sticky="ns")
         self.log_text.configure(yscrollcommand=scrollbar.set)
 
+        # Download threads post log lines and progress here; the main loop applies them
+        self.events = GuiEvents()
+        self.pump = EventPump(root, self.events, self.log_text, self.progress_bar, self.progress_var)
+
         self.user_agents = self.load_user_agents()
 
         if getattr(sys, 'frozen', False):
@@ -89,10 +114,20 @@ class NarouGUI:
             self.log(f"Warning: Could not load user agents file, using defaults. Error: {exc}")
             return default_agents
 
+    def episode_range(self) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+        """Return the first, last and latest episode numbers entered, None where left empty."""
+        numbers: List[Optional[int]] = []
+        for var in (self.from_var, self.to_var, self.latest_var):
+            text = var.get().strip()
+            numbers.append(int(text) if text else None)
+        check_episode_range(*numbers)
+        if numbers[2] and (numbers[0] or numbers[1]):
+            raise ValueError("Enter either a range of episodes or the latest episodes, not both")
+        return numbers[0], numbers[1], numbers[2]
+
     def log(self, message: str) -> None:
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        """Queue a log line; safe to call from any thread."""
+        self.events.log(message)
 
     def start_download(self) -> None:
         novel_id = self.novel_id_var.get().strip()
@@ -100,6 +135,12 @@ class NarouGUI:
             messagebox.showerror("Error", "Please enter a novel ID")
             return
 
+        try:
+            episodes = self.episode_range()
+        except ValueError as exc:
+            messagebox.showerror("Error", f"Invalid episodes: {exc}")
+            return
+
         output_dir = Path(self.output_dir_var.get())
         try:
             output_dir.mkdir(parents=True, exist_ok=True)
@@ -109,27 +150,32 @@ class NarouGUI:
 
         self.download_button.configure(state='disabled')
         self.progress_var.set("Downloading...")
+        self.pump.reset_progress()
 
-        thread = threading.Thread(target=self.download_book, args=(novel_id, output_dir))
+        thread = threading.Thread(target=self.download_book, args=(novel_id, output_dir, episodes))
         thread.daemon = True
         thread.start()
 
-    def download_book(self, novel_id: str, output_dir: Path) -> None:
+    def download_book(self, novel_id: str, output_dir: Path, episodes: Tuple[Optional[int], Optional[int], Optional[int]]) -> None:
+        """Download the novel on a worker thread, reporting back through self.events."""
+        start, end, latest = episodes
         try:
-            downloader = NarouDownloader(novel_id=novel_id, log=self.log, output_dir=output_dir)
-            success = downloader.download(self.user_agents)
+            with EpisodeCache(output_dir / ".cache") as cache, Catalog(output_dir / CATALOG_NAME) as catalog:
+                downloader = NarouDownloader(novel_id=novel_id, log=self.log, output_dir=output_dir, progress=self.events.progress)
+                success = downloader.download(self.user_agents, cache=cache, start=start, end=end, latest=latest, catalog=catalog)
 
             if success:
-                self.progress_var.set("Download completed!")
-                messagebox.showinfo("Success", "Novel downloaded successfully!")
+                self.events.call(lambda: self.finish("Download completed!", messagebox.showinfo, "Success", "Novel downloaded successfully!"))
             else:
-                self.progress_var.set("Download failed")
-                messagebox.showerror("Error", "Failed to download novel")
+                self.events.call(lambda: self.finish("Download failed", messagebox.showerror, "Error", "Failed to download novel"))
         except Exception as exc:
-            self.progress_var.set("Error occurred")
-            messagebox.showerror("Error", f"An error occurred: {exc}")
-        finally:
-            self.root.after(0, lambda: self.download_button.configure(state='normal'))
+            message = f"An error occurred: {exc}"
+            self.events.call(lambda: self.finish("Error occurred", messagebox.showerror, "Error", message))
+
+    def finish(self, status: str, show: Callable[[str, str], object], title: str, message: str) -> None:
+        self.progress_var.set(status)
+        self.download_button.configure(state='normal')
+        show(title, message)
 
 
 def main() -> None:
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+from xml.sax.saxutils import escape
+
+from bs4.element import Comment, NavigableString, Tag
+
+from download_metrics import metrics
+from page_parser import make_soup
+
+try:
+    import zstandard
+except ImportError:  # compressing JSONL output is optional
+    zstandard = None
+
+# Output formats; every one but epub is written by a sink
+FORMATS = ("epub", "jsonl", "txt", "html")
+MARKUP_WHITESPACE = re.compile(r"[ \t\r]*\n[ \t\r\n]*")
+
+
+class Episode:
+    """An episode as handed out by ``DownloadEngine.iter_episodes`` and written by the sinks.
+
+    ``index`` is the episode's number in the work, ``body`` the chapter HTML
+    and ``hash`` the SHA-256 of the body, which tells changed episodes apart.
+    """
+
+    __slots__ = ("index", "title", "url", "body", "hash")
+
+    def __init__(self, index: int, title: str, url: str, body: str):
+        self.index = index
+        self.title = title
+        self.url = url
+        self.body = body
+        self.hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    def __repr__(self) -> str:
+        return f"Episode({self.index}, {self.title!r})"
+
+
+class SinkOptions:
+    """Which file the episodes of a work are written to instead of an EPUB.
+
+    ``format`` is one of ``FORMATS`` other than epub. ``compress`` writes
+    JSONL through zstd (needs the zstandard package) and ``strip_ruby``
+    drops the readings of ruby from text instead of keeping them in Narou's
+    ``|base《reading》`` notation.
+    """
+
+    def __init__(self, format: str = "jsonl", compress: bool = False, strip_ruby: bool = False):
+        self.format = format
+        self.compress = compress
+        self.strip_ruby = strip_ruby
+
+
+def element_text(element: Tag, strip_ruby: bool = False) -> str:
+    """Return the text of an element, with its line breaks and ruby."""
+    parts = []
+    for child in element.children:
+        if isinstance(child, Comment):
+            continue
+        if isinstance(child, NavigableString):
+            # Line breaks and indentation in the markup (prettified bodies have plenty) aren't text;
+            # ideographic spaces indenting a paragraph are
+            parts.append(MARKUP_WHITESPACE.sub("", str(child)))
+        elif child.name == "br":
+            parts.append("\n")
+        elif child.name == "ruby":
+            base = "".join(MARKUP_WHITESPACE.sub("", str(text)) for text in child.find_all(string=True, recursive=False))
+            base += "".join(element_text(rb) for rb in child.find_all("rb"))
+            reading = "".join(element_text(rt) for rt in child.find_all("rt"))
+            parts.append(f"|{base}《{reading}》" if reading and not strip_ruby else base)
+        elif child.name not in ("rt", "rp"):
+            parts.append(element_text(child, strip_ruby))
+    return "".join(parts)
+
+
+def html_to_text(body: str, strip_ruby: bool = False) -> str:
+    """Return chapter HTML as plain text, one paragraph per line."""
+    soup = make_soup(body)
+    paragraphs = soup.find_all("p")
+    if not paragraphs:
+        return element_text(soup, strip_ruby).strip("\n")
+    return "\n".join(element_text(paragraph, strip_ruby).strip("\n") for paragraph in paragraphs)
+
+
+class EpisodeSink:
+    """Write the episodes of a work to one file as they arrive, in reading order.
+
+    Episodes go to a temporary file next to the destination, which ``close``
+    moves to ``<title><extension>`` once the work is complete, so an
+    interrupted download never leaves a truncated file under the real name.
+    """
+
+    extension = ""
+
+    def __init__(self, output_dir: Path, options: SinkOptions, log: Optional[Callable[[str], None]] = None):
+        self.output_dir = Path(output_dir)
+        self.options = options
+        self.log = log or print
+        # Work title; may only become known from the first episode page
+        self.title: Optional[str] = None
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(suffix=f"{self.extension}.part", dir=str(self.output_dir))
+        self.temp_path = Path(temp_path)
+        self.file = self.open(os.fdopen(handle, "wb"))
+        self.count = 0
+
+    def open(self, raw: BinaryIO) -> BinaryIO:
+        return raw
+
+    def write(self, episode: Episode) -> None:
+        with metrics.stage("write"):
+            if not self.count:
+                self.file.write(self.header().encode("utf-8"))
+            self.file.write(self.encode(episode).encode("utf-8"))
+        self.count += 1
+
+    def header(self) -> str:
+        return ""
+
+    def footer(self) -> str:
+        return ""
+
+    def encode(self, episode: Episode) -> str:
+        raise NotImplementedError
+
+    def close(self, title: str) -> Path:
+        """Finish the file and move it into place."""
+        with metrics.stage("write"):
+            if not self.count:
+                self.file.write(self.header().encode("utf-8"))
+            self.file.write(self.footer().encode("utf-8"))
+            self.file.close()
+            path = self.output_dir / f"{title}{self.extension}"
+            os.replace(self.temp_path, path)
+        return path
+
+    def discard(self) -> None:
+        """Close and delete the partly written file."""
+        self.file.close()
+        self.temp_path.unlink(missing_ok=True)
+
+
+class JsonlSink(EpisodeSink):
+    """One JSON object per episode and line, with its plain text next to the chapter HTML."""
+
+    def __init__(self, output_dir: Path, options: SinkOptions, log: Optional[Callable[[str], None]] = None):
+        self.compress = options.compress and zstandard is not None
+        if options.compress and zstandard is None:
+            (log or print)("[WARN] zstandard is not installed (pip install zstandard); writing uncompressed JSONL")
+        self.extension = ".jsonl.zst" if self.compress else ".jsonl"
+        super().__init__(output_dir, options, log)
+
+    def open(self, raw: BinaryIO) -> BinaryIO:
+        return zstandard.ZstdCompressor().stream_writer(raw) if self.compress else raw
+
+    def encode(self, episode: Episode) -> str:
+        return json.dumps({
+            "work": self.title,
+            "index": episode.index,
+            "title": episode.title,
+            "url": episode.url,
+            "hash": episode.hash,
+            "text": html_to_text(episode.body, self.options.strip_ruby),
+            "html": episode.body,
+        }, ensure_ascii=False) + "\n"
+
+
+class TextSink(EpisodeSink):
+    """The work as UTF-8 text, each episode under its title."""
+
+    extension = ".txt"
+
+    def header(self) -> str:
+        return f"{self.title or ''}\n\n"
+
+    def encode(self, episode: Episode) -> str:
+        return f"\n{episode.title}\n\n{html_to_text(episode.body, self.options.strip_ruby)}\n"
+
+
+class HtmlSink(EpisodeSink):
+    """The work as one HTML page, each episode in its own section."""
+
+    extension = ".html"
+
+    def header(self) -> str:
+        title = escape(self.title or "")
+        return f'<!DOCTYPE html>\n<html lang="ja">\n<head>\n<meta charset="utf-8"/>\n<title>{title}</title>\n</head>\n<body>\n<h1>{title}</h1>\n'
+
+    def footer(self) -> str:
+        return "</body>\n</html>\n"
+
+    def encode(self, episode: Episode) -> str:
+        return f'<section id="episode_{episode.index}">\n<h2>{escape(episode.title)}</h2>\n{episode.body}\n</section>\n'
+
+
+SINKS = {"jsonl": JsonlSink, "txt": TextSink, "html": HtmlSink}
+
+
+def open_sink(output_dir: Path, options: SinkOptions, log: Optional[Callable[[str], None]] = None) -> EpisodeSink:
+    return SINKS[options.format](output_dir, options, log)
@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from download_metrics import metrics
+
+try:
+    import lxml  # noqa: F401  (C tree builder, several times faster than html.parser)
+    BACKENDS = ("lxml", "html.parser")
+except ImportError:
+    BACKENDS = ("html.parser",)
+
+T = TypeVar("T")
+
+# Tree builder used by make_soup; the fastest installed one unless set_backend is called
+backend = BACKENDS[0]
+
+
+def set_backend(name: str) -> None:
+    """Select the tree builder used by make_soup ("auto" picks the fastest installed one)."""
+    global backend
+    if name == "auto":
+        name = BACKENDS[0]
+    if name not in BACKENDS:
+        raise ValueError(f"HTML parser {name!r} is not available (installed: {', '.join(BACKENDS)})")
+    backend = name
+
+
+def make_soup(html: str, parse_only: Optional[SoupStrainer] = None, parser: Optional[str] = None) -> BeautifulSoup:
+    """Parse a page with the selected backend, optionally keeping only the strained elements."""
+    with metrics.stage("parse"):
+        return BeautifulSoup(html, parser or backend, parse_only=parse_only)
+
+
+def create_parse_pool(processes: int) -> ProcessPoolExecutor:
+    """Start worker processes for parsing pages with the backend selected in this process."""
+    return ProcessPoolExecutor(max_workers=max(1, processes), initializer=set_backend, initargs=(backend,))
+
+
+def parse_in(executor: Optional[Executor], parse: Callable[..., T], *args: Any) -> T:
+    """Call a module-level parse function in ``executor`` and wait for it, or inline if None.
+
+    With a process pool only the page and the extracted result cross the
+    process boundary, so the tree building doesn't hold this process's GIL.
+    """
+    if executor is None:
+        return parse(*args)
+    if not isinstance(executor, ProcessPoolExecutor):
+        return executor.submit(parse, *args).result()
+    # Worker processes record parse times in their own metrics; count the wait here
+    with metrics.stage("parse"):
+        return executor.submit(parse, *args).result()
+
+
+async def parse_in_async(executor: Optional[Executor], parse: Callable[..., T], *args: Any) -> T:
+    """Await a parse function run in ``executor`` (a process or thread pool) from the event loop."""
+    loop = asyncio.get_running_loop()
+    if not isinstance(executor, ProcessPoolExecutor):
+        return await loop.run_in_executor(executor, parse, *args)
+    # Worker processes record parse times in their own metrics; count the wait here
+    with metrics.stage("parse"):
+        return await loop.run_in_executor(executor, parse, *args)
+
+
+class ElementStrainer(SoupStrainer):
+    """Build only the elements with one of the given tag names, ids or classes.
+
+    Matching elements are kept with all of their descendants; everything else
+    is skipped while parsing, so selectors must not rely on their ancestors.
+    """
+
+    def __init__(self, names: Iterable[str] = (), ids: Iterable[str] = (), classes: Iterable[str] = ()):
+        super().__init__()
+        self.names = frozenset(names)
+        self.ids = frozenset(ids)
+        self.classes = frozenset(classes)
+
+    def wanted(self, name: str, attrs: Optional[Dict[str, Any]]) -> bool:
+        if name in self.names:
+            return True
+        attrs = attrs or {}
+        if attrs.get("id") in self.ids:
+            return True
+        classes = attrs.get("class") or ()
+        if isinstance(classes, str):
+            classes = classes.split()
+        return not self.classes.isdisjoint(classes)
+
+    def allow_tag_creation(self, nsprefix: Optional[str], name: str, attrs: Optional[Dict[str, Any]]) -> bool:
+        return self.wanted(name, attrs)
+
+    def allow_string_creation(self, string: str) -> bool:
+        return False
+
+    # beautifulsoup4 < 4.13 asks search_tag instead of allow_tag_creation
+    def search_tag(self, markup_name: Optional[str] = None, markup_attrs: Optional[Dict[str, Any]] = None) -> bool:
+        return self.wanted(markup_name, markup_attrs)
+
+
+def compare_backends(
+    html: str,
+    extract: Callable[[BeautifulSoup], Any],
+    parse_only: Optional[SoupStrainer] = None,
+) -> Dict[str, Any]:
+    """Run ``extract`` on the page parsed by every backend, with and without ``parse_only``.
+
+    Returns the result keyed by the parse used ("lxml", "lxml+strainer", ...).
+    """
+    results = {}
+    for name in BACKENDS:
+        results[name] = extract(make_soup(html, parser=name))
+        if parse_only is not None:
+            results[f"{name}+strainer"] = extract(make_soup(html, parse_only, parser=name))
+    return results
+
+
+def check_pages(site: str, paths: List[Path]) -> bool:
+    """Check that every backend extracts the same chapter from saved episode pages."""
+    if site == "kakuyomu":
+        from kakuyomu import EPISODE_STRAINER, parse_episode
+        extract = lambda soup: parse_episode(soup, 1)  # noqa: E731
+    else:
+        from narou_downloader import EPISODE_STRAINER, parse_episode, parse_novel_title
+        extract = lambda soup: (parse_novel_title(soup),) + parse_episode(soup, 1)  # noqa: E731
+
+    agree = True
+    for path in paths:
+        results = compare_backends(path.read_text(encoding="utf-8"), extract, EPISODE_STRAINER)
+        reference_name, reference = next(iter(results.items()))
+        differing = [name for name, result in results.items() if result != reference]
+        if differing:
+            agree = False
+            print(f"[ERROR] {path}: {', '.join(differing)} differ from {reference_name}")
+        elif reference[-1] is None:
+            print(f"[WARN] {path}: no chapter content found")
+        else:
+            print(f"[INFO] {path}: {len(results)} parses agree")
+    return agree
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that every HTML parser backend extracts the same chapters')
+    parser.add_argument('site', choices=['kakuyomu', 'narou'], help='Site the pages were saved from')
+    parser.add_argument('pages', nargs='+', type=Path, help='Saved episode pages')
+    args = parser.parse_args()
+
+    print(f"[INFO] Backends: {', '.join(BACKENDS)}")
+    sys.exit(0 if check_pages(args.site, args.pages) else 1)
+
+if __name__ == "__main__":
+    main()
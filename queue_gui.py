@@ -0,0 +1,281 @@
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import io
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+import os
+import sys
+
+from batch import DEFAULT_ACTIVE_WORKS, DEFAULT_SITE_WORKERS, DEFAULT_WORKERS, BatchDownloader, BatchScheduler, BatchWork, read_work_list
+from catalog import CATALOG_NAME, Catalog
+from episode_cache import EpisodeCache
+from gui_events import EventPump, GuiEvents
+from http_client import HttpClient
+
+REFRESH_INTERVAL_MS = 500
+COLUMNS = ("site", "work", "title", "progress", "status")
+
+
+class QueueGUI:
+    """Download a list of Kakuyomu and Narou works through one shared worker pool.
+
+    Works can be added at any time; each has its own row with its progress,
+    and selected rows can be paused, resumed, cancelled or retried. All works
+    share the output directory, the HTTP client (and its user agent), the
+    episode cache and the catalog, which are set up when the first work is added.
+    """
+
+    def __init__(self, root: tk.Tk, workers: int = DEFAULT_WORKERS, max_active: int = DEFAULT_ACTIVE_WORKS):
+        self.root = root
+        self.root.title("Novel Download Queue")
+        self.root.geometry("760x560")
+        self.workers = workers
+        self.max_active = max_active
+
+        main_frame = ttk.Frame(root, padding="10")
+        main_frame.grid(row=0, column=0, sticky="nsew")
+
+        root.columnconfigure(0, weight=1)
+        root.rowconfigure(0, weight=1)
+        main_frame.columnconfigure(0, weight=1)
+        main_frame.rowconfigure(2, weight=1)
+
+        input_frame = ttk.Frame(main_frame)
+        input_frame.grid(row=0, column=0, columnspan=2, sticky="we", pady=5)
+        input_frame.columnconfigure(1, weight=1)
+
+        ttk.Label(input_frame, text="IDs or URLs:").grid(row=0, column=0, padx=(0, 5))
+        self.works_var = tk.StringVar()
+        works_entry = ttk.Entry(input_frame, textvariable=self.works_var)
+        works_entry.grid(row=0, column=1, sticky="we")
+        works_entry.bind("<Return>", lambda event: self.add_from_entry())
+        ttk.Button(input_frame, text="Add", command=self.add_from_entry).grid(row=0, column=2, padx=(5, 0))
+        ttk.Button(input_frame, text="Add list...", command=self.add_from_file).grid(row=0, column=3, padx=(5, 0))
+
+        dir_frame = ttk.Frame(main_frame)
+        dir_frame.grid(row=1, column=0, columnspan=2, sticky="we", pady=5)
+        dir_frame.columnconfigure(1, weight=1)
+
+        ttk.Label(dir_frame, text="Save to:").grid(row=0, column=0, padx=(0, 5))
+        self.output_dir_var = tk.StringVar(value=str(Path.cwd() / "epub"))
+        self.output_dir_entry = ttk.Entry(dir_frame, textvariable=self.output_dir_var)
+        self.output_dir_entry.grid(row=0, column=1, sticky="we")
+        self.browse_button = ttk.Button(dir_frame, text="Browse", command=self.browse_output_dir)
+        self.browse_button.grid(row=0, column=2, padx=(5, 0))
+
+        self.tree = ttk.Treeview(main_frame, columns=COLUMNS, show="headings", height=10)
+        for column, heading, width in zip(COLUMNS, ("Site", "ID", "Title", "Progress", "Status"), (80, 150, 240, 100, 160)):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, stretch=column in ("title", "status"))
+        self.tree.grid(row=2, column=0, sticky="nsew", pady=5)
+        tree_scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=self.tree.yview)
+        tree_scrollbar.grid(row=2, column=1, sticky="ns", pady=5)
+        self.tree.configure(yscrollcommand=tree_scrollbar.set)
+
+        button_frame = ttk.Frame(main_frame)
+        button_frame.grid(row=3, column=0, columnspan=2, sticky="w", pady=5)
+        for column, (label, command) in enumerate((
+            ("Pause", self.pause_selected),
+            ("Resume", self.resume_selected),
+            ("Cancel", self.cancel_selected),
+            ("Retry", self.retry_selected),
+        )):
+            ttk.Button(button_frame, text=label, command=command).grid(row=0, column=column, padx=(0, 5))
+
+        self.progress_var = tk.StringVar(value="Add works to start downloading")
+        ttk.Label(main_frame, textvariable=self.progress_var).grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        self.progress_bar = ttk.Progressbar(main_frame, orient="horizontal")
+        self.progress_bar.grid(row=5, column=0, columnspan=2, sticky="we")
+
+        self.log_text = tk.Text(main_frame, height=10, width=60)
+        self.log_text.grid(row=6, column=0, sticky="nsew", pady=10)
+
+        scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=self.log_text.yview)
+        scrollbar.grid(row=6, column=1, sticky="ns")
+        self.log_text.configure(yscrollcommand=scrollbar.set)
+
+        # Worker threads post log lines here; the main loop applies them
+        self.events = GuiEvents()
+        self.pump = EventPump(root, self.events, self.log_text, self.progress_bar, self.progress_var)
+
+        self.user_agents = self.load_user_agents()
+        self.works: Dict[str, BatchWork] = {}
+        self.client: Optional[HttpClient] = None
+        self.cache: Optional[EpisodeCache] = None
+        self.catalog: Optional[Catalog] = None
+        self.downloader: Optional[BatchDownloader] = None
+        self.scheduler: Optional[BatchScheduler] = None
+
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(REFRESH_INTERVAL_MS, self.refresh)
+
+        if getattr(sys, 'frozen', False):
+            sys.stdout = open(os.devnull, 'w')
+            sys.stderr = open(os.devnull, 'w')
+
+    def browse_output_dir(self) -> None:
+        dir_path = filedialog.askdirectory(initialdir=self.output_dir_var.get())
+        if dir_path:
+            self.output_dir_var.set(dir_path)
+
+    def load_user_agents(self) -> List[str]:
+        default_agents = [
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Firefox/89.0",
+            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+        ]
+
+        try:
+            if getattr(sys, 'frozen', False):
+                base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+            else:
+                base_path = os.path.dirname(os.path.abspath(__file__))
+
+            user_agents_path = os.path.join(base_path, 'userAgents.json')
+
+            if os.path.exists(user_agents_path):
+                with open(user_agents_path, 'r', encoding='utf-8') as file:
+                    return json.load(file)
+            return default_agents
+        except Exception as exc:
+            self.log(f"Warning: Could not load user agents file, using defaults. Error: {exc}")
+            return default_agents
+
+    def log(self, message: str) -> None:
+        """Queue a log line; safe to call from any thread."""
+        self.events.log(message)
+
+    def start(self) -> bool:
+        """Open the shared client, cache, catalog and worker pool before the first work is added."""
+        if self.scheduler:
+            return True
+        output_dir = Path(self.output_dir_var.get())
+        try:
+            output_dir.mkdir(parents=True, exist_ok=True)
+        except Exception as exc:
+            messagebox.showerror("Error", f"Could not create output directory: {exc}")
+            return False
+
+        # Every work of the queue is saved to the same directory
+        self.output_dir_entry.configure(state='disabled')
+        self.browse_button.configure(state='disabled')
+        self.client = HttpClient(self.user_agents, pool_size=self.workers, log=self.log)
+        self.cache = EpisodeCache(output_dir / ".cache")
+        self.catalog = Catalog(output_dir / CATALOG_NAME)
+        # Resume from the journal, so cancelled or failed works that are retried don't start over
+        self.downloader = BatchDownloader(self.client, output_dir, self.cache, log=self.log, resume=True, catalog=self.catalog)
+        self.scheduler = BatchScheduler(
+            [], {"kakuyomu": DEFAULT_SITE_WORKERS, "narou": DEFAULT_SITE_WORKERS}, self.max_active, keep_open=True, workers=self.workers,
+        )
+        self.downloader.start(self.scheduler)
+        self.log(f"Using User Agent: {self.client.user_agent}")
+        self.pump.reset_progress()
+        return True
+
+    def add_from_entry(self) -> None:
+        text = self.works_var.get()
+        if not text.strip():
+            return
+        self.works_var.set("")
+        self.add_works(re.split(r'[\s,]+', text))
+
+    def add_from_file(self) -> None:
+        path = filedialog.askopenfilename(filetypes=[("Text files", "*.txt"), ("All files", "*.*")])
+        if path:
+            with open(path, 'r', encoding='utf-8') as file:
+                self.add_works(file.read().splitlines())
+
+    def add_works(self, lines: List[str]) -> None:
+        works = read_work_list(io.StringIO("\n".join(lines)), log=self.log)
+        if not works or not self.start():
+            return
+        for work in works:
+            key = f"{work.site}:{work.work_id}"
+            if key in self.works:
+                self.log(f"{work.name} is already in the queue")
+                continue
+            self.works[key] = work
+            self.tree.insert("", tk.END, iid=key, values=(work.site, work.work_id, "", "", "Waiting"))
+            self.scheduler.add(work)
+        self.refresh_rows()
+
+    def selected_works(self) -> List[BatchWork]:
+        return [self.works[key] for key in self.tree.selection()]
+
+    def pause_selected(self) -> None:
+        for work in self.selected_works():
+            if work.state not in ("done", "failed"):
+                self.scheduler.set_paused(work, True)
+        self.refresh_rows()
+
+    def resume_selected(self) -> None:
+        for work in self.selected_works():
+            self.scheduler.set_paused(work, False)
+        self.refresh_rows()
+
+    def cancel_selected(self) -> None:
+        for work in self.selected_works():
+            if work.state in ("done", "failed"):
+                continue
+            self.scheduler.cancel(work)
+            self.log(f"{work.name}: cancelled")
+        self.refresh_rows()
+
+    def retry_selected(self) -> None:
+        for work in self.selected_works():
+            if work.state == "failed" and not work.running:
+                work.reset()
+                self.scheduler.add(work)
+        self.refresh_rows()
+
+    def refresh(self) -> None:
+        self.refresh_rows()
+        self.root.after(REFRESH_INTERVAL_MS, self.refresh)
+
+    def refresh_rows(self) -> None:
+        """Show the progress of every work and of the whole queue."""
+        done_total = 0
+        episodes_total = 0
+        for key, work in self.works.items():
+            total = work.total
+            done = total if work.state == "done" else work.done
+            if work.state != "failed":
+                done_total += done
+                episodes_total += total
+            progress = f"{done}/{total}" if total else ""
+            self.tree.item(key, values=(work.site, work.work_id, work.title or "", progress, self.describe(work)))
+        if episodes_total:
+            self.pump.show_progress(done_total, episodes_total)
+
+    def describe(self, work: BatchWork) -> str:
+        if work.state == "done":
+            return "Done"
+        if work.state == "failed":
+            return "Cancelled" if work.error == "cancelled" else f"Failed: {work.error}"
+        if work.paused:
+            return "Paused"
+        if work.state == "waiting":
+            return "Waiting"
+        return "Downloading" if work.total or work.done else "Listing episodes"
+
+    def close(self) -> None:
+        """Stop handing out tasks and close the window; journals let unfinished works resume."""
+        if self.scheduler and any(work.state not in ("done", "failed") for work in self.works.values()):
+            if not messagebox.askokcancel("Quit", "Downloads are still running. Quit anyway?"):
+                return
+        if self.scheduler:
+            self.scheduler.stop()
+        self.root.destroy()
+
+
+def main() -> None:
+    root = tk.Tk()
+    app = QueueGUI(root)
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
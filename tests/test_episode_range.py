@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+import pytest
+
+import batch
+import kakuyomu
+import kakuyomu_gui
+import narou_downloader
+import narou_gui
+
+
+class Var:
+    def __init__(self, text: str):
+        self.text = text
+
+    def get(self) -> str:
+        return self.text
+
+
+def gui_fields(start: str, end: str, latest: str) -> SimpleNamespace:
+    return SimpleNamespace(from_var=Var(start), to_var=Var(end), latest_var=Var(latest))
+
+
+@pytest.mark.parametrize("main, work_id", [(kakuyomu.main, "16816700427572694145"), (narou_downloader.main, "n5511kh")])
+@pytest.mark.parametrize("flags, message", [
+    (["--from", "8", "--to", "5"], "episode 8 comes after episode 5"),
+    (["--from", "0"], "0 is not an episode number"),
+    (["--to", "-3"], "-3 is not an episode number"),
+    (["--latest", "0"], "0 is not an episode number"),
+])
+def test_cli_rejects_bad_range(monkeypatch, capsys, main, work_id, flags, message):
+    monkeypatch.setattr("sys.argv", ["prog", "install", work_id, *flags])
+    with pytest.raises(SystemExit) as exc:
+        main()
+    assert exc.value.code == 2
+    assert message in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("gui", [kakuyomu_gui.KakuyomuGUI, narou_gui.NarouGUI])
+def test_gui_episode_range(gui):
+    assert gui.episode_range(gui_fields("2", "5", "")) == (2, 5, None)
+    assert gui.episode_range(gui_fields("", "", "10")) == (None, None, 10)
+    assert gui.episode_range(gui_fields("", "", "")) == (None, None, None)
+    for fields in (("8", "5", ""), ("0", "", ""), ("", "", "-1"), ("2", "", "3")):
+        with pytest.raises(ValueError):
+            gui.episode_range(gui_fields(*fields))
+
+
+def test_batch_episode_range():
+    assert batch.parse_episode_range("120-150") == (120, 150, None)
+    assert batch.parse_episode_range("120-") == (120, None, None)
+    assert batch.parse_episode_range("-150") == (None, 150, None)
+    assert batch.parse_episode_range("latest:10") == (None, None, 10)
+    for text in ("150-120", "0-5", "latest:0", "-", "x-1"):
+        with pytest.raises(ValueError):
+            batch.parse_episode_range(text)
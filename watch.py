@@ -0,0 +1,339 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import narou_downloader
+from catalog import CATALOG_NAME, Catalog
+from batch import ADAPTERS, DEFAULT_ACTIVE_WORKS, DEFAULT_WORKERS, BatchDownloader, BatchWork, parse_work_ref
+from download_engine import SiteAdapter
+from epub_images import DEFAULT_IMAGE_QUALITY, ImageOptions
+from episode_cache import DEFAULT_CACHE_DIR, EpisodeCache
+from http_client import DEFAULT_MAX_RETRIES, HttpClient, parse_rate_limit
+from narou_api import NAROU_API_URL
+
+DEFAULT_SUBSCRIPTIONS = Path("subscriptions.json")
+# Poll intervals in seconds: a new subscription starts at an hour
+DEFAULT_MIN_INTERVAL = 10 * 60
+DEFAULT_MAX_INTERVAL = 24 * 60 * 60
+INITIAL_INTERVAL = 60 * 60
+# An unchanged work is polled this much less often, a changed one twice as often
+BACKOFF_FACTOR = 1.5
+# Longest sleep between two looks at the subscription file, so works added meanwhile are picked up
+RELOAD_INTERVAL = 60
+
+
+def listing_stamp(episodes: List[Dict[str, str]], count: Optional[int] = None) -> str:
+    """Summarize an episode listing so that any new, removed or revised episode in it changes it.
+
+    ``count`` is the number of episodes of the work when ``episodes`` are only the latest ones.
+    """
+    digest = hashlib.sha1()
+    for episode in episodes:
+        digest.update(f"{episode['url']}\t{episode.get('stamp', '')}\n".encode("utf-8"))
+    return f"{len(episodes) if count is None else count} episodes, {digest.hexdigest()[:12]}"
+
+
+class Subscription:
+    """A followed work: what it looked like when last polled and when to poll it again."""
+
+    def __init__(
+        self,
+        site: str,
+        work_id: str,
+        title: Optional[str] = None,
+        stamp: Optional[str] = None,
+        interval: float = INITIAL_INTERVAL,
+        next_check: float = 0.0,
+        last_change: Optional[float] = None,
+    ):
+        self.site = site
+        self.work_id = work_id
+        self.title = title
+        # Last update time or listing summary of the work; None until it was first downloaded
+        self.stamp = stamp
+        self.interval = interval
+        self.next_check = next_check
+        self.last_change = last_change
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.site, self.work_id
+
+    @property
+    def name(self) -> str:
+        return f"{self.site} {self.work_id}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "site": self.site,
+            "work_id": self.work_id,
+            "title": self.title,
+            "stamp": self.stamp,
+            "interval": self.interval,
+            "next_check": self.next_check,
+            "last_change": self.last_change,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Subscription":
+        return cls(
+            data["site"],
+            data["work_id"],
+            data.get("title"),
+            data.get("stamp"),
+            float(data.get("interval") or INITIAL_INTERVAL),
+            float(data.get("next_check") or 0.0),
+            data.get("last_change"),
+        )
+
+    def reschedule(self, now: float, changed: bool, min_interval: float, max_interval: float) -> None:
+        """Poll a work that just changed more often and one that didn't less often."""
+        interval = self.interval / 2 if changed else self.interval * BACKOFF_FACTOR
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.next_check = now + self.interval
+
+
+class SubscriptionList:
+    """The followed works, kept as a JSON file so a running watcher and the CLI can share it."""
+
+    def __init__(self, path: Path = DEFAULT_SUBSCRIPTIONS):
+        self.path = Path(path)
+
+    def load(self) -> List[Subscription]:
+        if not self.path.exists():
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            return [Subscription.from_dict(data) for data in json.load(f)]
+
+    def save(self, subscriptions: List[Subscription]) -> None:
+        """Replace the file in one step, so it is never seen half written."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump([subscription.to_dict() for subscription in subscriptions], f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+    def add(self, refs: Iterable[Tuple[str, str]]) -> List[Subscription]:
+        """Follow works not followed yet; return the new subscriptions."""
+        subscriptions = self.load()
+        known = {subscription.key for subscription in subscriptions}
+        added = [Subscription(site, work_id) for site, work_id in refs if (site, work_id) not in known]
+        if added:
+            self.save(subscriptions + added)
+        return added
+
+    def remove(self, refs: Iterable[Tuple[str, str]]) -> List[Subscription]:
+        """Stop following works; return the subscriptions removed."""
+        keys = set(refs)
+        subscriptions = self.load()
+        removed = [subscription for subscription in subscriptions if subscription.key in keys]
+        if removed:
+            self.save([subscription for subscription in subscriptions if subscription.key not in keys])
+        return removed
+
+    def merge(self, polled: List[Subscription]) -> None:
+        """Store the outcome of a poll, keeping works added or removed while it ran."""
+        updates = {subscription.key: subscription for subscription in polled}
+        self.save([updates.get(subscription.key, subscription) for subscription in self.load()])
+
+
+class Watcher:
+    """Poll followed works and download the ones that changed.
+
+    A poll asks each site for the cheapest sign of a change it offers: the
+    last update time from the Syosetu novel API for Narou (with
+    ``narou_api_url``), otherwise a summary of the work's episode listing,
+    which for Kakuyomu is a single work page. Only works whose sign differs
+    from the previous poll are downloaded, as with ``--update``, so only
+    their new or changed episodes are fetched. Each work is polled at its
+    own interval, which halves when it changed and grows otherwise, between
+    ``min_interval`` and ``max_interval``.
+    """
+
+    def __init__(
+        self,
+        subscriptions: SubscriptionList,
+        client: HttpClient,
+        output_dir: Path = Path("epub"),
+        cache: Optional[EpisodeCache] = None,
+        narou_api_url: Optional[str] = None,
+        workers: int = DEFAULT_WORKERS,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        max_interval: float = DEFAULT_MAX_INTERVAL,
+        log: Optional[Callable[[str], None]] = None,
+        images: Optional[ImageOptions] = None,
+        catalog: Optional[Catalog] = None,
+    ):
+        self.subscriptions = subscriptions
+        self.client = client
+        self.output_dir = Path(output_dir)
+        self.cache = cache
+        self.narou_api_url = narou_api_url
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.log = log or print
+        self.images = images
+        self.catalog = catalog
+
+    def adapters(self) -> Dict[str, SiteAdapter]:
+        # A new Narou adapter per poll, so the API answers of the previous one aren't reused
+        return dict(ADAPTERS, narou=narou_downloader.NarouAdapter(self.narou_api_url))
+
+    def check(self, adapter: SiteAdapter, subscription: Subscription) -> str:
+        """Return the current update time or listing summary of a work."""
+        title, stamp = adapter.work_stamp(self.client, subscription.work_id, self.log)
+        if stamp:
+            return stamp
+        # New episodes show up among the latest ones, so the rest of a long listing isn't read
+        latest = adapter.latest_episodes(self.client, subscription.work_id, self.log)
+        if latest:
+            count, episodes = latest
+            return listing_stamp(episodes, count)
+        title, listing = adapter.list_episodes(self.client, subscription.work_id, self.log)
+        episodes = list(listing)
+        if not episodes:
+            raise ValueError("no episodes found")
+        return listing_stamp(episodes)
+
+    def poll(self, now: Optional[float] = None) -> List[Subscription]:
+        """Check the works that are due and download those that changed; return the works checked."""
+        now = time.time() if now is None else now
+        due = [subscription for subscription in self.subscriptions.load() if subscription.next_check <= now]
+        if not due:
+            return []
+        adapters = self.adapters()
+        for site, adapter in adapters.items():
+            adapter.prefetch(self.client, [subscription.work_id for subscription in due if subscription.site == site], self.log)
+
+        changed: List[Tuple[Subscription, str]] = []
+        for subscription in due:
+            try:
+                stamp = self.check(adapters[subscription.site], subscription)
+            except Exception as exc:
+                self.log(f"[WARN] {subscription.name}: could not check for updates: {type(exc).__name__}: {exc}")
+                subscription.next_check = now + self.min_interval
+                continue
+            if stamp == subscription.stamp:
+                subscription.reschedule(now, False, self.min_interval, self.max_interval)
+            else:
+                changed.append((subscription, stamp))
+        self.log(f"[INFO] Checked {len(due)} works, {len(changed)} changed")
+
+        if changed:
+            downloader = BatchDownloader(self.client, self.output_dir, self.cache, update=True, log=self.log, resume=True, adapters=adapters, images=self.images, catalog=self.catalog)
+            works = downloader.run([BatchWork(*subscription.key) for subscription, _ in changed], self.workers, max_active=DEFAULT_ACTIVE_WORKS)
+            for (subscription, stamp), work in zip(changed, works):
+                if work.state != "done":
+                    self.log(f"[ERROR] {subscription.name}: {work.error}; retrying in {self.min_interval / 60:.0f} minutes")
+                    subscription.next_check = now + self.min_interval
+                    continue
+                self.log(f"[INFO] {subscription.name}: {', '.join(str(path) for path in work.paths)}")
+                # The first download of a work tells nothing about how often it changes
+                first = subscription.stamp is None
+                subscription.stamp = stamp
+                subscription.title = work.title or subscription.title
+                if first:
+                    subscription.next_check = now + subscription.interval
+                else:
+                    subscription.last_change = now
+                    subscription.reschedule(now, True, self.min_interval, self.max_interval)
+        self.subscriptions.merge(due)
+        return due
+
+    def run(self) -> None:
+        """Poll until interrupted, sleeping until the next work is due."""
+        while True:
+            self.poll()
+            pending = [subscription.next_check for subscription in self.subscriptions.load()]
+            wait = min(pending, default=time.time() + RELOAD_INTERVAL) - time.time()
+            time.sleep(min(max(wait, 1.0), RELOAD_INTERVAL))
+
+
+def describe_time(timestamp: Optional[float]) -> str:
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)) if timestamp else "never"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Follow Kakuyomu and Narou works and download them when they are updated')
+    parser.add_argument('mode', choices=['add', 'remove', 'list', 'run'], help='Follow works, stop following them, show them, or poll them')
+    parser.add_argument('works', nargs='*', help='Work IDs or URLs to add or remove')
+    parser.add_argument('--subscriptions', type=Path, default=DEFAULT_SUBSCRIPTIONS, help='File the followed works are kept in')
+    parser.add_argument('--once', action='store_true', help='Poll the works that are due once and exit (for cron)')
+    parser.add_argument('--min-interval', type=float, default=DEFAULT_MIN_INTERVAL / 60, help='Shortest time between two polls of a work, in minutes')
+    parser.add_argument('--max-interval', type=float, default=DEFAULT_MAX_INTERVAL / 60, help='Longest time between two polls of a work, in minutes')
+    parser.add_argument('--output-dir', type=Path, default=Path('epub'), help='Directory the EPUB files are written to')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Requests running at once while downloading updates')
+    parser.add_argument('--images', action='store_true', help='Download the illustrations of the chapters and embed them in the EPUBs')
+    parser.add_argument('--image-max-size', type=int, help='Scale embedded images down to this many pixels on the longest edge (requires Pillow)')
+    parser.add_argument('--image-quality', type=int, help=f'Recompress embedded images as JPEG of this quality (requires Pillow, default {DEFAULT_IMAGE_QUALITY} when scaling)')
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR, help='Directory of the episode cache')
+    parser.add_argument('--no-cache', action='store_true', help='Download and parse every episode again')
+    parser.add_argument('--no-catalog', action='store_true', help=f'Don\'t record the downloads in {CATALOG_NAME} in the output directory')
+    parser.add_argument('--narou-api', action='store_true', help='Check Narou works for updates with the Syosetu novel API')
+    parser.add_argument('--narou-api-url', default=NAROU_API_URL, help='Base URL of the novel API (for a mirror or local stand-in)')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES, help='Retries of a request after network errors, 429 or 5xx responses')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='HOST=RATE', help='Requests per second allowed for a host (0 disables the limit)')
+    args = parser.parse_args()
+
+    subscriptions = SubscriptionList(args.subscriptions)
+    if args.mode in ('add', 'remove'):
+        refs = []
+        for work in args.works:
+            ref = parse_work_ref(work)
+            if ref is None:
+                print(f"[ERROR] Not a Kakuyomu or Narou work: {work}")
+                sys.exit(1)
+            refs.append(ref)
+        if args.mode == 'add':
+            changed = subscriptions.add(refs)
+            print(f"[INFO] Following {len(changed)} new works")
+        else:
+            changed = subscriptions.remove(refs)
+            print(f"[INFO] Stopped following {len(changed)} works")
+        return
+
+    if args.mode == 'list':
+        for subscription in subscriptions.load():
+            print(f"{subscription.name}: {subscription.title or '(not downloaded yet)'}")
+            next_check = describe_time(subscription.next_check) if subscription.next_check > time.time() else "now"
+            print(f"  every {subscription.interval / 60:.0f} min, next check {next_check}, last update seen {describe_time(subscription.last_change)}")
+        return
+
+    with open('userAgents.json', 'r') as f:
+        user_agents = json.load(f)
+
+    rate_limits = {host: rate for limit in args.rate_limit for host, rate in limit.items()}
+    cache = None if args.no_cache else EpisodeCache(args.cache_dir)
+    catalog = None if args.no_catalog else Catalog(args.output_dir / CATALOG_NAME)
+    try:
+        with HttpClient(user_agents, pool_size=args.workers, rate_limits=rate_limits, max_retries=args.max_retries) as client:
+            watcher = Watcher(
+                subscriptions, client, args.output_dir, cache,
+                narou_api_url=args.narou_api_url if args.narou_api else None,
+                workers=args.workers,
+                min_interval=args.min_interval * 60,
+                max_interval=args.max_interval * 60,
+                images=ImageOptions(args.image_max_size, args.image_quality) if args.images else None,
+                catalog=catalog,
+            )
+            if args.once:
+                watcher.poll()
+            else:
+                print(f"[INFO] Watching the works in {args.subscriptions} (Ctrl+C to stop)")
+                watcher.run()
+    except KeyboardInterrupt:
+        print("[INFO] Stopped watching")
+    finally:
+        if cache:
+            cache.close()
+        if catalog:
+            catalog.close()
+
+if __name__ == "__main__":
+    main()